@@ -1,16 +1,31 @@
 from datetime import datetime
-from meteostat import Point, Hourly
+from weather_store import WeatherStore
+import pandas as pd
 import time
 start_time = time.time()
 
-location = Point(57.014768, 9.974116)  # AAU Build
+STATIONS = {'aau_build': (57.014768, 9.974116)}  # AAU Build
+# we can add more locations, e.g. {'aau_build': ..., 'aalborg_airport': (57.0928, 9.8492)}; with more than
+# one location every column is prefixed with the name of its location
+VARIABLES = ['temp', 'dwpt', 'rhum', 'prcp', 'wspd', 'wdir', 'pres', 'tsun', 'coco']
+# meteostat hourly variables: temperature, dew point, relative humidity, precipitation, wind speed and direction,
+# pressure, sunshine minutes and weather condition code (the thermal models mostly need temp, rhum, wspd and tsun)
+FETCH = True
+# False works offline, from the weather store and the files dropped in weather_store/drop/<location>/
 start = datetime(2024, 9, 7)
 end = datetime(2025, 5, 11)
-# we specify the location, start and end date of the dataset
-data = Hourly(location, start, end)
-data = data.fetch()
-# we extract the weather data hourly ( we cannot extract it minute-by-minute )
-temp_data = data[['temp']]
-# we want to extract only the temperature from the API
-temp_data.to_csv("aalborg_weather_hourly_test2.csv")
-print("--- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+# we specify the start and end date of the dataset
+store = WeatherStore()
+frames = []
+for name, location in STATIONS.items():
+    data = store.hourly(location, start, end + pd.Timedelta(hours=1), VARIABLES, fetch=FETCH)
+    # we read the weather data hourly ( we cannot extract it minute-by-minute ) from the local weather store, which
+    # only fetches the hours it does not hold yet from meteostat; its end is exclusive, so we add an hour to keep
+    # the end hour, as the meteostat call did
+    if len(STATIONS) > 1:
+        data = data.add_prefix(name + '_')
+    frames.append(data)
+weather_data = pd.concat(frames, axis=1)
+weather_data.index.name = 'time'
+weather_data.to_csv("aalborg_weather_hourly_test2.csv")
+print("--- %s seconds ---" % (time.time() - start_time))
@@ -1,12 +1,196 @@
+import json
+import os
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
+from exogenous_alignment import ExogenousSeries, align_exogenous
+from weather_store import WeatherStore
 start_time = time.time()
 
-senzori = pd.read_csv("TMV23_2025_02_28_Rooms_100_memeff_2024_2__2024_6.csv", parse_dates=['time'])
-# we read the dataset , using each date value  as datetime
-temp = pd.read_csv("aalborg_weather_hourly.csv", parse_dates=['time'])
-# we read the weather dataset, using each date value  as datetime
-merged = pd.merge_asof(senzori, temp, on='time', direction='backward')
-# we merge the two datasets, each row will get the last known hourly temperature from the weather dataset, using the direction backwards
-merged.to_csv("TMV23_2025_02_28_Rooms_100_memeff_2024_2__2024_6_augmented_weather.csv", index=False)
-print("--- %s seconds ---" % (time.time() - start_time))
\ No newline at end of file
+SENSOR_DATA = "TMV23_2025_02_28_Rooms_100_memeff_2024_2__2024_6.csv"
+# the sensor data: a CSV export, or a Parquet file / partitioned Parquet dataset directory (e.g. from bms_dataset)
+SERIES = [
+    {'location': (57.014768, 9.974116), 'variables': ['temp'], 'method': 'linear'},
+]
+# the exogenous series joined onto the sensor times (weather stations, tariffs, ...): a CSV with a 'time' column and
+# a method: 'last' (last known value, a step function), 'linear', 'spline' (needs scipy) or 'mean' (needs a 'window',
+# e.g. '1h'); optional 'columns' to use and a 'prefix' for the new column names (e.g. one per station)
+# instead of a 'path', a 'location' (latitude, longitude) with 'variables' reads the hourly weather straight from
+# the local weather store (see weather_store.py), which only fetches the hours it does not hold yet
+OUTPUT = "TMV23_2025_02_28_Rooms_100_memeff_2024_2__2024_6_augmented_weather.csv"
+# for Parquet sensor data the output is a Parquet file / dataset directory with the same layout
+MODE = 'chunked'        # either 'memory' (load everything) or 'chunked' (stream the sensor data)
+CHUNK_ROWS = 100000
+# number of sensor rows held in memory at once in the chunked mode
+
+
+def parse_csv_times(times):
+    """Parse the times of a CSV file through UTC, as a file spanning a DST change holds two UTC offsets."""
+    return pd.to_datetime(times, utc=True)
+
+
+def sensor_time_range(sensor_path):
+    """Return the first and last time of the sensor data, reading only its time column."""
+    first = last = None
+    if not sensor_path.endswith('.parquet') and not os.path.isdir(sensor_path):
+        times = (parse_csv_times(chunk['time']) for chunk in pd.read_csv(sensor_path, usecols=['time'],
+                                                                         chunksize=CHUNK_ROWS))
+    else:
+        files = ([os.path.join(root, name) for root, _, names in os.walk(sensor_path)
+                  for name in names if name.endswith('.parquet')] if os.path.isdir(sensor_path) else [sensor_path])
+        times = (pq.read_table(file_path, columns=['time']).to_pandas()['time'] for file_path in files)
+    for time_values in times:
+        if len(time_values):
+            first = time_values.min() if first is None else min(first, time_values.min())
+            last = time_values.max() if last is None else max(last, time_values.max())
+    return first, last
+
+
+def load_series(specs, time_range=None):
+    """
+    Load the exogenous series of the SERIES settings.
+
+    Args:
+        specs: List of {'path' or 'location', 'variables', 'method', 'window', 'columns', 'prefix'} dicts (see SERIES)
+        time_range: (first, last) time of the sensor data, needed for the series read from the weather store
+
+    Returns:
+        List of ExogenousSeries
+    """
+    series = []
+    for spec in specs:
+        if 'location' in spec:
+            first, last = (pd.Timestamp(t) for t in time_range)
+            first = first.tz_convert('UTC').tz_localize(None) if first.tz is not None else first
+            last = last.tz_convert('UTC').tz_localize(None) if last.tz is not None else last
+            # the store is in UTC; a day of margin covers sensor times in local time and the interpolation neighbours
+            data = WeatherStore().hourly(spec['location'], first - pd.Timedelta(days=1), last + pd.Timedelta(days=1),
+                                         spec.get('variables'))
+        else:
+            data = pd.read_csv(spec['path'], parse_dates=['time'])
+        series.append(ExogenousSeries(data, spec.get('method', 'last'), spec.get('window'), spec.get('columns'),
+                                      spec.get('prefix', '')))
+    return series
+
+
+def sensor_chunks(sensor_path):
+    """
+    Yield the sensor data in chunks of about CHUNK_ROWS rows, in time order.
+
+    Args:
+        sensor_path: CSV file, Parquet file or directory of Parquet files (partition directories in time order)
+
+    Yields:
+        Tuple (relative path of the Parquet file the chunk comes from or None for CSV, chunk DataFrame); the times
+        of a CSV chunk are left as read (see parse_csv_times)
+    """
+    if not sensor_path.endswith('.parquet') and not os.path.isdir(sensor_path):
+        for chunk in pd.read_csv(sensor_path, chunksize=CHUNK_ROWS):
+            yield None, chunk
+        return
+    if os.path.isdir(sensor_path):
+        files = sorted(os.path.relpath(os.path.join(root, name), sensor_path)
+                       for root, _, names in os.walk(sensor_path) for name in names if name.endswith('.parquet'))
+    else:
+        files = [os.path.basename(sensor_path)]
+        sensor_path = os.path.dirname(sensor_path)
+    for file_name in files:
+        for batch in pq.ParquetFile(os.path.join(sensor_path, file_name)).iter_batches(batch_size=CHUNK_ROWS):
+            yield file_name, batch.to_pandas()
+
+
+def augment_streaming(sensor_path, series, output_path):
+    """
+    Augment the sensor data with the exogenous series chunk by chunk, with constant memory.
+
+    The sensor data comes in time order, so a cursor per series is carried from chunk
+    to chunk and every chunk is aligned with a sorted merge over the samples from the
+    cursor on; the result is the same as aligning the whole sensor data at once. CSV
+    input is written to one CSV file with its times as read; Parquet input is written
+    file by file with the same layout, and the source dictionary of a bms_dataset
+    directory gets the new columns.
+
+    Args:
+        sensor_path: CSV file, Parquet file or directory of Parquet files
+        series: List of ExogenousSeries
+        output_path: Output CSV file, Parquet file or dataset directory
+
+    Returns:
+        Number of rows written
+    """
+    sources_file = os.path.join(sensor_path, 'sources.json')
+    if os.path.isdir(sensor_path) and os.path.exists(sources_file):
+        with open(sources_file, 'r', encoding='utf-8') as f:
+            dictionary = json.load(f)
+        if dictionary.get('encoding', 'plain') != 'plain':
+            raise ValueError(f"{sensor_path} is not a plain dataset; expand it with read_dataset first")
+        dictionary['columns'] += [{'column': name, 'source': f"exogenous/{name}", 'dtype': 'float64'}
+                                  for exogenous in series for name in exogenous.names]
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        os.makedirs(output_path)
+        with open(os.path.join(output_path, 'sources.json'), 'w', encoding='utf-8') as f:
+            json.dump(dictionary, f, indent=1)
+
+    last_time = None
+    cursors = [0] * len(series)
+    rows = 0
+    writer = None
+    writer_file = None
+    try:
+        for file_name, chunk in sensor_chunks(sensor_path):
+            if chunk.empty:
+                continue
+            csv_times = chunk['time'] if file_name is None else None
+            if csv_times is not None:
+                chunk = chunk.assign(time=parse_csv_times(csv_times))
+            if last_time is not None and chunk['time'].iloc[0] < last_time:
+                raise ValueError(f"The sensor data is not in time order at {chunk['time'].iloc[0]}")
+            last_time = chunk['time'].iloc[-1]
+            merged = align_exogenous(chunk, series, starts=cursors)
+            # we add the aligned exogenous values to every chunk
+            cursors = [exogenous.cursor(last_time) for exogenous in series]
+            # and move the cursor of every series to the first sample the next chunks can need
+            if file_name is None:
+                merged['time'] = csv_times.to_numpy()
+                # we write the times as they were read, in local time
+                merged.to_csv(output_path, mode='a' if rows else 'w', header=not rows, index=False)
+            else:
+                # one output file per input file, in the same partition directory
+                if file_name != writer_file:
+                    if writer is not None:
+                        writer.close()
+                    target = (os.path.join(output_path, file_name) if os.path.isdir(sensor_path)
+                              else output_path)
+                    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+                    table = pa.Table.from_pandas(merged, preserve_index=False)
+                    writer = pq.ParquetWriter(target, table.schema, compression='zstd')
+                    writer_file = file_name
+                writer.write_table(pa.Table.from_pandas(merged, preserve_index=False, schema=writer.schema))
+            rows += len(merged)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+if __name__ == '__main__':
+    series = load_series(SERIES,
+                         sensor_time_range(SENSOR_DATA) if any('location' in spec for spec in SERIES) else None)
+    # we read the exogenous datasets (e.g. the hourly weather from the weather store), using each date value as
+    # datetime
+    if MODE == 'chunked':
+        rows = augment_streaming(SENSOR_DATA, series, OUTPUT)
+        # we stream the sensor data in time order and append the aligned columns chunk by chunk
+        print(f"{rows} rows augmented")
+    else:
+        senzori = pd.read_csv(SENSOR_DATA)
+        # we read the dataset , using each date value  as datetime
+        merged = align_exogenous(senzori.assign(time=parse_csv_times(senzori['time'])), series)
+        # each row gets the exogenous values at its time, e.g. the hourly temperature interpolated to the minute
+        merged['time'] = senzori['time'].to_numpy()
+        # and keeps its time as read, in local time
+        merged.to_csv(OUTPUT, index=False)
+    print("--- %s seconds ---" % (time.time() - start_time))
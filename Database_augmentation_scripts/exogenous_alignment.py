@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy.interpolate import CubicSpline
+except ImportError:  # scipy is only needed for the 'spline' method
+    CubicSpline = None
+
+METHODS = ('last', 'linear', 'spline', 'mean')
+# 'last' is the last known value (merge_asof backward), 'linear' and 'spline' interpolate between the
+# samples, 'mean' is the mean of the samples in the window ending at each time
+
+
+class ExogenousSeries:
+    """
+    One exogenous series (e.g. the weather of a station, or a tariff) to align onto a sensor time grid.
+
+    The samples are sorted once, and align() finds the neighbouring samples of every
+    target time with one searchsorted over the sorted times (a sorted merge), then
+    computes all columns of the series at once. When the targets come in time order
+    (e.g. chunks of sensor data), cursor() gives the first sample a later chunk can
+    need, and align() only searches the samples from there on.
+
+    Args:
+        data: DataFrame with a 'time' column (or a DatetimeIndex) and one column per variable
+        method: 'last', 'linear', 'spline' (needs scipy) or 'mean'
+        window: Length of the window of the 'mean' method, e.g. '1h'
+        columns: Columns to align (default: every column except 'time')
+        prefix: Prefix of the aligned column names, e.g. 'aalborg_'
+    """
+
+    def __init__(self, data, method='last', window=None, columns=None, prefix=''):
+        if method not in METHODS:
+            raise ValueError(f"Unknown alignment method {method!r}, use one of {METHODS}")
+        if method == 'mean' and window is None:
+            raise ValueError("The 'mean' method needs a window")
+        if method == 'spline' and CubicSpline is None:
+            raise ImportError("The 'spline' method needs scipy")
+        if 'time' not in data.columns:
+            data = data.rename_axis('time').reset_index()
+        data = data.sort_values('time', kind='stable').drop_duplicates('time', keep='last')
+        # a repeated time keeps its last sample, as merge_asof does
+        columns = list(columns) if columns is not None else [c for c in data.columns if c != 'time']
+
+        self.method = method
+        self.window = pd.Timedelta(window) if window is not None else None
+        self.names = [prefix + column for column in columns]
+        self.times = pd.DatetimeIndex(data['time'])
+        values = data[columns].astype(float).set_axis(self.times)
+        if method in ('linear', 'spline'):
+            values = values.interpolate(method='time', limit_area='inside')
+            # we fill the gaps inside every column, so all columns can be interpolated at once
+        self.values = values.to_numpy(dtype=np.float64)
+        self._ns = self.times.as_unit('ns').asi8
+        # times without a time zone are taken as UTC (as meteostat returns them); asi8 counts in the unit of
+        # the index (e.g. microseconds from Parquet), so both sides are compared in nanoseconds
+
+        if method == 'mean':
+            valid = ~np.isnan(self.values)
+            self._sums = np.vstack([np.zeros(len(columns)), np.cumsum(np.where(valid, self.values, 0.0), axis=0)])
+            self._counts = np.vstack([np.zeros(len(columns)), np.cumsum(valid, axis=0)])
+        elif method == 'spline':
+            seconds = (self._ns - self._ns[0]) / 1e9 if len(self._ns) else np.array([])
+            valid = ~np.isnan(self.values)
+            if valid.all() and len(seconds) > 1:
+                self._splines = [(slice(None), CubicSpline(seconds, self.values, axis=0), seconds[0], seconds[-1])]
+            else:
+                # columns with missing samples at the edges get a spline over their own samples
+                self._splines = [(i, CubicSpline(seconds[valid[:, i]], self.values[valid[:, i], i]),
+                                  seconds[valid[:, i]][0], seconds[valid[:, i]][-1])
+                                 for i in range(len(columns)) if valid[:, i].sum() > 1]
+
+    def _target_ns(self, times):
+        times = pd.DatetimeIndex(times)
+        if times.tz is None and self.times.tz is not None:
+            raise ValueError("Sensor times without a time zone cannot be aligned with a time zone aware series")
+        return times.as_unit('ns').asi8
+
+    def cursor(self, time):
+        """Return the first sample that targets at or after time can need (the start of a later align())."""
+        t = self._target_ns([time])[0]
+        if self.method == 'mean':
+            return int(np.searchsorted(self._ns, t - self.window.value, side='right'))
+        return max(int(np.searchsorted(self._ns, t, side='right')) - 1, 0)
+
+    def align(self, times, start=0):
+        """
+        Align the series onto the target times.
+
+        Args:
+            times: Sorted or unsorted target times (Series, DatetimeIndex or array)
+            start: First sample to search (a cursor() of a time at or before every target time)
+
+        Returns:
+            2-D array with one row per target time and one column per variable (NaN where there is no value)
+        """
+        t = self._target_ns(times)
+        aligned = np.full((len(t), len(self.names)), np.nan)
+        if not len(self._ns):
+            return aligned
+        before = np.searchsorted(self._ns[start:], t, side='right') - 1 + start
+        # index of the last sample at or before every target time
+
+        if self.method == 'last':
+            found = before >= 0
+            aligned[found] = self.values[before[found]]
+        elif self.method == 'linear':
+            inside = (before >= 0) & (before + 1 < len(self._ns))
+            lo, hi = before[inside], before[inside] + 1
+            fraction = ((t[inside] - self._ns[lo]) / (self._ns[hi] - self._ns[lo]))[:, None]
+            aligned[inside] = self.values[lo] + (self.values[hi] - self.values[lo]) * fraction
+            exact = (before >= 0) & (self._ns[np.maximum(before, 0)] == t)
+            aligned[exact] = self.values[before[exact]]
+        elif self.method == 'spline':
+            seconds = (t - self._ns[0]) / 1e9
+            for columns, spline, first, last in self._splines:
+                inside = (seconds >= first) & (seconds <= last)
+                if isinstance(columns, slice):
+                    aligned[inside] = spline(seconds[inside])
+                else:
+                    aligned[inside, columns] = spline(seconds[inside])
+        else:
+            window_start = np.searchsorted(self._ns[start:], t - self.window.value, side='right') + start
+            window_end = before + 1
+            counts = self._counts[window_end] - self._counts[window_start]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                aligned = np.where(counts > 0, (self._sums[window_end] - self._sums[window_start]) / counts, np.nan)
+        return aligned
+
+
+def align_exogenous(sensor_df, series, on='time', starts=None):
+    """
+    Add the aligned columns of every exogenous series to a sensor DataFrame.
+
+    Args:
+        sensor_df: DataFrame with the target times in the column on (or in its index)
+        series: List of ExogenousSeries
+        on: Name of the time column
+        starts: First sample to search in every series (see ExogenousSeries.cursor), default all
+
+    Returns:
+        A copy of sensor_df with the aligned columns appended
+    """
+    times = sensor_df[on] if on in sensor_df.columns else sensor_df.index
+    if not series:
+        return sensor_df.copy()
+    starts = starts if starts is not None else [0] * len(series)
+    aligned = np.hstack([exogenous.align(times, start) for exogenous, start in zip(series, starts)])
+    names = [name for exogenous in series for name in exogenous.names]
+    return pd.concat([sensor_df, pd.DataFrame(aligned, index=sensor_df.index, columns=names)], axis=1)
@@ -0,0 +1,192 @@
+import datetime as dt
+import glob
+import json
+import os
+import shutil
+import pandas as pd
+
+try:
+    from meteostat import Hourly, Point
+except ImportError:  # without meteostat the store only serves what it holds and the file drop
+    Hourly = Point = None
+
+WEATHER_STORE_DIR = "./weather_store"
+# the store holds one folder per location with its hourly data (hourly.parquet) and the hours it covers per
+# variable (coverage.json)
+DROP_SUBDIR = "drop"
+# offline file drop: CSV or Parquet files with a 'time' column (UTC hours) and one column per variable, put in
+# <store>/drop/<location key>/, are loaded into the store the next time that location is read
+REFRESH_RECENT = dt.timedelta(days=3)
+# meteostat still fills in the most recent hours, so hours newer than this are fetched again on the next run
+
+
+def location_key(location):
+    """Return the folder name of a (latitude, longitude) location, e.g. '57.01477_9.97412'."""
+    return f"{location[0]:.5f}_{location[1]:.5f}"
+
+
+def _subtract_ranges(start, end, ranges):
+    """Return the parts of [start, end) not covered by the sorted, non-overlapping ranges."""
+    missing = []
+    for range_start, range_end in ranges:
+        if range_end <= start or range_start >= end:
+            continue
+        if range_start > start:
+            missing.append((start, range_start))
+        start = max(start, range_end)
+    if start < end:
+        missing.append((start, end))
+    return missing
+
+
+def _add_range(ranges, start, end):
+    """Return the sorted ranges with [start, end) added, merging ranges that touch or overlap."""
+    merged = []
+    for range_start, range_end in sorted(ranges + [(start, end)]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+        else:
+            merged.append((range_start, range_end))
+    return merged
+
+
+class WeatherStore:
+    """
+    Local store of hourly weather data keyed by (location, variable, hour).
+
+    The store records which hours it holds for every variable of a location, so
+    hourly() only fetches the missing spans from meteostat, or takes them from the
+    offline file drop; reading a period that is already held costs no fetch at all.
+
+    Args:
+        store_dir: Folder of the store
+    """
+
+    def __init__(self, store_dir=WEATHER_STORE_DIR):
+        self.store_dir = store_dir
+
+    def _location_dir(self, location):
+        return os.path.join(self.store_dir, location_key(location))
+
+    def coverage(self, location):
+        """Return the covered hours of a location as {variable: [(start, end), ...]} (end exclusive, UTC)."""
+        coverage_file = os.path.join(self._location_dir(location), 'coverage.json')
+        if not os.path.exists(coverage_file):
+            return {}
+        with open(coverage_file, 'r', encoding='utf-8') as f:
+            coverage = json.load(f)
+        return {variable: [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+                for variable, ranges in coverage.items()}
+
+    def _write_coverage(self, location, coverage):
+        coverage_file = os.path.join(self._location_dir(location), 'coverage.json')
+        with open(coverage_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({variable: [[start.isoformat(), end.isoformat()] for start, end in ranges]
+                       for variable, ranges in coverage.items()}, f, indent=1)
+        os.replace(coverage_file + '.tmp', coverage_file)
+
+    def _read_data(self, location):
+        data_file = os.path.join(self._location_dir(location), 'hourly.parquet')
+        if not os.path.exists(data_file):
+            return pd.DataFrame(index=pd.DatetimeIndex([], name='time'))
+        return pd.read_parquet(data_file)
+
+    def store(self, location, data, start=None, end=None, variables=None):
+        """
+        Add hourly data of a location to the store and mark its hours as covered.
+
+        Args:
+            location: (latitude, longitude) tuple
+            data: DataFrame indexed by hour (UTC, no time zone) with one column per variable (may be empty
+                when the source has no data for the span, which is then covered without values)
+            start: First hour the data covers (default: its first row)
+            end: Hour after the last one the data covers (default: one hour after its last row)
+            variables: Variables to mark as covered besides the columns of the data
+        """
+        if data.empty and (start is None or end is None):
+            return
+        os.makedirs(self._location_dir(location), exist_ok=True)
+        if data.empty:
+            data = pd.DataFrame(columns=data.columns, index=pd.DatetimeIndex([], name='time'), dtype=float)
+        data = data[~data.index.duplicated(keep='last')].sort_index()
+        start = pd.Timestamp(start) if start is not None else data.index[0]
+        end = pd.Timestamp(end) if end is not None else data.index[-1] + pd.Timedelta(hours=1)
+        stored = self._read_data(location)
+        combined = data.combine_first(stored) if not stored.empty else data
+        # new values replace the stored ones for the same hour (meteostat revises recent hours)
+        combined.index.name = 'time'
+        data_file = os.path.join(self._location_dir(location), 'hourly.parquet')
+        combined.sort_index().to_parquet(data_file + '.tmp')
+        os.replace(data_file + '.tmp', data_file)
+
+        coverage = self.coverage(location)
+        covered_until = min(end, pd.Timestamp.now(tz='UTC').tz_localize(None) - REFRESH_RECENT)
+        if start < covered_until:
+            for variable in dict.fromkeys(list(data.columns) + list(variables or [])):
+                coverage[variable] = _add_range(coverage.get(variable, []), start, covered_until)
+            self._write_coverage(location, coverage)
+
+    def load_drop(self, location):
+        """Load the files of the offline file drop of a location into the store (they are moved to 'loaded')."""
+        drop_dir = os.path.join(self.store_dir, DROP_SUBDIR, location_key(location))
+        files = sorted(glob.glob(os.path.join(drop_dir, '*.csv')) + glob.glob(os.path.join(drop_dir, '*.parquet')))
+        for file_path in files:
+            if file_path.endswith('.csv'):
+                data = pd.read_csv(file_path, parse_dates=['time'])
+            else:
+                data = pd.read_parquet(file_path)
+                data = data.reset_index() if 'time' not in data.columns else data
+            data = data.set_index('time')
+            if data.index.tz is not None:
+                data.index = data.index.tz_convert('UTC').tz_localize(None)
+            print(f"Loading {file_path} into the weather store")
+            self.store(location, data.astype(float))
+            os.makedirs(os.path.join(drop_dir, 'loaded'), exist_ok=True)
+            shutil.move(file_path, os.path.join(drop_dir, 'loaded', os.path.basename(file_path)))
+
+    def hourly(self, location, start, end, variables=None, fetch=True):
+        """
+        Read the hourly weather of a location, fetching only the hours the store does not hold yet.
+
+        Args:
+            location: (latitude, longitude) tuple
+            start: First hour to read (UTC)
+            end: Hour after the last one to read (UTC)
+            variables: meteostat variables to read, e.g. ['temp', 'rhum'] (default: every stored variable)
+            fetch: Fetch missing spans from meteostat (False to work offline from the store and the file drop)
+
+        Returns:
+            DataFrame indexed by 'time' (UTC hours) with one column per variable (NaN where there is no data)
+        """
+        start = pd.Timestamp(start).floor('h')
+        end = pd.Timestamp(end).ceil('h')
+        self.load_drop(location)
+        coverage = self.coverage(location)
+        wanted = variables if variables is not None else list(coverage) or None
+
+        # the spans missing for any wanted variable (a fetch returns every variable at once)
+        missing = []
+        for variable in (wanted or [None]):
+            for span_start, span_end in _subtract_ranges(start, end, coverage.get(variable, [])):
+                missing = _add_range(missing, span_start, span_end)
+        if missing and fetch and Hourly is not None:
+            for span_start, span_end in missing:
+                print(f"Fetching weather for {location_key(location)} from {span_start} to {span_end}")
+                try:
+                    data = Hourly(Point(*location), span_start.to_pydatetime(),
+                                  (span_end - pd.Timedelta(hours=1)).to_pydatetime()).fetch()
+                    # meteostat includes the end hour
+                except Exception as e:
+                    print(f"Could not fetch the weather ({e!r}); using the stored data")
+                    break
+                self.store(location, data.astype(float), span_start, span_end, wanted)
+                # a span without data (a station gap) is covered too, so it is not fetched again
+        elif missing:
+            print(f"The weather store has no data for {len(missing)} span(s) of {location_key(location)}; "
+                  f"put files in {os.path.join(self.store_dir, DROP_SUBDIR, location_key(location))} to fill them")
+
+        data = self._read_data(location)
+        data = data[(data.index >= start) & (data.index < end)]
+        if wanted is not None:
+            data = data.reindex(columns=wanted)
+        return data
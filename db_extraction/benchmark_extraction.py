@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Benchmark of the extraction scripts against the local mock BMS API
+Every script is run unchanged in its own scratch directory (with a copy of the
+log maps), pointed at mock_bms_server.py through BMS_API_URL. Wall time,
+requests/s, rows/s and peak RSS are printed and appended as JSON lines to
+BENCHMARK_RESULTS_FILE, so results of different versions can be compared
+"""
+
+import datetime as dt
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_bms_server import start_mock_server
+
+# Directory of this file (the extraction scripts and log maps live next to it)
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Function to run a script as a child process and measure its wall time and peak RSS
+def run_script(script_path, work_dir, env, log_path):
+    """
+    Run a script as a child process and measure its wall time and peak RSS.
+
+    Args:
+        script_path: Path to the script
+        work_dir: Working directory of the child process
+        env: Environment of the child process
+        log_path: File receiving the output of the child process
+
+    Returns:
+        Tuple (exit code, wall time in seconds, peak RSS in MB or None if it cannot be measured)
+    """
+    start = time.perf_counter()
+    with open(log_path, 'w', encoding='utf-8') as log_file:
+        process = subprocess.Popen([sys.executable, script_path], cwd=work_dir, env=env,
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            # wait4 returns the resource usage of this child (and the children it waited for)
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kB on Linux and in bytes on macOS
+            peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        else:
+            process.wait()
+            peak_rss_mb = None
+    return process.returncode, time.perf_counter() - start, peak_rss_mb
+
+# Function to benchmark one extraction script against the mock server
+def benchmark_script(script_name, server, log_dir):
+    """
+    Benchmark one extraction script against the mock server.
+
+    Args:
+        script_name: File name of the script in this directory
+        server: Running MockBMSServer
+        log_dir: Directory receiving the output of the script
+
+    Returns:
+        Dict with the benchmark results
+    """
+    print(f"Benchmarking {script_name}...")
+    work_dir = tempfile.mkdtemp(prefix="bms_benchmark_")
+    try:
+        shutil.copytree(os.path.join(SCRIPT_DIR, 'log_maps'), os.path.join(work_dir, 'log_maps'))
+        os.makedirs(os.path.join(work_dir, 'SAVED_LOGS'))
+        env = dict(os.environ, BMS_API_URL=server.url(), BD_API_USER='benchmark',
+                   BD_API_PASSWORD='benchmark', BD_APU_PASSWORD='benchmark',
+                   PYTHONPATH=os.pathsep.join(filter(None, [SCRIPT_DIR, os.environ.get('PYTHONPATH')])))
+        server.reset_stats()
+        log_path = os.path.join(log_dir, f"{os.path.splitext(script_name)[0]}_benchmark.log")
+        exit_code, wall_time, peak_rss_mb = run_script(os.path.join(SCRIPT_DIR, script_name), work_dir, env,
+                                                       log_path)
+        stats = dict(server.stats)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {
+        'script': script_name,
+        'exit_code': exit_code,
+        'wall_time_s': round(wall_time, 3),
+        'requests': stats['requests'],
+        'requests_per_s': round(stats['requests'] / wall_time, 2) if wall_time else None,
+        'rows': stats['rows'],
+        'rows_per_s': round(stats['rows'] / wall_time, 1) if wall_time else None,
+        'bytes': stats['bytes'],
+        'errors_served': stats['errors'],
+        'peak_rss_mb': round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+        'log': log_path,
+    }
+    if exit_code != 0:
+        print(f"{script_name} exited with code {exit_code}, see {log_path}")
+    return result
+
+# Function to print the benchmark results as a table
+def print_results(results):
+    """Print the benchmark results as a table."""
+    print(f"\n{'script':<55} {'wall s':>8} {'req/s':>8} {'rows/s':>11} {'peak MB':>8}")
+    for result in results:
+        peak_rss = f"{result['peak_rss_mb']:.1f}" if result['peak_rss_mb'] is not None else 'n/a'
+        print(f"{result['script']:<55} {result['wall_time_s']:>8.2f} {result['requests_per_s'] or 0:>8.2f} "
+              f"{result['rows_per_s'] or 0:>11.1f} {peak_rss:>8}")
+
+# Main process
+if __name__ == '__main__':
+    # Extraction scripts to benchmark (each one runs with its own settings, e.g. its time range)
+    SCRIPTS = [
+        'multiprocessing_bms_data_extraction.py',
+        'memory_efficient_bms_extraction.py',
+        'bms-api_build_aau_dk_v1_long_term_data_extraction.py',
+    ]
+
+    # Mock server settings (see mock_bms_server.py)
+    MOCK_CONFIG = {
+        'logmap_path': os.path.join(SCRIPT_DIR, 'log_maps', 'Log_map_TMV23_2025_02_28_MIN.xlsx'),
+        'extra_ids': 0,
+        'latency': 0.05,
+        'latency_per_row': 0.0,
+        'sample_seconds': 60,
+        'error_rate': 0.0,
+        'max_rows': None,
+    }
+
+    # File the results are appended to (one JSON line per script and run) and directory for the script output
+    BENCHMARK_RESULTS_FILE = "./SAVED_LOGS/benchmark_results.jsonl"
+    log_dir = "./SAVED_LOGS/benchmark_logs"
+    os.makedirs(log_dir, exist_ok=True)
+
+    server = start_mock_server(port=0, **MOCK_CONFIG)
+    run_info = {
+        'run_at': dt.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mock_config': {key: value for key, value in MOCK_CONFIG.items() if key != 'logmap_path'},
+        'sources': len(server.sources),
+    }
+
+    results = []
+    try:
+        for script_name in SCRIPTS:
+            results.append(benchmark_script(script_name, server, log_dir))
+    finally:
+        server.shutdown()
+
+    print_results(results)
+    with open(BENCHMARK_RESULTS_FILE, 'a', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps({**run_info, **result}) + '\n')
+    print(f"Results appended to {BENCHMARK_RESULTS_FILE}")
@@ -14,8 +14,14 @@ import csv
 import os
 import glob
 import time
+import io
 from dotenv import load_dotenv
 
+from bms_logmap import load_logmap
+from bms_metadata import load_metadata_index
+from bms_metrics import metrics
+from bms_processing import build_source_lookup, label_trend_data, long_to_wide
+
 load_dotenv()  # take environment variables from .env.
 
 # Start timing the script
@@ -23,9 +29,10 @@ script_start_time = time.time()
 
 pd.set_option('display.max_colwidth', None)
 ###############################
-# API endpoints for the DB server
-TRENDDATA_NAME = "https://bms-api.build.aau.dk/api/v1/trenddata"
-METADATA_NAME = "https://bms-api.build.aau.dk/api/v1/metadata"
+# API endpoints for the DB server (set BMS_API_URL to use another server, e.g. mock_bms_server.py)
+BMS_API_URL = os.getenv('BMS_API_URL', "https://bms-api.build.aau.dk/api/v1").rstrip('/')
+TRENDDATA_NAME = BMS_API_URL + "/trenddata"
+METADATA_NAME = BMS_API_URL + "/metadata"
 
 # Set the username for the DB server (if you do not have one ask Simon)
 username = os.getenv('BD_API_USER')
@@ -33,7 +40,7 @@ username = os.getenv('BD_API_USER')
 password = os.getenv('BD_APU_PASSWORD')
 
 print(f"Username: {username}")
-print(f"Password: {password}")
+print(f"Password: {'set' if password else 'not set'}")
 
 # Set the path where the different file(s) to run are located
 # files_to_run = glob.glob("log_maps/Log_map_TMV23_2025_02_28_MIN.xlsx") #TODO
@@ -55,6 +62,8 @@ for i in files_to_run:
     filenames.append(i.split("\\")[-1].split(".")[0].split("Log_map_")[-1])
 
 print("Files to run: ", files_to_run)
+with metrics.stage('metadata'):
+    metadata_index = load_metadata_index(METADATA_NAME, (username, password))                                  # load the source -> externallogid index once for all log maps and timesteps (cached on disk between runs)
 for j in range(len(files_to_run)):
     # Set the name of the data file as a string, e.g. 'test'
     save_file_name = filenames[j]
@@ -75,96 +84,54 @@ for j in range(len(files_to_run)):
     final_endtime = dt.datetime(end_year, end_month, end_day, end_hour) 
     
     
+    ###############################
+    # if identifier is 3, the source_df is pulled from the excel sheet logmap (for many inputs)
+    # Fill in the path to the logmap as a string, e.g. 'C:/Users/GQ05XY/Aalborg Universitet/SATO - General/TMV23/Data_from_BMS/Log_map_TMV23.xlsx'
+    source_logmap = files_to_run[j]
+    # Fill in the name of the sheet containing the logmap as a string, e.g. 'log_map'
+    logmap_sheet = 'log_map' #TODO
+    # Fill in the columns that should be imported from the logmap file as a string, e.g. 'A:D'
+    logmap_columns = 'A:D' #TODO
+    # Fill in the name of the column containing the location of the log variable as a string, e.g. 'Log_variable_location'
+    logmap_var_loc = 'Log_variable_location' #TODO
+    # Fill in the name of the column containing the name of the log variable as a string, e.g. 'Logged_variable_name'
+    logmap_var_name = 'Logged_variable_name' #TODO
+
+    
+    #########################################################################################################################################################################
+    ##                                                                  Script below                                                                                       ##
+    ##                                                                  Do not touch!                                                                                      ##
+    #########################################################################################################################################################################
+    # create the list of externallogid
+    
+    
+        
+    
+    with metrics.stage('metadata'):
+        source_df, externallogid = load_logmap(source_logmap, metadata_index, logmap_sheet, logmap_columns, logmap_var_loc, logmap_var_name)  # load the compiled logmap (cached by spreadsheet contents) with the externallogid of every variable, failed variables are printed
+    print("Meta data done")
+    source_lookup = build_source_lookup(source_df, logmap_var_loc, logmap_var_name)                             # build the externallogid -> source lookup used to label the trend data
+    
+    
     temp_trend_data_df = pd.DataFrame()
     while starttime < final_endtime:
         print('Now running file '+filenames[j]+' at timestep '+str(starttime))
-        ###############################
-        # if identifier is 3, the source_df is pulled from the excel sheet logmap (for many inputs)
-        # Fill in the path to the logmap as a string, e.g. 'C:/Users/GQ05XY/Aalborg Universitet/SATO - General/TMV23/Data_from_BMS/Log_map_TMV23.xlsx'
-        source_logmap = files_to_run[j]
-        # Fill in the name of the sheet containing the logmap as a string, e.g. 'log_map'
-        logmap_sheet = 'log_map' #TODO
-        # Fill in the columns that should be imported from the logmap file as a string, e.g. 'A:D'
-        logmap_columns = 'A:D' #TODO
-        # Fill in the name of the column containing the location of the log variable as a string, e.g. 'Log_variable_location'
-        logmap_var_loc = 'Log_variable_location' #TODO
-        # Fill in the name of the column containing the name of the log variable as a string, e.g. 'Logged_variable_name'
-        logmap_var_name = 'Logged_variable_name' #TODO
-
-        
-        #########################################################################################################################################################################
-        ##                                                                  Script below                                                                                       ##
-        ##                                                                  Do not touch!                                                                                      ##
-        #########################################################################################################################################################################
-        # create the list of externallogid
-        
-        
-            
-        
-        source_df = pd.read_excel(io=source_logmap,sheet_name=logmap_sheet,header=0,usecols=logmap_columns)     # create the source from the logmap, with the specified naming and location
-        source = []
-        for i in range(0,len(source_df)):
-            temp = '/'.join([str(source_df[logmap_var_loc][i]),str(source_df[logmap_var_name][i])])             # create a full path with variable name for each variable
-            source.append(temp)                                                                                 # append the full path of each variable to this list, to get a full list of variable paths
-        trend_meta = requests.get(url=METADATA_NAME, auth=(username, password))                                                            # extract the trend_meta data as a dataframe
-        trend_meta_text = trend_meta.text
-        print("Trend meta: ", trend_meta)
-        print("Trend meta text: ", trend_meta_text[:500])  # Print first 500 characters to check format
-        print("Trend meta status code: ", trend_meta.status_code)
-        trend_meta_df = pd.read_json(trend_meta_text, orient = 'records')
-        print("trend_meta_df columns: ", trend_meta_df.columns)
-        externallogid=[]
-        temp_externallogid=[]
-        for i in range(0,len(source_df)):
-            externallogid.append(trend_meta_df.externallogid[source[i] == trend_meta_df.source].tolist())       # create a list of all valid externallogid
-            temp_externallogid.append(trend_meta_df.externallogid[source[i] == trend_meta_df.source].tolist())  # create a list of all externallogid
-            if externallogid[-1] == []:
-                print(' '.join(['source_df index',str(source_df.index[i]),'failed']))                           # Print the index corresponding to source_df for each variable, which did not have a valid externallogid
-                externallogid.pop()                                                                             # remove the invalid externallogid from the list of all valid externallogid
-        source_df_insert_point = len(source_df.columns)
-        source_df.insert(source_df_insert_point,'externallogid',temp_externallogid)                                                  # append the list of all externallogid to the source_df for an easy overview of which externallogid are missing
-        print("Meta data done")
-        del temp
-        del temp_externallogid
-        del source
-        del i
-        
-        
-        
         # extract the trend_data
         PARAMS = {'starttime':starttime, 'endtime':endtime, 'externallogid':externallogid}
+        request_start = time.perf_counter()
         try:
-            trend_data = requests.get(TRENDDATA_NAME, params=PARAMS, auth=(username, password))                                                    # extract the trend_data for each externallogid in the timespan between starttime and endtime
-            trend_data_text = trend_data.text
-            trend_data_df = pd.read_json(trend_data_text,orient = 'records') 
+            with metrics.stage('fetch'):
+                trend_data = requests.get(TRENDDATA_NAME, params=PARAMS, auth=(username, password))                                                    # extract the trend_data for each externallogid in the timespan between starttime and endtime
+                trend_data_text = trend_data.text
+            with metrics.stage('parse'):
+                trend_data_df = pd.read_json(io.StringIO(trend_data_text),orient = 'records') 
+            metrics.record_request(starttime, endtime, time.perf_counter() - request_start, len(trend_data.content), len(trend_data_df))   # record latency, bytes and rows of the request
             
             print("Data extracted")
             
             
-            temp_externallogid_1 = source_df['externallogid'].explode()
-            temp_externallogid_1 = temp_externallogid_1[~temp_externallogid_1.index.duplicated(keep='first')]
-            source_df['externallogid'] = temp_externallogid_1
-            
-            dfs = []
-            for id_, id_df in trend_data_df.groupby('externallogid'):
-                temp_source = (source_df[source_df['externallogid']==id_]['Log_variable_location']).tolist()
-                temp_name   = (source_df[source_df['externallogid']==id_]['Logged_variable_name']).tolist()
-                
-                temp_source_name = '/'.join(temp_source + temp_name)
-                
-                temp_s = pd.Series([temp_source_name] * len(id_df))
-                temp_df = pd.concat([id_df.reset_index(drop=True),
-                                     temp_s.reset_index(drop=True)],
-                                    ignore_index=True, axis=1)
-                
-                dfs.append(temp_df)
-            
-            
-            trend_data_df = pd.concat(dfs, axis=0, ignore_index=True)
-            col_names = ['externallogid', 'timestamp', 'timestamp_tzinfo', 'value', 'source']
-            trend_data_df.columns = col_names
-            source_column = trend_data_df.pop('source')
-            trend_data_df.insert(1,'source',source_column)
+            with metrics.stage('label'):
+                trend_data_df = label_trend_data(trend_data_df, source_lookup)                                    # label every row with its source in one vectorized merge
             print("Source added")
             
             if len(temp_trend_data_df) == 0:
@@ -175,7 +142,7 @@ for j in range(len(files_to_run)):
             print("temp_trend_data_df finished")
         except Exception as e:
             print("An error occurred: ", e)
-            pass
+            metrics.record_request(starttime, endtime, time.perf_counter() - request_start, error=e)
         
 
     
@@ -185,36 +152,25 @@ for j in range(len(files_to_run)):
     
     print("All data extracted")
     # Convert the temp_trend_data_df file into a useful df
-    unique_source = temp_trend_data_df['source'].unique()
-    
-    final_trend_data_df = pd.DataFrame()
-    for source_id in unique_source:
-        temp_final_trend_data_df = pd.DataFrame()
-        temp_final_trend_data_df[source_id] = temp_trend_data_df['value'][temp_trend_data_df['source']==source_id]
-        temp_final_trend_data_df['time'] = temp_trend_data_df['timestamp'][temp_trend_data_df['source']==source_id]
-        temp_final_trend_data_df['time'] = temp_final_trend_data_df['time'].apply(lambda ts: ts.replace(second=0))
-        temp_final_trend_data_df.set_index('time',inplace=True)
-        if len(final_trend_data_df) == 0:
-            final_trend_data_df = temp_final_trend_data_df
-        else:
-            final_trend_data_df = final_trend_data_df.join(temp_final_trend_data_df,how='outer')
-        
-        final_trend_data_df.dropna(how=na_drop_setting,inplace=True)
-        final_trend_data_df = final_trend_data_df[~final_trend_data_df.index.duplicated(keep='first')]
-        print(source_id)
-        print(final_trend_data_df.size)
-        print(len(final_trend_data_df))
-    final_trend_data_df.sort_index(inplace=True)
+    
+    with metrics.stage('merge'):
+        final_trend_data_df = long_to_wide(temp_trend_data_df, na_drop_setting)
     
 
 
     # save the file with the desired name, location and filetype
     save_file = ''.join([save_location,'/',save_file_name,'_',str(start_year),'_',str(start_month),'__',str(end_year),'_',str(end_month),'.csv'])
     
-    final_trend_data_df.to_csv(save_file)
+    with metrics.stage('write'):
+        final_trend_data_df.to_csv(save_file)
     
     # Calculate and print timing statistics
     script_end_time = time.time()
     elapsed_seconds = script_end_time - script_start_time
     elapsed_minutes = elapsed_seconds / 60
     print(f"\nScript execution time: {elapsed_seconds:.2f} seconds ({elapsed_minutes:.2f} minutes)")
+    
+    # report where the time went and save the per-request metrics of this file
+    metrics.print_summary()
+    metrics.save(''.join([save_location,'/',save_file_name,'_metrics.jsonl']))
+    metrics.reset()
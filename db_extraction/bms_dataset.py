@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Typed, time-partitioned Parquet datasets for extracted BMS data
+The wide time x source table is written as one directory per dataset with one
+sub-directory per day or month. Value columns are stored as float32 where that is
+lossless, under short column names with a separate source dictionary, and every
+row group carries min/max statistics, so readers only load the columns and the
+time range they ask for. With the 'change_points' encoding only the minutes where
+a source changes are stored (run-length encoding), and read_dataset expands the
+requested sources and time range back to the minute grid
+"""
+
+import datetime as dt
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from bms_processing import compact_float_dtype
+
+# Number of rows per Parquet row group (one day of minute data per group)
+ROW_GROUP_SIZE = 1440
+# Name of the source dictionary file inside a dataset directory
+SOURCES_FILE = "sources.json"
+# strftime format of the partition directory names for each partitioning
+PARTITION_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m'}
+# Number of change points per row group of a change point file
+CHANGE_POINT_ROW_GROUP_SIZE = 65536
+# Pseudo column of a change point file marking the minutes that hold a row (1) or not (NA)
+ROW_MARKER = '__row__'
+
+
+# Function to read the source dictionary of a dataset
+def read_source_dictionary(dataset_dir):
+    """
+    Read the source dictionary of a dataset.
+
+    Args:
+        dataset_dir: Path to the dataset directory
+
+    Returns:
+        Dict with the keys 'partition', 'encoding' ('plain' or 'change_points') and 'columns' (list of
+        {'column', 'source', 'dtype'} entries in the original column order), or None if the
+        directory holds no dataset
+    """
+    sources_file = os.path.join(dataset_dir, SOURCES_FILE)
+    if not os.path.exists(sources_file):
+        return None
+    with open(sources_file, 'r', encoding='utf-8') as f:
+        dictionary = json.load(f)
+    # Datasets written before the change point encoding existed are plain
+    dictionary.setdefault('encoding', 'plain')
+    return dictionary
+
+# Function to write the source dictionary of a dataset
+def _write_source_dictionary(dataset_dir, dictionary):
+    temp_file = os.path.join(dataset_dir, SOURCES_FILE + '.tmp')
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(dictionary, f, indent=1)
+    os.replace(temp_file, os.path.join(dataset_dir, SOURCES_FILE))
+
+# Function to write a wide time x source table as a partitioned Parquet dataset
+def write_dataset(trend_data_df, dataset_dir, partition='month', mode='overwrite', row_group_size=ROW_GROUP_SIZE,
+                  encoding='plain'):
+    """
+    Write a wide time x source table as a time-partitioned Parquet dataset.
+
+    Args:
+        trend_data_df: Wide DataFrame indexed by time with one column per source
+        dataset_dir: Path to the dataset directory
+        partition: 'day' or 'month'
+        mode: 'overwrite' replaces an existing dataset, 'append' adds the rows as new files
+            (the rows must be later than the ones already stored; new sources are added
+            to the dictionary, and float32 sources whose new values need float64 are widened)
+        row_group_size: Number of rows per Parquet row group
+        encoding: 'plain' stores every row, 'change_points' stores only the minutes where a source
+            changes (best for counters and near-constant values); an appended dataset keeps its encoding
+    """
+    dictionary = read_source_dictionary(dataset_dir) if mode == 'append' else None
+    if mode == 'overwrite' and os.path.isdir(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    os.makedirs(dataset_dir, exist_ok=True)
+    if dictionary is None:
+        dictionary = {'partition': partition, 'encoding': encoding, 'columns': []}
+    partition = dictionary['partition']
+    encoding = dictionary['encoding']
+
+    # Map every source to its short column name, adding new sources to the dictionary
+    column_names = {entry['source']: entry['column'] for entry in dictionary['columns']}
+    dtypes = {entry['source']: entry['dtype'] for entry in dictionary['columns']}
+    for source in trend_data_df.columns:
+        if source not in column_names:
+            column_names[source] = f"s{len(dictionary['columns'])}"
+            dtypes[source] = compact_float_dtype(trend_data_df[source])
+            dictionary['columns'].append({'column': column_names[source], 'source': source,
+                                          'dtype': dtypes[source]})
+        elif dtypes[source] == 'float32' and compact_float_dtype(trend_data_df[source]) == 'float64':
+            # Widen the source from here on; the readers combine its float32 and float64 files
+            dtypes[source] = 'float64'
+            for entry in dictionary['columns']:
+                if entry['source'] == source:
+                    entry['dtype'] = 'float64'
+
+    table_df = pd.DataFrame({'time': trend_data_df.index})
+    for source in trend_data_df.columns:
+        table_df[column_names[source]] = trend_data_df[source].to_numpy(dtype=dtypes[source])
+    table_df = table_df.sort_values('time', kind='stable', ignore_index=True)
+
+    partition_keys = table_df['time'].dt.strftime(PARTITION_FORMATS[partition])
+    file_name = f"part-{dt.datetime.now():%Y%m%d%H%M%S%f}.parquet" if mode == 'append' else "part-0.parquet"
+    for partition_key, partition_df in table_df.groupby(partition_keys, sort=True):
+        partition_dir = os.path.join(dataset_dir, f"{partition}={partition_key}")
+        os.makedirs(partition_dir, exist_ok=True)
+        if encoding == 'change_points':
+            _write_change_points(partition_df, os.path.join(partition_dir, file_name))
+            continue
+        table = pa.Table.from_pandas(partition_df, preserve_index=False)
+        pq.write_table(table, os.path.join(partition_dir, file_name), row_group_size=row_group_size,
+                       compression='zstd', write_statistics=True)
+
+    _write_source_dictionary(dataset_dir, dictionary)
+    print(f"Dataset written to {dataset_dir} ({len(table_df)} rows, {len(trend_data_df.columns)} sources)")
+
+# Function to write the rows of one partition as change points
+def _write_change_points(table_df, path):
+    # A file covers the minute grid from its first to its last row and starts with the value of
+    # every source, so it can be expanded on its own. The row marker records which minutes hold a row
+    times = pd.DatetimeIndex(table_df['time'])
+    grid = pd.date_range(times[0], times[-1], freq='min')
+    columns = [column for column in table_df.columns if column != 'time']
+    values = table_df.set_index('time')[columns].reindex(grid)
+    values[ROW_MARKER] = np.where(grid.isin(times), 1.0, np.nan)
+
+    array = values.to_numpy(dtype=np.float64)
+    missing = np.isnan(array)
+    changed = np.ones(array.shape, dtype=bool)
+    changed[1:] = ~((array[1:] == array[:-1]) | (missing[1:] & missing[:-1]))
+    # Order the change points by column and then by time, so a row group covers few columns
+    column_index, row_index = np.nonzero(changed.T)
+    change_df = pd.DataFrame({
+        'column': np.asarray(values.columns, dtype=object)[column_index],
+        'time': grid[row_index],
+        'value': array[row_index, column_index],
+    })
+    table = pa.Table.from_pandas(change_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b'first_time': times[0].isoformat().encode('utf-8'),
+                                           b'last_time': times[-1].isoformat().encode('utf-8')})
+    pq.write_table(table, path, row_group_size=CHANGE_POINT_ROW_GROUP_SIZE, compression='zstd',
+                   write_statistics=True)
+
+# Function to read the minute range covered by a change point file
+def _change_point_range(file_path):
+    metadata = pq.read_schema(file_path).metadata
+    return pd.Timestamp(metadata[b'first_time'].decode('utf-8')), pd.Timestamp(metadata[b'last_time'].decode('utf-8'))
+
+# Function to turn a time into a Timestamp comparable with times in the time zone tz
+def _in_tz(timestamp, tz):
+    timestamp = pd.Timestamp(timestamp)
+    if tz is None:
+        return _wall_time(timestamp)
+    return timestamp.tz_localize(tz) if timestamp.tz is None else timestamp.tz_convert(tz)
+
+# Function to expand change point files to the minute grid
+def _read_change_points(files, columns, start=None, end=None):
+    blocks = []
+    for file_path in files:
+        first_time, last_time = _change_point_range(file_path)
+        change_df = pq.read_table(file_path, columns=['column', 'time', 'value'],
+                                  filters=[('column', 'in', columns + [ROW_MARKER])]).to_pandas()
+        tz = change_df['time'].dt.tz
+        if tz is not None:
+            # Build the grid in UTC, the first and last time may have different UTC offsets (DST)
+            grid = pd.date_range(first_time.tz_convert('UTC'), last_time.tz_convert('UTC'), freq='min').tz_convert(tz)
+        else:
+            grid = pd.date_range(first_time, last_time, freq='min')
+        if start is not None:
+            grid = grid[grid >= _in_tz(start, tz)]
+        if end is not None:
+            grid = grid[grid < _in_tz(end, tz)]
+        if not len(grid):
+            continue
+
+        # Every value holds until the next change point of its source
+        block = {}
+        for column, column_df in change_df.groupby('column', sort=False):
+            series = pd.Series(column_df['value'].to_numpy(), index=pd.DatetimeIndex(column_df['time']))
+            block[column] = series.reindex(grid, method='ffill').to_numpy()
+        block_df = pd.DataFrame(block, index=grid)
+        blocks.append(block_df[block_df[ROW_MARKER] == 1].drop(columns=ROW_MARKER))
+    if not blocks:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='time'))
+    trend_data_df = pd.concat(blocks)
+    trend_data_df.index.name = 'time'
+    return trend_data_df
+
+# Function to turn a time into a naive Timestamp in wall-clock time (as used by the partition names)
+def _wall_time(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize(None) if timestamp.tz is not None else timestamp
+
+# Function to list the partition files of a dataset overlapping a time range
+def _partition_files(dataset_dir, partition, start=None, end=None):
+    files = []
+    for partition_dir in sorted(glob.glob(os.path.join(dataset_dir, f"{partition}=*"))):
+        partition_start = pd.Timestamp(dt.datetime.strptime(os.path.basename(partition_dir).split('=', 1)[1],
+                                                            PARTITION_FORMATS[partition]))
+        partition_end = (partition_start + pd.DateOffset(days=1) if partition == 'day'
+                         else partition_start + pd.DateOffset(months=1))
+        if start is not None and partition_end <= _wall_time(start):
+            continue
+        if end is not None and partition_start >= _wall_time(end):
+            continue
+        files.extend(sorted(glob.glob(os.path.join(partition_dir, '*.parquet'))))
+    return files
+
+# Function to read (part of) a partitioned Parquet dataset
+def read_dataset(dataset_dir, sources=None, start=None, end=None):
+    """
+    Read (part of) a partitioned Parquet dataset.
+
+    Only the partitions overlapping [start, end) are opened, only the requested
+    columns are read, and the row group statistics skip row groups outside the range.
+
+    Args:
+        dataset_dir: Path to the dataset directory
+        sources: List of source paths (or short column names) to load, None for all
+        start: Optional first time to load (inclusive)
+        end: Optional last time to load (exclusive)
+
+    Returns:
+        Wide DataFrame indexed by 'time' with one column per source (full source paths as names)
+    """
+    dictionary = read_source_dictionary(dataset_dir)
+    if dictionary is None:
+        raise FileNotFoundError(f"No dataset found in {dataset_dir}")
+
+    entries = dictionary['columns']
+    if sources is not None:
+        wanted = set(sources)
+        entries = [entry for entry in entries if entry['source'] in wanted or entry['column'] in wanted]
+
+    files = _partition_files(dataset_dir, dictionary['partition'], start, end)
+    if not files:
+        return pd.DataFrame(columns=[entry['source'] for entry in entries],
+                            index=pd.DatetimeIndex([], name='time'))
+
+    if dictionary['encoding'] == 'change_points':
+        trend_data_df = _read_change_points(files, [entry['column'] for entry in entries], start, end)
+        trend_data_df = trend_data_df.reindex(columns=[entry['column'] for entry in entries])
+        trend_data_df = trend_data_df.astype({entry['column']: entry['dtype'] for entry in entries})
+        trend_data_df.columns = [entry['source'] for entry in entries]
+        return trend_data_df.sort_index()
+
+    # Sources added by a later append are missing from the older files; read every file with the
+    # combined schema, so they come back as nulls only for the rows written before they were added
+    schema = pa.unify_schemas([pq.read_schema(file_path) for file_path in files], promote_options='permissive')
+    dataset = ds.dataset(files, schema=schema, format='parquet')
+    schema_names = set(schema.names)
+    columns = ['time'] + [entry['column'] for entry in entries if entry['column'] in schema_names]
+
+    time_type = dataset.schema.field('time').type
+    filter_expression = None
+    if start is not None:
+        filter_expression = ds.field('time') >= pa.scalar(pd.Timestamp(start), type=time_type)
+    if end is not None:
+        end_expression = ds.field('time') < pa.scalar(pd.Timestamp(end), type=time_type)
+        filter_expression = end_expression if filter_expression is None else filter_expression & end_expression
+
+    trend_data_df = dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+    trend_data_df = trend_data_df.set_index('time').sort_index()
+    # A partition that is being compacted can briefly hold its rows twice
+    trend_data_df = trend_data_df[~trend_data_df.index.duplicated(keep='first')]
+    trend_data_df = trend_data_df.reindex(columns=[entry['column'] for entry in entries])
+    trend_data_df.columns = [entry['source'] for entry in entries]
+    return trend_data_df
+
+# Function to merge the small files of every partition of a dataset
+def compact_dataset(dataset_dir, min_files=2, row_group_size=ROW_GROUP_SIZE):
+    """
+    Merge the files of every partition holding at least min_files files into one file.
+
+    Frequent appends (e.g. the live tail) add one small file per write. The merged
+    file replaces the first file of the partition before the others are removed, so
+    readers never miss rows (read_dataset drops the rows they may briefly see twice).
+
+    Args:
+        dataset_dir: Path to the dataset directory
+        min_files: Smallest number of files in a partition worth merging
+        row_group_size: Number of rows per Parquet row group
+    """
+    dictionary = read_source_dictionary(dataset_dir)
+    # Change point files are already small, and each one is expanded on its own
+    if dictionary is None or dictionary['encoding'] == 'change_points':
+        return
+    column_order = ['time'] + [entry['column'] for entry in dictionary['columns']]
+    for partition_dir in sorted(glob.glob(os.path.join(dataset_dir, f"{dictionary['partition']}=*"))):
+        files = sorted(glob.glob(os.path.join(partition_dir, '*.parquet')))
+        if len(files) < min_files:
+            continue
+        # Files written before a source was added lack its column, and a widened source is float32 in
+        # the files written before it was widened; read them with the combined schema
+        schema = pa.unify_schemas([pq.read_schema(file_path) for file_path in files], promote_options='permissive')
+        schema = pa.schema([schema.field(name) for name in column_order if name in schema.names])
+        table = ds.dataset(files, schema=schema, format='parquet').to_table()
+        table = table.sort_by('time')
+        temp_file = files[0] + '.tmp'
+        pq.write_table(table, temp_file, row_group_size=row_group_size, compression='zstd',
+                       write_statistics=True)
+        os.replace(temp_file, files[0])
+        for file_path in files[1:]:
+            os.remove(file_path)
+
+# Function to get the last timestamp stored in a dataset
+def dataset_last_timestamp(dataset_dir):
+    """
+    Get the last timestamp stored in a dataset, using only the file metadata and row group statistics.
+
+    Args:
+        dataset_dir: Path to the dataset directory
+
+    Returns:
+        The last timestamp as a pandas Timestamp, or None if the dataset is missing or empty
+    """
+    dictionary = read_source_dictionary(dataset_dir)
+    if dictionary is None:
+        return None
+    files = _partition_files(dataset_dir, dictionary['partition'])
+    last_timestamp = None
+    # Appended files are always later, so only the last partition needs to be inspected
+    last_partition = os.path.dirname(files[-1]) if files else None
+    for file_path in files:
+        if os.path.dirname(file_path) != last_partition:
+            continue
+        if dictionary['encoding'] == 'change_points':
+            candidate = _change_point_range(file_path)[1]
+            if last_timestamp is None or candidate > last_timestamp:
+                last_timestamp = candidate
+            continue
+        metadata = pq.read_metadata(file_path)
+        time_index = metadata.schema.to_arrow_schema().get_field_index('time')
+        for row_group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(row_group).column(time_index).statistics
+            if statistics is not None and statistics.has_min_max:
+                candidate = pd.Timestamp(statistics.max)
+                if last_timestamp is None or candidate > last_timestamp:
+                    last_timestamp = candidate
+    return last_timestamp
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+HTTP helpers for fetching trend data from the BMS API
+Provides pooled keep-alive sessions for the thread pool, and an asyncio based
+extraction mode that runs many interval requests over one pooled client
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import datetime as dt
+import os
+import threading
+import time
+
+import pandas as pd
+import requests
+from tqdm import tqdm  # For progress bars
+
+from bms_metrics import metrics, response_size
+from bms_processing import (decode_trend_data_stream, decode_trend_data_stream_async, label_trend_data_compact,
+                            write_compact_chunk)
+from bms_scheduling import (MAX_RETRIES, RETRY_STATUS_CODES, backoff_delay, get_with_retries,
+                            parse_retry_after, rate_limiter)
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is only needed for the async extraction mode
+    aiohttp = None
+
+# Timeout (in seconds) for a single trend data request
+REQUEST_TIMEOUT = 300
+# HTTP status codes that mean the request was too large for the server to answer in time
+SPLIT_STATUS_CODES = (413, 502, 503, 504)
+
+# Thread-local storage, so every worker thread reuses its own keep-alive session
+_thread_local = threading.local()
+
+
+# Function to build the query parameters for a trend data request
+def trend_data_params(starttime, endtime, externallogid):
+    """
+    Build the query parameters for a trend data request.
+
+    The parameters are encoded the same way requests encodes
+    {'starttime': ..., 'endtime': ..., 'externallogid': [[id, ...], ...]}.
+
+    Args:
+        starttime: Start time for data extraction
+        endtime: End time for data extraction
+        externallogid: List of external log IDs (or lists of IDs) to fetch
+
+    Returns:
+        List of (key, value) string pairs
+    """
+    params = [('starttime', str(starttime)), ('endtime', str(endtime))]
+    for ids in externallogid:
+        if isinstance(ids, (list, tuple)):
+            params.extend(('externallogid', str(id_)) for id_ in ids)
+        else:
+            params.append(('externallogid', str(ids)))
+    return params
+
+# Function to split the externallogid list into shards
+def shard_externallogid(externallogid, shard_size=None):
+    """
+    Split the externallogid list into shards of at most shard_size entries.
+
+    Args:
+        externallogid: List of external log IDs (or lists of IDs) to fetch
+        shard_size: Maximum number of entries per shard, None for a single shard
+
+    Returns:
+        List of externallogid lists
+    """
+    if not shard_size or shard_size >= len(externallogid):
+        return [externallogid]
+    return [externallogid[i:i + shard_size] for i in range(0, len(externallogid), shard_size)]
+
+# Function to build the (time window x id shard) work items of an extraction
+def build_work_items(time_intervals, id_shards):
+    """
+    Build the (time window x id shard) work items of an extraction.
+
+    Args:
+        time_intervals: List of (starttime, endtime) tuples
+        id_shards: List of externallogid shards (see shard_externallogid)
+
+    Returns:
+        List of (interval, shard_index) tuples, ordered by time window and then by shard
+    """
+    return [(interval, shard_index) for interval in time_intervals for shard_index in range(len(id_shards))]
+
+# Function to get the keep-alive session of the current thread
+def get_thread_session(pool_size=10):
+    """
+    Get the requests.Session of the current thread, creating it on first use.
+
+    Args:
+        pool_size: Maximum number of pooled connections kept by the session
+
+    Returns:
+        The requests.Session of the calling thread
+    """
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _thread_local.session = session
+    return session
+
+# Function to fetch and label the trend data for one time interval
+def fetch_trend_data(starttime, endtime, externallogid, source_lookup, auth, trenddata_url,
+                     session=None, timeout=REQUEST_TIMEOUT, queued_at=None):
+    """
+    Fetch the trend data for one time interval and label it with the sources.
+
+    Transient errors are retried with backoff under the shared rate limit (see
+    bms_scheduling.get_with_retries). Unlike the script level fetch functions, errors
+    that remain are raised instead of printed.
+
+    Args:
+        starttime: Start time for data extraction
+        endtime: End time for data extraction
+        externallogid: List of external log IDs to fetch
+        source_lookup: Shared externallogid -> source lookup (see build_source_lookup)
+        auth: (username, password) tuple for the API
+        trenddata_url: URL of the trenddata endpoint
+        session: requests.Session to use (defaults to the session of the current thread)
+        timeout: Request timeout in seconds
+        queued_at: time.perf_counter() value when the request was queued, to record its queue wait
+
+    Returns:
+        Compact records (see label_trend_data_compact), empty if the interval had no data
+    """
+    if session is None:
+        session = get_thread_session()
+    request_start = time.perf_counter()
+    queue_wait = request_start - queued_at if queued_at is not None else 0.0
+    try:
+        with metrics.stage('fetch'):
+            trend_data = get_with_retries(session, trenddata_url,
+                                          params=trend_data_params(starttime, endtime, externallogid),
+                                          auth=auth, timeout=timeout, stream=True)
+        try:
+            # Decode the body straight from the socket into typed columns (the parse stage
+            # includes reading the streamed body)
+            with metrics.stage('parse'):
+                trend_data.raw.decode_content = True
+                trend_data_df = decode_trend_data_stream(trend_data.raw)
+            response_bytes = response_size(trend_data)
+        finally:
+            trend_data.close()
+    except Exception as e:
+        metrics.record_request(starttime, endtime, time.perf_counter() - request_start,
+                               retries=getattr(e, 'retries', 0), queue_wait=queue_wait, error=e)
+        raise
+    metrics.record_request(starttime, endtime, time.perf_counter() - request_start, response_bytes,
+                           len(trend_data_df), getattr(trend_data, 'retries', 0), queue_wait)
+    if trend_data_df.empty:
+        return pd.DataFrame()
+    with metrics.stage('label'):
+        return label_trend_data_compact(trend_data_df, source_lookup)
+
+# Function running a function as one pass through a metrics stage (used with run_in_executor)
+def _run_in_stage(stage, function, *args):
+    with metrics.stage(stage):
+        return function(*args)
+
+# Coroutine sending a GET request through the shared client with rate limiting and retries
+async def _get_with_retries_async(client, semaphore, url, params, auth, read_body, request_info=None):
+    """
+    Send a GET request with the shared rate limiter, retries and backoff (see get_with_retries).
+
+    Args:
+        read_body: Coroutine function reading the successful response, e.g. decoding its body
+        request_info: Optional dict receiving the 'retries', 'queue_wait' (seconds waited for a
+            connection slot) and 'bytes' (body size) of the request
+
+    Returns:
+        The result of read_body
+    """
+    if request_info is None:
+        request_info = {}
+    request_info.setdefault('queue_wait', 0.0)
+    for attempt in range(MAX_RETRIES + 1):
+        await rate_limiter.acquire_async()
+        retry_after = None
+        request_info['retries'] = attempt
+        try:
+            wait_start = time.perf_counter()
+            async with semaphore:
+                request_info['queue_wait'] += time.perf_counter() - wait_start
+                async with client.get(url, params=params, auth=aiohttp.BasicAuth(*auth),
+                                      timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as response:
+                    if response.status not in RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        result = await read_body(response)
+                        request_info['bytes'] = getattr(response.content, 'total_bytes', None)
+                        return result
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                        status=response.status, message=response.reason)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            error = e
+
+        if attempt == MAX_RETRIES:
+            raise error
+        if retry_after is not None:
+            rate_limiter.pause(retry_after)
+        delay = backoff_delay(attempt, retry_after)
+        print(f"Request failed ({error!r}), retrying in {delay:.1f} s")
+        await asyncio.sleep(delay)
+
+# Coroutine fetching one time interval through the shared client
+async def _fetch_interval_async(client, semaphore, trenddata_url, auth, interval, externallogid,
+                                source_lookup, temp_dir, interval_index):
+    """
+    Fetch and parse the trend data for one time interval.
+
+    Returns:
+        Tuple (result, row_count, error): result is the path to the saved chunk file
+        (temp_dir given) or the compact records, None / an empty DataFrame if the
+        interval had no data or failed; error is the exception of a failed interval
+    """
+    starttime, endtime = interval
+    empty_result = None if temp_dir is not None else pd.DataFrame()
+    request_info = {}
+    request_start = time.perf_counter()
+    try:
+        # Decode the body straight from the connection into typed columns (the fetch stage
+        # includes decoding, as the body is decoded while it streams in)
+        try:
+            with metrics.stage('fetch'):
+                trend_data_df = await _get_with_retries_async(
+                    client, semaphore, trenddata_url, trend_data_params(starttime, endtime, externallogid), auth,
+                    lambda response: decode_trend_data_stream_async(response.content), request_info)
+        except Exception as e:
+            metrics.record_request(starttime, endtime, time.perf_counter() - request_start,
+                                   retries=request_info.get('retries', 0),
+                                   queue_wait=request_info.get('queue_wait', 0.0), error=e)
+            raise
+        metrics.record_request(starttime, endtime, time.perf_counter() - request_start,
+                               request_info.get('bytes'), len(trend_data_df), request_info['retries'],
+                               request_info['queue_wait'])
+
+        # Label (and write) off the event loop, so other requests keep flowing
+        loop = asyncio.get_running_loop()
+        if not trend_data_df.empty:
+            result_df = await loop.run_in_executor(None, _run_in_stage, 'label', label_trend_data_compact,
+                                                   trend_data_df, source_lookup)
+        else:
+            result_df = trend_data_df
+        if result_df.empty:
+            print(f"No data found for interval {starttime} to {endtime}")
+            return empty_result, 0, None
+        if temp_dir is None:
+            return result_df, len(result_df), None
+
+        temp_file_path = os.path.join(temp_dir, f"chunk_{interval_index}.parquet")
+        await loop.run_in_executor(None, _run_in_stage, 'write', write_compact_chunk, result_df,
+                                   temp_file_path)
+        return temp_file_path, len(result_df), None
+
+    except Exception as e:
+        print(f"Error fetching data for interval {starttime} to {endtime}: {e}")
+        return empty_result, 0, e
+
+# Coroutine running all interval requests over one pooled client
+async def _fetch_intervals_async(work_items, id_shards, source_lookup, auth, trenddata_url,
+                                 max_concurrency, temp_dir, chunk_names, on_complete, failure_report):
+    connector = aiohttp.TCPConnector(limit=max_concurrency, keepalive_timeout=60)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as client:
+        with tqdm(total=len(work_items), desc="Downloading data chunks") as progress:
+            async def fetch_and_count(idx, interval, shard_index):
+                chunk_name = chunk_names[idx] if chunk_names is not None else idx
+                result, row_count, error = await _fetch_interval_async(
+                    client, semaphore, trenddata_url, auth, interval, id_shards[shard_index],
+                    source_lookup, temp_dir, chunk_name)
+                if error is not None and failure_report is not None:
+                    failure_report.add(interval[0], interval[1], id_shards[shard_index], error)
+                if on_complete is not None:
+                    on_complete(idx, result, row_count, error)
+                progress.update(1)
+                return result
+
+            # gather keeps the results in work item order
+            return await asyncio.gather(*(fetch_and_count(idx, interval, shard_index)
+                                          for idx, (interval, shard_index) in enumerate(work_items)))
+
+# Function to fetch all time intervals with the asyncio extraction mode
+def fetch_intervals_async(time_intervals, externallogid, source_lookup, auth, trenddata_url,
+                          max_concurrency=64, temp_dir=None, id_shard_size=None,
+                          work_items=None, chunk_names=None, on_complete=None, failure_report=None):
+    """
+    Fetch trend data for all time intervals with asyncio and one pooled HTTP client.
+
+    Connections are kept alive and reused, and at most max_concurrency requests are
+    in flight at the same time. When id_shard_size is given, every time interval is
+    fetched as several requests of at most id_shard_size externallogid each. The
+    results are the same as calling fetch_trend_data_for_interval for every
+    (interval, shard) work item.
+
+    Args:
+        time_intervals: List of (starttime, endtime) tuples
+        externallogid: List of external log IDs to fetch
+        source_lookup: Shared externallogid -> source lookup (see build_source_lookup)
+        auth: (username, password) tuple for the API
+        trenddata_url: URL of the trenddata endpoint
+        max_concurrency: Maximum number of requests in flight
+        temp_dir: If given, every work item is saved as chunk_<index>.parquet in this directory
+        id_shard_size: Maximum number of externallogid per request, None to send them all at once
+        work_items: Optional subset of the (interval, shard_index) work items to fetch
+            (see build_work_items), e.g. the chunks still missing from a manifest
+        chunk_names: Optional names used instead of the work item index in the chunk file names
+        on_complete: Optional callback (index, result, row_count, error) called when a work
+            item finishes; error is None unless the request failed
+        failure_report: Optional FailureReport collecting the work items that still failed
+
+    Returns:
+        List with one entry per work item (ordered by time window, then by shard): the chunk
+        file path or None when temp_dir is given, otherwise the compact records (empty if no data)
+    """
+    if aiohttp is None:
+        raise ImportError("The async extraction mode needs aiohttp (pip install aiohttp)")
+    id_shards = shard_externallogid(externallogid, id_shard_size)
+    if work_items is None:
+        work_items = build_work_items(time_intervals, id_shards)
+    return asyncio.run(_fetch_intervals_async(work_items, id_shards, source_lookup, auth, trenddata_url,
+                                              max_concurrency, temp_dir, chunk_names, on_complete,
+                                              failure_report))
+
+# Planner adapting the interval length toward a target number of rows per response
+class AdaptiveIntervalPlanner:
+    """
+    Plan the time intervals of an extraction, adapting their length to the data.
+
+    Intervals are handed out from starttime to endtime. After every response the
+    observed row rate is used to size the following intervals toward target_rows.
+    Empty responses double the interval length, so runs of empty intervals are
+    merged into a few long requests. Intervals that time out (or that the server
+    refuses as too large) are split in two and handed out again first.
+
+    Args:
+        starttime: Start time for data extraction
+        endtime: End time for data extraction
+        timestep: Length of the first interval(s)
+        target_rows: Desired number of rows per response
+        min_timestep: Shortest interval the planner will use (or split down to)
+        max_timestep: Longest interval the planner will use
+    """
+
+    def __init__(self, starttime, endtime, timestep, target_rows, min_timestep, max_timestep):
+        self.endtime = endtime
+        self.cursor = starttime
+        self.timestep = timestep
+        self.target_rows = target_rows
+        self.min_timestep = min_timestep
+        self.max_timestep = max_timestep
+        self.retry_intervals = collections.deque()
+
+    def has_work(self):
+        """Return True while there are intervals left to hand out."""
+        return bool(self.retry_intervals) or self.cursor < self.endtime
+
+    def next_interval(self):
+        """Return the next (starttime, endtime) interval to fetch, or None when done."""
+        if self.retry_intervals:
+            return self.retry_intervals.popleft()
+        if self.cursor >= self.endtime:
+            return None
+        interval = (self.cursor, min(self.cursor + self.timestep, self.endtime))
+        self.cursor = interval[1]
+        return interval
+
+    def record(self, interval, row_count):
+        """Adapt the interval length to the number of rows returned for an interval."""
+        if row_count == 0:
+            new_timestep = self.timestep * 2
+        else:
+            row_rate = row_count / (interval[1] - interval[0]).total_seconds()
+            new_timestep = dt.timedelta(seconds=self.target_rows / row_rate)
+            # Do not change the length by more than a factor 4 from one response to the next
+            new_timestep = max(self.timestep / 4, min(new_timestep, self.timestep * 4))
+        self.timestep = max(self.min_timestep, min(new_timestep, self.max_timestep))
+
+    def split(self, interval):
+        """
+        Split an interval that timed out into two halves and queue them first.
+
+        Returns:
+            False if the interval is already at the minimum length and was not split
+        """
+        half = (interval[1] - interval[0]) / 2
+        if half < self.min_timestep:
+            return False
+        self.retry_intervals.appendleft((interval[0] + half, interval[1]))
+        self.retry_intervals.appendleft((interval[0], interval[0] + half))
+        self.timestep = max(self.min_timestep, min(self.timestep, half))
+        return True
+
+# Function to decide whether a failed request should be retried as two smaller intervals
+def _is_split_error(error):
+    if isinstance(error, requests.Timeout):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in SPLIT_STATUS_CODES
+    return False
+
+# Function to fetch the intervals handed out by AdaptiveIntervalPlanners with a thread pool
+def fetch_intervals_adaptive(planners, fetch_fn, max_workers, failure_report=None, id_shards=None):
+    """
+    Fetch the intervals handed out by AdaptiveIntervalPlanners with a thread pool.
+
+    There is one planner per externallogid shard, so every shard adapts its interval
+    length to its own data density. At most max_workers requests are in flight; new
+    intervals are only planned once earlier responses have come back, so the
+    planners can adapt to them.
+
+    Args:
+        planners: List of AdaptiveIntervalPlanner, one per externallogid shard
+        fetch_fn: Function (starttime, endtime, shard_index, interval_index) -> (result, row_count).
+            It should raise on errors; timeouts and SPLIT_STATUS_CODES split the interval
+        max_workers: Number of worker threads
+        failure_report: Optional FailureReport collecting the intervals that still failed
+        id_shards: Optional list of the externallogid shards of the planners (recorded in the failure report)
+
+    Returns:
+        List of (interval, shard_index, result) tuples for the successful requests,
+        sorted by start time and then by shard
+    """
+    results = []
+    interval_index = 0
+    next_shard = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(desc="Downloading adaptive intervals", unit="interval") as progress:
+        in_flight = {}
+        while any(planner.has_work() for planner in planners) or in_flight:
+            # Hand out work round-robin over the shards that still have intervals left
+            while len(in_flight) < max_workers and any(planner.has_work() for planner in planners):
+                shard_index = next_shard
+                next_shard = (next_shard + 1) % len(planners)
+                if not planners[shard_index].has_work():
+                    continue
+                interval = planners[shard_index].next_interval()
+                future = executor.submit(fetch_fn, interval[0], interval[1], shard_index, interval_index)
+                in_flight[future] = (interval, shard_index)
+                interval_index += 1
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                interval, shard_index = in_flight.pop(future)
+                progress.update(1)
+                try:
+                    result, row_count = future.result()
+                except Exception as e:
+                    if _is_split_error(e) and planners[shard_index].split(interval):
+                        print(f"Splitting interval {interval[0]} to {interval[1]} after: {e}")
+                    else:
+                        print(f"Error fetching data for interval {interval[0]} to {interval[1]}: {e}")
+                        if failure_report is not None:
+                            failure_report.add(interval[0], interval[1],
+                                               id_shards[shard_index] if id_shards is not None else None, e)
+                    continue
+                planners[shard_index].record(interval, row_count)
+                results.append((interval, shard_index, result))
+
+    results.sort(key=lambda item: (item[0][0], item[1]))
+    return results
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Shared extraction jobs over several log maps
+Log maps often share sensors. A shared job fetches the union of their externallogids
+once per time interval into one chunk store, and every log map's output is then
+projected from that store, so no (id, interval) pair is requested twice
+"""
+
+import hashlib
+
+import pandas as pd
+
+from bms_processing import add_source_ids
+
+
+# Function to build the name of a shared job (used for its work directory and reports)
+def shared_job_name(logmap_names):
+    """
+    Build the name of a shared job from the names of its log maps.
+
+    Args:
+        logmap_names: Names of the log maps in the job
+
+    Returns:
+        'shared_<hash>' name that is the same for the same set of log maps
+    """
+    names = '|'.join(sorted(logmap_names))
+    return f"shared_{hashlib.sha1(names.encode('utf-8')).hexdigest()[:10]}"
+
+# Function to combine the externallogid lists of several log maps
+def union_externallogids(externallogid_lists):
+    """
+    Combine the externallogid lists of several log maps, keeping every source once.
+
+    Args:
+        externallogid_lists: One externallogid list (list of per-source id lists) per log map
+
+    Returns:
+        List of per-source id lists, in order of first appearance
+    """
+    seen = set()
+    union = []
+    for externallogid in externallogid_lists:
+        for ids in externallogid:
+            key = tuple(ids)
+            if key not in seen:
+                seen.add(key)
+                union.append(ids)
+    return union
+
+# Function to combine the source lookups of several log maps
+def union_source_lookup(source_lookups):
+    """
+    Combine the externallogid -> source lookups of several log maps.
+
+    Args:
+        source_lookups: Lookups built by build_source_lookup, one per log map
+
+    Returns:
+        Lookup with every externallogid once (the first log map using it names its source)
+    """
+    union = pd.concat([lookup.drop(columns='source_id').astype({'source': str}) for lookup in source_lookups],
+                      ignore_index=True)
+    union = union.drop_duplicates(subset='externallogid', keep='first')
+    union['source'] = union['source'].astype('category')
+    return add_source_ids(union.reset_index(drop=True))
+
+# Function to report how many requests a shared job saves
+def print_overlap_summary(logmap_names, externallogid_lists, union_externallogid):
+    """Print the number of sources per log map and how many a shared job fetches once."""
+    total = sum(len(externallogid) for externallogid in externallogid_lists)
+    for name, externallogid in zip(logmap_names, externallogid_lists):
+        print(f"  {name}: {len(externallogid)} sources")
+    saved = 1 - len(union_externallogid) / total if total else 0
+    print(f"Shared job fetches {len(union_externallogid)} of {total} sources "
+          f"({saved:.0%} fewer ids per interval)")
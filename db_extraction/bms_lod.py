@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Level-of-detail pyramid for plotting long extractions
+Every column of a wide time x source table is aggregated once into levels with
+LOD_FACTOR times fewer buckets each, holding the min, max, sum and count of the
+samples of every bucket. A plot of any time range reads the finest level with at
+most a few buckets per pixel in that range and reduces it to one bucket per pixel
+(min-max), or picks one mean per pixel with LTTB, so the number of points drawn is
+bounded by the width of the axes and not by the length of the data. Buckets do not
+span gaps in the data, and the downsampled lines break at them. Times are kept as
+UTC nanoseconds, so data spanning a DST change stays in order; the time zone is
+kept with the pyramid for the axis labels. The pyramid is cached on disk and
+memory-mapped, so reopening a file does not parse it again
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from bms_metadata import METADATA_CACHE_DIR
+from bms_processing import tz_to_string
+
+# Number of buckets of a level merged into one bucket of the next level
+LOD_FACTOR = 4
+# The pyramid stops at the first level with at most this many buckets
+LOD_MIN_BUCKETS = 1024
+# A level is used for a time range while it has at most this many buckets per pixel in the range
+LOD_BUCKETS_PER_PIXEL = 4
+# Rows further apart than this many times the typical spacing of the data are separated by a gap
+LOD_GAP_FACTOR = 5
+# Sub-directory of the cache directory holding one pyramid per source file
+LOD_CACHE_SUBDIR = "lod"
+
+# Arrays stored per level: bucket start time, aggregates and whether a gap comes before the bucket
+# (level 0 holds the samples themselves as 'values')
+LEVEL_FIELDS = ('time', 'min', 'max', 'sum', 'count', 'gap')
+
+
+# Function to get the times of an index as int64 UTC nanoseconds (naive times are taken as UTC)
+def _utc_ns(index):
+    return pd.DatetimeIndex(index).as_unit('ns').asi8
+
+# Function to flag the rows that come after a gap
+def _gaps(times, gap_factor):
+    gap = np.zeros(len(times), dtype=bool)
+    steps = np.diff(times)
+    if len(steps):
+        gap[1:] = steps > gap_factor * np.median(steps)
+    return gap
+
+# Function to get the first bucket of every bucket of the next level
+def _bucket_starts(gap, factor):
+    # Every run of buckets between two gaps is merged factor by factor, so no bucket spans a gap
+    positions = np.arange(len(gap))
+    run_start = np.maximum.accumulate(np.where(gap | (positions == 0), positions, 0))
+    return np.flatnonzero((positions - run_start) % factor == 0)
+
+# Function to merge groups of buckets of a level
+def _reduce(level, lo, hi, starts):
+    """
+    Merge the buckets [lo, hi) of a level into groups.
+
+    Args:
+        level: Level dict (see build_pyramid)
+        lo: First bucket
+        hi: Bucket after the last one
+        starts: Sorted offsets (relative to lo) of the first bucket of every group
+
+    Returns:
+        Dict with the 'min', 'max', 'sum' and 'count' of every group (one row per group)
+    """
+    if 'values' in level:
+        values = level['values'][lo:hi]
+        valid = ~np.isnan(values)
+        return {'min': np.fmin.reduceat(values, starts, axis=0),
+                'max': np.fmax.reduceat(values, starts, axis=0),
+                'sum': np.add.reduceat(np.where(valid, values, 0).astype(np.float64), starts, axis=0),
+                'count': np.add.reduceat(valid.astype(np.int32), starts, axis=0)}
+    # fmin/fmax skip the NaN of buckets without samples
+    return {'min': np.fmin.reduceat(level['min'][lo:hi], starts, axis=0),
+            'max': np.fmax.reduceat(level['max'][lo:hi], starts, axis=0),
+            'sum': np.add.reduceat(level['sum'][lo:hi], starts, axis=0),
+            'count': np.add.reduceat(level['count'][lo:hi], starts, axis=0)}
+
+# Function to build the level-of-detail pyramid of a wide table
+def build_pyramid(trend_data_df, factor=LOD_FACTOR, min_buckets=LOD_MIN_BUCKETS, gap_factor=LOD_GAP_FACTOR):
+    """
+    Build the level-of-detail pyramid of a wide time x source table.
+
+    Level 0 holds the samples (as float32, plenty for plotting); every next level
+    merges factor buckets of the level below, and a bucket starts at the time of its
+    first row. Rows further apart than gap_factor times the median spacing are
+    separated by a gap: buckets end at a gap, so it stays a gap at every level.
+    Only where gaps are so dense that splitting at them would not halve a level do
+    the buckets of that level and the levels above merge across them.
+
+    Args:
+        trend_data_df: Wide DataFrame indexed by time, sorted by time
+        factor: Number of buckets merged into one bucket of the next level
+        min_buckets: Maximum number of buckets of the coarsest level
+        gap_factor: Spacing (in typical spacings of the data) from which rows are separated by a gap
+
+    Returns:
+        Dict with the 'columns', the 'tz' of the data (see bms_processing.tz_to_string) and the
+        'levels' (list of dicts of arrays, finest first)
+    """
+    times = _utc_ns(trend_data_df.index)
+    levels = [{'time': times, 'values': trend_data_df.to_numpy(dtype=np.float32, na_value=np.nan),
+               'gap': _gaps(times, gap_factor)}]
+    split_at_gaps = True
+    while len(levels[-1]['time']) > min_buckets:
+        level = levels[-1]
+        count = len(level['time'])
+        starts = _bucket_starts(level['gap'], factor) if split_at_gaps else np.arange(0, count, factor)
+        if len(starts) > count // 2:
+            split_at_gaps = False
+            starts = np.arange(0, count, factor)
+        merged = _reduce(level, 0, count, starts)
+        merged['time'] = level['time'][starts]
+        merged['gap'] = level['gap'][starts]
+        levels.append(merged)
+    return {'columns': [str(column) for column in trend_data_df.columns],
+            'tz': tz_to_string(pd.DatetimeIndex(trend_data_df.index).tz), 'levels': levels}
+
+# Function to get the signature of a source file or dataset directory
+def _source_signature(path):
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+    else:
+        stats = [os.stat(path)]
+    signature = (f"{os.path.abspath(path)}|{sum(s.st_size for s in stats)}"
+                 f"|{max((s.st_mtime_ns for s in stats), default=0)}")
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+# Function to write a pyramid to the cache
+def save_pyramid(pyramid, pyramid_dir):
+    """
+    Write a pyramid to a directory of .npy files (atomically, via a temporary directory).
+
+    Args:
+        pyramid: Pyramid (see build_pyramid)
+        pyramid_dir: Directory to write
+    """
+    temp_dir = pyramid_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    for number, level in enumerate(pyramid['levels']):
+        for field, array in level.items():
+            np.save(os.path.join(temp_dir, f"level{number}_{field}.npy"), array)
+    with open(os.path.join(temp_dir, 'pyramid.json'), 'w', encoding='utf-8') as f:
+        json.dump({'columns': pyramid['columns'], 'tz': pyramid['tz'], 'levels': len(pyramid['levels'])}, f)
+    shutil.rmtree(pyramid_dir, ignore_errors=True)
+    os.replace(temp_dir, pyramid_dir)
+
+# Function to read a pyramid from the cache
+def load_pyramid(pyramid_dir):
+    """
+    Read a pyramid written by save_pyramid, memory-mapped (only the parts that are plotted are read).
+
+    Args:
+        pyramid_dir: Directory of the pyramid
+
+    Returns:
+        The pyramid, or None if there is no usable pyramid in the directory
+    """
+    try:
+        with open(os.path.join(pyramid_dir, 'pyramid.json'), 'r', encoding='utf-8') as f:
+            header = json.load(f)
+        # pyramids cached before the time zone was kept hold wall-clock times and are built again
+        tz_string = header['tz']
+        levels = []
+        for number in range(header['levels']):
+            fields = ('time', 'values', 'gap') if number == 0 else LEVEL_FIELDS
+            levels.append({field: np.load(os.path.join(pyramid_dir, f"level{number}_{field}.npy"), mmap_mode='r')
+                           for field in fields})
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.isdir(pyramid_dir):
+            print(f"Ignoring unreadable pyramid {pyramid_dir}: {e}")
+        return None
+    return {'columns': header['columns'], 'tz': tz_string, 'levels': levels}
+
+# Function to get the pyramid of a file, building it only when the file changed
+def cached_pyramid(path, read_data, cache_dir=METADATA_CACHE_DIR):
+    """
+    Get the pyramid of a CSV file or dataset directory from the cache, or build and cache it.
+
+    Args:
+        path: CSV file or dataset directory
+        read_data: Function reading path into a wide DataFrame indexed by time
+        cache_dir: Cache directory (the pyramids go into its LOD_CACHE_SUBDIR)
+
+    Returns:
+        The pyramid (see build_pyramid)
+    """
+    pyramid_dir = os.path.join(cache_dir, LOD_CACHE_SUBDIR, _source_signature(path))
+    pyramid = load_pyramid(pyramid_dir)
+    if pyramid is not None:
+        return pyramid
+    print(f"Building the level-of-detail pyramid of {path}")
+    trend_data_df = read_data(path)
+    pyramid = build_pyramid(trend_data_df.sort_index())
+    del trend_data_df
+    save_pyramid(pyramid, pyramid_dir)
+    return load_pyramid(pyramid_dir)
+
+# Function to get the time range of a pyramid
+def pyramid_range(pyramid):
+    """Return the first and last time of a pyramid as int64 UTC nanoseconds (None if it is empty)."""
+    times = pyramid['levels'][0]['time']
+    return (int(times[0]), int(times[-1])) if len(times) else None
+
+# Function to select the level and buckets to read for a time range
+def select_level(pyramid, start, end, max_buckets):
+    """
+    Select the finest level with at most max_buckets buckets in a time range.
+
+    Args:
+        pyramid: Pyramid (see build_pyramid)
+        start: First time of the range (int64 UTC nanoseconds)
+        end: Last time of the range (int64 UTC nanoseconds)
+        max_buckets: Maximum number of buckets to read
+
+    Returns:
+        Tuple (level number, first bucket, bucket after the last one); the range includes one bucket
+        on either side, so lines run on to the edges of the plot
+    """
+    for number, level in enumerate(pyramid['levels']):
+        times = level['time']
+        lo = max(int(np.searchsorted(times, start, side='right')) - 1, 0)
+        hi = min(int(np.searchsorted(times, end, side='right')) + 1, len(times))
+        if hi - lo <= max_buckets or number == len(pyramid['levels']) - 1:
+            return number, lo, hi
+
+# Function to insert a NaN row before every row that follows a gap, so plotted lines break there
+def _break_at_gaps(times, values, breaks):
+    """
+    Insert a row of NaN values before the rows that follow a gap.
+
+    Args:
+        times: Times of the rows (1-D, or 2-D with one column per source)
+        values: List of 2-D value arrays with one row per time and one column per source
+        breaks: Boolean array, True for the rows that follow a gap
+
+    Returns:
+        Tuple (times, values) with the NaN rows inserted
+    """
+    rows = np.flatnonzero(breaks)
+    if not len(rows):
+        return times, values
+    return (np.insert(times, rows, times[rows], axis=0),
+            [np.insert(np.asarray(array, dtype=np.float64), rows, np.nan, axis=0) for array in values])
+
+# Function to downsample a time range to one min/max bucket per pixel
+def minmax_downsample(pyramid, start, end, pixels):
+    """
+    Downsample a time range to at most one min/max/mean bucket per pixel.
+
+    Drawing the min and the max of every bucket keeps every peak of the data, so
+    the plot looks like a plot of every sample at the resolution of the screen.
+
+    Args:
+        pyramid: Pyramid (see build_pyramid)
+        start: First time of the range (int64 UTC nanoseconds)
+        end: Last time of the range (int64 UTC nanoseconds)
+        pixels: Width of the plot in pixels
+
+    Returns:
+        Tuple (level number, bucket times, mins, maxs, means); the values have one row per bucket and
+        one column per source (NaN where a bucket has no samples, and in a row inserted at every gap)
+    """
+    number, lo, hi = select_level(pyramid, start, end, pixels * LOD_BUCKETS_PER_PIXEL)
+    level = pyramid['levels'][number]
+    count = hi - lo
+    if count <= 0:
+        empty = np.empty((0, len(pyramid['columns'])))
+        return number, np.empty(0, dtype=np.int64), empty, empty, empty
+    gap = np.array(level['gap'][lo:hi])
+    gap[0] = False
+    if count <= pixels:
+        starts = np.arange(count)
+    else:
+        # a pixel does not span a gap either
+        starts = np.union1d(np.linspace(0, count, pixels, endpoint=False).astype(np.int64), np.flatnonzero(gap))
+    merged = _reduce(level, lo, hi, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(merged['count'] > 0, merged['sum'] / merged['count'], np.nan)
+    times, (mins, maxs, means) = _break_at_gaps(np.asarray(level['time'][lo:hi])[starts],
+                                                [merged['min'], merged['max'], means], gap[starts])
+    return number, times, mins, maxs, means
+
+# Function to downsample a time range with largest-triangle-three-buckets
+def lttb_downsample(pyramid, start, end, pixels):
+    """
+    Downsample a time range to one point per pixel with largest-triangle-three-buckets (LTTB).
+
+    LTTB runs over the samples of the range (or the bucket means of the finest level
+    that is small enough) and keeps, in every bucket, the point forming the largest
+    triangle with the point kept before it and the mean of the next bucket. All
+    sources are downsampled at once, each keeping its own points.
+
+    Args:
+        pyramid: Pyramid (see build_pyramid)
+        start: First time of the range (int64 UTC nanoseconds)
+        end: Last time of the range (int64 UTC nanoseconds)
+        pixels: Width of the plot in pixels (number of points kept per source)
+
+    Returns:
+        Tuple (level number, times, values); both have one row per point and one column per source
+        (with a NaN value inserted wherever consecutive points are separated by a gap)
+    """
+    pixels = max(int(pixels), 3)
+    number, lo, hi = select_level(pyramid, start, end, pixels * LOD_BUCKETS_PER_PIXEL)
+    level = pyramid['levels'][number]
+    times = np.asarray(level['time'][lo:hi])
+    if 'values' in level:
+        values = np.asarray(level['values'][lo:hi], dtype=np.float64)
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where(level['count'][lo:hi] > 0, level['sum'][lo:hi] / level['count'][lo:hi], np.nan)
+    count, sources = values.shape
+    gap = np.array(level['gap'][lo:hi])
+    if count:
+        gap[0] = False
+    if count <= pixels:
+        times, (values,) = _break_at_gaps(times, [values], gap)
+        return number, np.repeat(times[:, None], sources, axis=1), values
+
+    x = (times - times[0]) / 1e9
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    columns = np.arange(sources)
+    every = (count - 2) / (pixels - 2)
+    kept = np.empty((pixels, sources), dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = count - 1
+    a = kept[0]
+    for bucket in range(pixels - 2):
+        bucket_start = int(bucket * every) + 1
+        bucket_end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        # the mean of the next bucket is the third point of the triangle
+        next_count = valid[bucket_end:next_end].sum(axis=0)
+        next_x = x[bucket_end:next_end].mean()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            next_y = np.where(next_count > 0, filled[bucket_end:next_end].sum(axis=0) / next_count, np.nan)
+        x_a, y_a = x[a], values[a, columns]
+        area = np.abs((x_a - next_x) * (values[bucket_start:bucket_end] - y_a)
+                      - (x_a - x[bucket_start:bucket_end, None]) * (next_y - y_a))
+        a = bucket_start + np.argmax(np.where(np.isnan(area), -1.0, area), axis=0)
+        kept[bucket + 1] = a
+    if not gap.any():
+        return number, times[kept], values[kept, columns]
+    # every source keeps its own points; a point gets a NaN point before it when a gap lies between it and
+    # the point kept before it
+    gaps_before = np.cumsum(gap)[kept]
+    breaks = np.zeros(kept.shape, dtype=bool)
+    breaks[1:] = gaps_before[1:] > gaps_before[:-1]
+    point_times = np.empty((2 * pixels, sources), dtype=np.int64)
+    point_values = np.empty((2 * pixels, sources))
+    point_times[0::2] = point_times[1::2] = times[kept]
+    point_values[0::2] = np.where(breaks, np.nan, values[kept, columns])
+    point_values[1::2] = values[kept, columns]
+    # the first point of every pair is the break (NaN) or a repeat of the second one
+    return number, point_times, point_values
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Compiled log map cache
+Parsing the .xlsx log maps with pd.read_excel is slow, so every log map is compiled
+once into an uncompressed Feather (Arrow IPC) file holding its columns (in their
+original order), the resolved source paths and the externallogids. The file is
+named after the hash of the spreadsheet contents, so editing the spreadsheet
+invalidates it, and it is loaded with a memory map on the following runs
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from bms_metadata import METADATA_CACHE_DIR
+
+# Sub-directory of the cache directory holding the compiled log maps
+LOGMAP_CACHE_SUBDIR = 'logmaps'
+
+# Compiled log maps already loaded in this process, keyed by file, size, mtime and settings
+_compiled_logmap_memo = {}
+
+
+# Function to hash the contents of a file
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to read the log map spreadsheet and resolve its externallogids
+def compile_logmap(logmap_path, metadata_index, logmap_sheet, logmap_columns, logmap_var_loc, logmap_var_name):
+    """
+    Read a log map spreadsheet and resolve the source path and externallogids of every row.
+
+    Args:
+        logmap_path: Path to the .xlsx log map
+        metadata_index: Index returned by load_metadata_index
+        logmap_sheet: Name of the sheet containing the log map
+        logmap_columns: Columns to read from the sheet, e.g. 'A:D'
+        logmap_var_loc: Column name for variable location
+        logmap_var_name: Column name for variable name
+
+    Returns:
+        The log map DataFrame with the extra columns 'source' and 'externallogid' (list per row)
+    """
+    print(f"Compiling logmap {logmap_path}")
+    source_df = pd.read_excel(io=logmap_path, sheet_name=logmap_sheet, header=0, usecols=logmap_columns)
+    source_df['source'] = source_df[logmap_var_loc].astype(str) + '/' + source_df[logmap_var_name].astype(str)
+    source_df['externallogid'] = [list(metadata_index.get(source, [])) for source in source_df['source']]
+    return source_df
+
+# Function to write a compiled log map as an uncompressed Feather file
+def _write_compiled_logmap(cache_file, source_df, logmap_columns_order):
+    table_df = source_df.copy()
+    for column in logmap_columns_order:
+        if table_df[column].dtype == object:
+            # Excel columns can mix numbers and text; store them as text (keeping empty cells)
+            table_df[column] = table_df[column].where(table_df[column].isna(), table_df[column].astype(str))
+    table = pa.Table.from_pandas(table_df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           b'logmap_columns': json.dumps(logmap_columns_order).encode('utf-8')})
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = cache_file + '.tmp'
+    feather.write_feather(table, temp_file, compression='uncompressed')
+    os.replace(temp_file, cache_file)
+
+# Function to load a log map, using the compiled cache when possible
+def load_logmap(logmap_path, metadata_index, logmap_sheet='log_map', logmap_columns='A:D',
+                logmap_var_loc='Log_variable_location', logmap_var_name='Logged_variable_name',
+                cache_dir=METADATA_CACHE_DIR):
+    """
+    Load a log map with the externallogids of its rows, using the compiled cache when possible.
+
+    The compiled file is keyed by the hash of the spreadsheet contents and the read
+    settings. Its externallogids are checked against the current metadata index on
+    every load, and the file is rewritten when they changed.
+
+    Args:
+        logmap_path: Path to the .xlsx log map
+        metadata_index: Index returned by load_metadata_index
+        logmap_sheet: Name of the sheet containing the log map
+        logmap_columns: Columns to read from the sheet, e.g. 'A:D'
+        logmap_var_loc: Column name for variable location
+        logmap_var_name: Column name for variable name
+        cache_dir: Directory holding the cache
+
+    Returns:
+        Tuple (source_df, externallogid): the log map with an 'externallogid' column of lists
+        (empty for rows without a match), and the list of valid externallogid lists
+    """
+    settings = [logmap_sheet, logmap_columns, logmap_var_loc, logmap_var_name]
+    file_stat = os.stat(logmap_path)
+    memo_key = (os.path.abspath(logmap_path), file_stat.st_size, file_stat.st_mtime_ns, tuple(settings))
+
+    if memo_key in _compiled_logmap_memo:
+        source_df = _compiled_logmap_memo[memo_key]
+    else:
+        key = hashlib.sha1((_file_digest(logmap_path) + json.dumps(settings)).encode('utf-8')).hexdigest()[:20]
+        cache_file = os.path.join(cache_dir, LOGMAP_CACHE_SUBDIR, f"{key}.feather")
+        source_df = None
+        if os.path.exists(cache_file):
+            try:
+                table = feather.read_table(cache_file, memory_map=True)
+                logmap_columns_order = json.loads(table.schema.metadata[b'logmap_columns'])
+                source_df = table.to_pandas()[logmap_columns_order + ['source', 'externallogid']]
+                source_df['externallogid'] = [ids.tolist() for ids in source_df['externallogid']]
+                print(f"Using compiled logmap {cache_file}")
+            except (OSError, KeyError, ValueError, pa.ArrowInvalid) as e:
+                print(f"Ignoring unreadable compiled logmap {cache_file}: {e}")
+                source_df = None
+
+        if source_df is None:
+            source_df = compile_logmap(logmap_path, metadata_index, *settings)
+            logmap_columns_order = [c for c in source_df.columns if c not in ('source', 'externallogid')]
+            _write_compiled_logmap(cache_file, source_df, logmap_columns_order)
+        else:
+            # Re-resolve the rows whose externallogids changed in the metadata since the log map was compiled
+            current_ids = [list(metadata_index.get(source, [])) for source in source_df['source']]
+            if current_ids != source_df['externallogid'].tolist():
+                print("Metadata changed since the logmap was compiled, updating it")
+                source_df['externallogid'] = current_ids
+                logmap_columns_order = [c for c in source_df.columns if c not in ('source', 'externallogid')]
+                _write_compiled_logmap(cache_file, source_df, logmap_columns_order)
+        _compiled_logmap_memo[memo_key] = source_df
+
+    externallogid = []
+    for index, ids in zip(source_df.index, source_df['externallogid']):
+        if ids:
+            externallogid.append(ids)
+        else:
+            print(' '.join(['source_df index', str(index), 'failed']))
+    return source_df.drop(columns='source'), externallogid
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Chunk manifest for resumable and incremental BMS data extractions
+Downloaded chunks are kept in a persistent work directory together with a manifest
+of the (log map, interval, id shard) chunks that are complete, so an interrupted
+run only fetches the missing or failed chunks when it is started again
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+
+
+# Manifest of the chunks downloaded into a work directory
+class ChunkManifest:
+    """
+    Manifest of the chunks downloaded into a work directory.
+
+    Every finished chunk is appended as one JSON line to manifest.jsonl, so the
+    manifest survives a crash at any point. Later lines override earlier ones
+    for the same chunk key.
+
+    Args:
+        work_dir: Directory holding the chunk files and the manifest
+    """
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.manifest_file = os.path.join(work_dir, 'manifest.jsonl')
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash; that chunk is simply fetched again
+                        continue
+                    self.entries[entry['key']] = entry
+
+    @staticmethod
+    def chunk_key(logmap_name, interval, externallogid, sources=None):
+        """
+        Build the key of the chunk for one log map, time interval and id shard.
+
+        Compact chunks store source ids, which are positions in the source dictionary
+        (see bms_processing.source_dictionary). The dictionary is part of the key, so a
+        chunk is fetched again instead of being read with other ids once a source is
+        added to or removed from the log map.
+        """
+        ids = json.dumps(externallogid, default=str, sort_keys=True)
+        key = [logmap_name, str(interval[0]), str(interval[1]), hashlib.sha1(ids.encode('utf-8')).hexdigest()[:16]]
+        if sources is not None:
+            names = json.dumps([str(source) for source in sources])
+            key.append(hashlib.sha1(names.encode('utf-8')).hexdigest()[:16])
+        return '|'.join(key)
+
+    @staticmethod
+    def chunk_name(key):
+        """Build a file name (without extension) for the chunk with the given key."""
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    def is_done(self, key):
+        """Return True if the chunk was downloaded (or found empty) and its file still exists."""
+        entry = self.entries.get(key)
+        if entry is None or entry['status'] not in ('ok', 'empty'):
+            return False
+        return entry['path'] is None or os.path.exists(entry['path'])
+
+    def chunk_path(self, key):
+        """Return the chunk file of a finished chunk, None if it was empty."""
+        return self.entries[key]['path']
+
+    def record(self, key, status, path=None, rows=0):
+        """
+        Record the outcome of a chunk.
+
+        Args:
+            key: Chunk key (see chunk_key)
+            status: 'ok', 'empty' or 'failed'
+            path: Path to the chunk file for 'ok' chunks
+            rows: Number of rows in the chunk
+        """
+        entry = {'key': key, 'status': status, 'path': path, 'rows': rows}
+        with self._lock:
+            self.entries[key] = entry
+            with open(self.manifest_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def failed_keys(self):
+        """Return the keys of the chunks whose last attempt failed."""
+        return [key for key, entry in self.entries.items() if entry['status'] == 'failed']
+
+# Function to create (or reopen) the persistent work directory of an extraction
+def create_work_dir(work_location, logmap_name, starttime):
+    """
+    Create (or reopen) the persistent work directory of an extraction.
+
+    The directory is named after the log map and the start time, so a re-run of
+    the same extraction (even with a later end time) finds its earlier chunks.
+
+    Args:
+        work_location: Directory holding all work directories
+        logmap_name: Name of the log map
+        starttime: Start time of the extraction
+
+    Returns:
+        Path to the work directory
+    """
+    work_dir = os.path.join(work_location, f"{logmap_name}_{starttime:%Y%m%d%H%M}")
+    os.makedirs(work_dir, exist_ok=True)
+    print(f"Using work directory: {work_dir}")
+    return work_dir
+
+# Function to read the last timestamp of a saved CSV dataset
+def read_last_timestamp(csv_path):
+    """
+    Read the last timestamp of a saved CSV dataset, without reading the whole file.
+
+    Args:
+        csv_path: Path to a CSV file with the time in the first column
+
+    Returns:
+        The last timestamp as a pandas Timestamp, or None if the file has no data rows
+    """
+    if not os.path.exists(csv_path):
+        return None
+    with open(csv_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''
+        # Read backwards in blocks until the tail holds a complete last line
+        while position > 0 and tail.rstrip(b'\r\n').count(b'\n') < 1:
+            step = min(65536, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+    lines = tail.decode('utf-8').strip().splitlines()
+    if len(lines) < 2 and position == 0:
+        # Only a header line
+        return None
+    return pd.Timestamp(lines[-1].split(',', 1)[0])
+
+# Function to append newly extracted rows to a saved CSV dataset
+def append_to_csv_dataset(csv_path, new_trend_data_df):
+    """
+    Append newly extracted rows to a saved CSV dataset.
+
+    Rows at or before the last saved timestamp are skipped. When the saved columns
+    include every new column, the rows are appended to the file in the saved column
+    order; otherwise (e.g. the log map gained a variable) the dataset is rewritten
+    with the union of the columns.
+
+    Args:
+        csv_path: Path to the saved CSV dataset
+        new_trend_data_df: Wide DataFrame indexed by time, as saved by the extraction scripts
+    """
+    last_timestamp = read_last_timestamp(csv_path)
+    if last_timestamp is not None:
+        new_trend_data_df = new_trend_data_df[new_trend_data_df.index > last_timestamp]
+    if new_trend_data_df.empty:
+        print(f"No new rows to append to {csv_path}")
+        return
+
+    saved_columns = pd.read_csv(csv_path, nrows=0, index_col=0).columns.tolist()
+    if set(new_trend_data_df.columns) <= set(saved_columns):
+        new_trend_data_df.reindex(columns=saved_columns).to_csv(csv_path, mode='a', header=False)
+    else:
+        print(f"Columns changed, rewriting {csv_path}")
+        saved_df = pd.read_csv(csv_path, index_col=0)
+        # A file spanning a DST change holds mixed UTC offsets, which only parse through UTC
+        tz = new_trend_data_df.index.tz
+        saved_index = pd.to_datetime(saved_df.index, utc=tz is not None)
+        saved_df.index = saved_index.tz_convert(tz).rename(saved_df.index.name) if tz is not None else saved_index
+        combined_df = pd.concat([saved_df, new_trend_data_df], axis=0)
+        combined_df = combined_df[~combined_df.index.duplicated(keep='first')]
+        combined_df.sort_index(inplace=True)
+        combined_df.to_csv(csv_path)
+    print(f"Appended {len(new_trend_data_df)} rows to {csv_path}")
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Out-of-core merge of downloaded chunk files into the final wide table
+Every chunk is first sorted by time into a run file on disk; the runs are then
+k-way merged in time order while only a bounded slice of each overlapping run is
+held in memory, and the wide table comes out block by block. The peak memory
+depends on the memory budget and the number of overlapping chunks (id shards),
+not on the length of the extracted time range. Chunks and runs hold compact records
+(see bms_processing.label_trend_data_compact)
+"""
+
+import collections
+import os
+import shutil
+
+import pandas as pd
+import pyarrow.parquet as pq
+from tqdm import tqdm  # For progress bars
+
+from bms_processing import pivot_compact_to_wide, read_compact_chunk_tz
+
+# Approximate memory budget (MB) of the merge, and estimated in-memory size of one compact record
+MERGE_MEMORY_BUDGET_MB = 512
+MERGE_BYTES_PER_ROW = 32
+# Smallest number of rows read from a run at once
+MIN_RUN_BATCH_ROWS = 1024
+
+
+# Sorted run file, read in bounded batches during the merge
+class _SortedRun:
+
+    def __init__(self, path, batch_rows, chunk_index):
+        self.chunk_index = chunk_index
+        self._batches = pq.ParquetFile(path).iter_batches(batch_size=batch_rows)
+        self.buffer = None
+        self.exhausted = False
+
+    def fill(self):
+        """Read the next batch of the run into the buffer (until rows arrive or the run ends)."""
+        while not self.exhausted:
+            try:
+                batch_df = next(self._batches).to_pandas()
+            except StopIteration:
+                self.exhausted = True
+                return
+            if batch_df.empty:
+                continue
+            self.buffer = batch_df if self.buffer is None else pd.concat([self.buffer, batch_df], ignore_index=True)
+            return
+
+    def last_time(self):
+        """Return the last (largest) minute in the buffer, None if the buffer is empty."""
+        return self.buffer['minute'].iloc[-1] if self.buffer is not None else None
+
+    def take_before(self, watermark):
+        """Remove and return the buffered rows before the watermark (all rows if it is None)."""
+        if self.buffer is None:
+            return None
+        if watermark is None:
+            taken, self.buffer = self.buffer, None
+            return taken
+        split = self.buffer['minute'].searchsorted(watermark, side='left')
+        taken = self.buffer.iloc[:split]
+        self.buffer = self.buffer.iloc[split:].reset_index(drop=True) if split < len(self.buffer) else None
+        return taken if len(taken) else None
+
+# Function to sort one chunk file by time into a run file
+def sort_chunk_file(chunk_path, run_path, source_ids=None):
+    """
+    Sort one chunk file by minute into a run file.
+
+    The first reading of every (source, minute) is kept before the stable sort, so
+    the first-value rule of the extraction scripts is kept within the chunk.
+
+    Args:
+        chunk_path: Path to a compact chunk file ('source_id', 'minute' and 'value' columns)
+        run_path: Path to write the sorted run file to
+        source_ids: Optional source ids to project a shared chunk onto (the other sources are dropped)
+
+    Returns:
+        (source ids in order of first appearance, first minute, last minute), or None if the chunk is empty
+    """
+    run_df = pd.read_parquet(chunk_path, columns=['source_id', 'minute', 'value'])
+    if source_ids is not None:
+        run_df = run_df[run_df['source_id'].isin(source_ids)]
+    if run_df.empty:
+        return None
+    run_df = run_df.drop_duplicates(subset=['source_id', 'minute'], keep='first')
+    sources = pd.unique(run_df['source_id']).tolist()
+    run_df = run_df.sort_values('minute', kind='stable', ignore_index=True)
+    run_df.to_parquet(run_path, index=False, row_group_size=65536)
+    return sources, run_df['minute'].iloc[0], run_df['minute'].iloc[-1]
+
+# Function to find the largest number of runs that overlap in time
+def _max_overlap(time_ranges):
+    events = sorted([(first, 0) for first, _ in time_ranges] + [(last, 1) for _, last in time_ranges])
+    overlap = max_overlap = 0
+    for _, is_end in events:
+        overlap += -1 if is_end else 1
+        max_overlap = max(max_overlap, overlap)
+    return max_overlap
+
+# Function to merge chunk files into the final wide table, block by block
+def merge_chunk_files(temp_files, na_drop_setting, run_dir, sources, memory_budget_mb=None, source_ids=None):
+    """
+    Merge chunk files into the final wide time x source table, block by block.
+
+    The blocks come out in time order, never share a minute and all have the same
+    columns (every source, in order of first appearance over the chunks), so they
+    can be written one after the other. Minutes that occur in several chunks keep
+    the first value in chunk order, as with a merge in memory.
+
+    Args:
+        temp_files: List of paths to chunk files, in chunk order
+        na_drop_setting: Setting for dropping NA values ('all' or 'any')
+        run_dir: Directory for the sorted run files (removed when the merge ends)
+        sources: Source dictionary of the chunks (see bms_processing.source_dictionary)
+        memory_budget_mb: Approximate memory budget (MB) of the merge
+        source_ids: Optional source ids to project shared chunks onto (see sort_chunk_file)
+
+    Yields:
+        Wide DataFrames indexed by 'time' with one column per source
+    """
+    if memory_budget_mb is None:
+        memory_budget_mb = MERGE_MEMORY_BUDGET_MB
+    budget_rows = max(MIN_RUN_BATCH_ROWS, int(memory_budget_mb * 1024 * 1024 / MERGE_BYTES_PER_ROW))
+    os.makedirs(run_dir, exist_ok=True)
+
+    try:
+        # Sort every chunk into a run file and collect the source order
+        runs = []
+        source_order = {}
+        tz_string = None
+        for chunk_index, chunk_path in enumerate(tqdm(temp_files, desc="Sorting chunks")):
+            run_path = os.path.join(run_dir, f"run_{chunk_index}.parquet")
+            sorted_run = sort_chunk_file(chunk_path, run_path, source_ids)
+            if sorted_run is None:
+                continue
+            if not runs:
+                tz_string = read_compact_chunk_tz(chunk_path)
+            run_sources, first_time, last_time = sorted_run
+            for source_id in run_sources:
+                source_order.setdefault(source_id, len(source_order))
+            runs.append((first_time, last_time, chunk_index, run_path))
+        if not runs:
+            return
+        columns = [sources[source_id] for source_id in sorted(source_order, key=source_order.get)]
+
+        # Split the budget over the runs that are open at the same time
+        batch_rows = max(MIN_RUN_BATCH_ROWS, budget_rows // (2 * _max_overlap([r[:2] for r in runs])))
+        pending = collections.deque(sorted(runs, key=lambda r: (r[0], r[2])))
+        active = []
+        long_parts = []
+        long_rows = 0
+
+        def wide_block(parts):
+            block_df = pivot_compact_to_wide(pd.concat(parts, ignore_index=True), sources, tz_string)
+            block_df = block_df.reindex(columns=columns)
+            block_df.dropna(how=na_drop_setting, inplace=True)
+            block_df.sort_index(inplace=True)
+            return block_df
+
+        progress = tqdm(total=len(runs), desc="Merging sorted chunks")
+        while pending or active:
+            # Open the runs that start before the data buffered so far ends
+            buffered_until = min((run.last_time() for run in active if run.buffer is not None), default=None)
+            while pending and (buffered_until is None or pending[0][0] <= buffered_until):
+                _, _, chunk_index, run_path = pending.popleft()
+                run = _SortedRun(run_path, batch_rows, chunk_index)
+                run.fill()
+                active.append(run)
+                active.sort(key=lambda r: r.chunk_index)
+                if run.buffer is not None:
+                    last_time = run.last_time()
+                    buffered_until = last_time if buffered_until is None else min(buffered_until, last_time)
+
+            # Every row before the watermark is buffered already: no run still to be read can reach it
+            candidates = [run.last_time() for run in active if not run.exhausted and run.buffer is not None]
+            if pending:
+                candidates.append(pending[0][0])
+            watermark = min(candidates) if candidates else None
+
+            # Take the finished rows in chunk order, so the first value per minute wins
+            for run in active:
+                part = run.take_before(watermark)
+                if part is not None:
+                    long_parts.append(part)
+                    long_rows += len(part)
+            if long_rows >= budget_rows // 2:
+                yield wide_block(long_parts)
+                long_parts = []
+                long_rows = 0
+
+            for run in active:
+                if run.exhausted and run.buffer is None:
+                    progress.update(1)
+                elif run.buffer is None or run.last_time() == watermark:
+                    run.fill()
+            active = [run for run in active if not (run.exhausted and run.buffer is None)]
+        progress.close()
+
+        if long_parts:
+            yield wide_block(long_parts)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Persistent cache for the BMS /metadata endpoint
+The metadata payload is stored on disk as a prebuilt source -> externallogid index,
+so repeated runs (and runs over several log maps) do not download or scan it again
+"""
+
+import datetime as dt
+import io
+import json
+import os
+
+import pandas as pd
+import requests
+
+# Default location and time-to-live of the on-disk metadata cache
+METADATA_CACHE_DIR = "./.bms_cache"
+METADATA_CACHE_TTL = dt.timedelta(hours=24)
+
+# Indexes already loaded in this process, keyed by metadata URL
+_metadata_index_memo = {}
+
+
+# Function to read the cached metadata index from disk
+def _read_metadata_cache(cache_file):
+    """
+    Read the cached metadata index from disk.
+
+    Args:
+        cache_file: Path to the cache file
+
+    Returns:
+        The cache contents as a dict, or None if there is no usable cache
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable metadata cache {cache_file}: {e}")
+        return None
+
+# Function to write the metadata index to disk
+def _write_metadata_cache(cache_file, cache):
+    """
+    Write the metadata index to disk (atomically, via a temporary file).
+
+    Args:
+        cache_file: Path to the cache file
+        cache: Cache contents to write
+    """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = cache_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f)
+    os.replace(temp_file, cache_file)
+
+# Function to build the source -> externallogid index from a metadata payload
+def build_metadata_index(trend_meta_df):
+    """
+    Build the source -> externallogid index from a metadata payload.
+
+    Args:
+        trend_meta_df: DataFrame with (at least) the columns 'source' and 'externallogid'
+
+    Returns:
+        Dict mapping every source path to the list of its externallogid
+    """
+    metadata_index = {}
+    for source, externallogid in zip(trend_meta_df['source'].tolist(), trend_meta_df['externallogid'].tolist()):
+        metadata_index.setdefault(source, []).append(externallogid)
+    return metadata_index
+
+# Function to load the source -> externallogid index, using the on-disk cache when possible
+def load_metadata_index(metadata_url, auth, cache_dir=METADATA_CACHE_DIR, ttl=METADATA_CACHE_TTL,
+                        session=None):
+    """
+    Load the source -> externallogid index for the metadata endpoint.
+
+    A cache younger than the TTL is used as is. An older cache is refreshed with a
+    conditional request (ETag / Last-Modified), so an unchanged payload is not
+    downloaded again. If the refresh fails, the stale cache is used.
+
+    Args:
+        metadata_url: URL of the metadata endpoint
+        auth: (username, password) tuple for the API
+        cache_dir: Directory holding the cache file
+        ttl: Maximum age (timedelta) of the cache before it is revalidated
+        session: Optional requests.Session to use for the download
+
+    Returns:
+        Dict mapping every source path to the list of its externallogid
+    """
+    if metadata_url in _metadata_index_memo:
+        return _metadata_index_memo[metadata_url]
+
+    cache_file = os.path.join(cache_dir, 'metadata_index.json')
+    cache = _read_metadata_cache(cache_file)
+    if cache is not None and cache.get('url') != metadata_url:
+        cache = None
+
+    now = dt.datetime.now()
+    if cache is not None:
+        fetched_at = dt.datetime.fromisoformat(cache['fetched_at'])
+        if now - fetched_at < ttl:
+            print(f"Using cached metadata from {cache_file} (fetched {cache['fetched_at']})")
+            _metadata_index_memo[metadata_url] = cache['index']
+            return cache['index']
+
+    headers = {}
+    if cache is not None:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+
+    print("Fetching metadata...")
+    http = session if session is not None else requests
+    try:
+        trend_meta = http.get(url=metadata_url, auth=auth, headers=headers)
+        print("Metadata status code: ", trend_meta.status_code)
+        if trend_meta.status_code == 304 and cache is not None:
+            print("Metadata unchanged since the last download")
+            cache['fetched_at'] = now.isoformat()
+            _write_metadata_cache(cache_file, cache)
+            _metadata_index_memo[metadata_url] = cache['index']
+            return cache['index']
+        trend_meta.raise_for_status()
+        trend_meta_df = pd.read_json(io.StringIO(trend_meta.text), orient='records')
+    except (requests.RequestException, ValueError) as e:
+        if cache is None:
+            raise
+        print(f"Metadata refresh failed ({e}), using the cached metadata from {cache['fetched_at']}")
+        _metadata_index_memo[metadata_url] = cache['index']
+        return cache['index']
+
+    print("Metadata columns: ", trend_meta_df.columns)
+    cache = {
+        'url': metadata_url,
+        'fetched_at': now.isoformat(),
+        'etag': trend_meta.headers.get('ETag'),
+        'last_modified': trend_meta.headers.get('Last-Modified'),
+        'index': build_metadata_index(trend_meta_df),
+    }
+    _write_metadata_cache(cache_file, cache)
+    _metadata_index_memo[metadata_url] = cache['index']
+    return cache['index']
+
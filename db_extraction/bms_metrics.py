@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Per-request metrics and stage timings for extraction runs
+Every trend data request records its latency, response bytes, row count, retries
+and queue wait, and the extraction stages (metadata, fetch, parse, label, write,
+merge) add up the time spent in them. The records are exported as JSON lines and
+summarised with a latency histogram, to tune MAX_WORKERS and timestep from data
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+# Upper bounds (in seconds) of the buckets of the latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Stages of an extraction, in pipeline order
+STAGES = ('metadata', 'fetch', 'parse', 'label', 'write', 'merge')
+
+
+# Function to compute a percentile of a sorted list
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+# Recorder of the per-request metrics and stage timings of a run
+class MetricsRecorder:
+    """Thread-safe recorder of the per-request metrics and stage timings of an extraction run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far (e.g. at the start of a new log map)."""
+        with self._lock:
+            self.requests = []
+            self.stage_seconds = {}
+            self.stage_counts = {}
+            self.started = time.perf_counter()
+
+    def record_request(self, starttime, endtime, latency, response_bytes=None, rows=None, retries=0,
+                       queue_wait=0.0, error=None):
+        """
+        Record one trend data request.
+
+        Args:
+            starttime: Start of the requested interval
+            endtime: End of the requested interval
+            latency: Seconds from sending the request until the body was read (including retries)
+            response_bytes: Size of the response body as received, None if unknown
+            rows: Number of rows in the response, None if unknown
+            retries: Number of retries before the request succeeded (or gave up)
+            queue_wait: Seconds the request waited for a worker before it was sent
+            error: Exception of a failed request
+        """
+        request = {
+            'starttime': str(starttime),
+            'endtime': str(endtime),
+            'latency_s': round(latency, 4),
+            'bytes': response_bytes,
+            'rows': rows,
+            'retries': retries,
+            'queue_wait_s': round(queue_wait, 4),
+            'error': str(error) if error is not None else None,
+        }
+        with self._lock:
+            self.requests.append(request)
+
+    def add_stage_time(self, stage, seconds):
+        """Add the time spent in one pass through a stage."""
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+            self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Context manager timing the code inside it as one pass through a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Summarise the recorded metrics.
+
+        Returns:
+            Dict with the request totals, latency percentiles and histogram, and the stage timings
+        """
+        with self._lock:
+            requests = list(self.requests)
+            stage_seconds = dict(self.stage_seconds)
+            stage_counts = dict(self.stage_counts)
+            wall_time = time.perf_counter() - self.started
+
+        latencies = sorted(request['latency_s'] for request in requests)
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in latencies:
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if latency <= bound), len(LATENCY_BUCKETS))
+            histogram[bucket] += 1
+        stages = sorted(stage_seconds, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES))
+        return {
+            'wall_time_s': round(wall_time, 3),
+            'requests': len(requests),
+            'failed_requests': sum(1 for request in requests if request['error'] is not None),
+            'retries': sum(request['retries'] or 0 for request in requests),
+            'bytes': sum(request['bytes'] or 0 for request in requests),
+            'rows': sum(request['rows'] or 0 for request in requests),
+            'queue_wait_s': round(sum(request['queue_wait_s'] for request in requests), 3),
+            'latency_p50_s': _percentile(latencies, 0.50),
+            'latency_p90_s': _percentile(latencies, 0.90),
+            'latency_p99_s': _percentile(latencies, 0.99),
+            'latency_histogram': [{'le': bound, 'count': count}
+                                  for bound, count in zip(list(LATENCY_BUCKETS) + ['inf'], histogram)],
+            'stages': [{'stage': stage, 'seconds': round(stage_seconds[stage], 3), 'count': stage_counts[stage]}
+                       for stage in stages],
+        }
+
+    def print_summary(self):
+        """Print the request totals, a latency histogram and the time spent per stage."""
+        summary = self.summary()
+        if summary['requests']:
+            print(f"\n{summary['requests']} requests ({summary['failed_requests']} failed, "
+                  f"{summary['retries']} retries), {summary['rows']} rows, {summary['bytes'] / 1e6:.1f} MB, "
+                  f"{summary['queue_wait_s']:.1f} s queue wait")
+            print(f"Latency p50 {summary['latency_p50_s']:.2f} s, p90 {summary['latency_p90_s']:.2f} s, "
+                  f"p99 {summary['latency_p99_s']:.2f} s")
+            largest = max(bucket['count'] for bucket in summary['latency_histogram'])
+            for bucket in summary['latency_histogram']:
+                if bucket['count']:
+                    print(f"  <= {bucket['le']:>5} s {bucket['count']:>7} {'#' * max(1, 40 * bucket['count'] // largest)}")
+        if summary['stages']:
+            # Stage times are summed over all workers, so they can add up to more than the wall time
+            print(f"Time per stage (summed over workers, wall time {summary['wall_time_s']:.1f} s):")
+            for stage in summary['stages']:
+                print(f"  {stage['stage']:<9} {stage['seconds']:>10.2f} s in {stage['count']} passes")
+
+    def save(self, path):
+        """Write every request, the stage timings and the summary to a JSON lines file."""
+        summary = self.summary()
+        with self._lock:
+            requests = list(self.requests)
+        with open(path, 'w', encoding='utf-8') as f:
+            for request in requests:
+                f.write(json.dumps({'type': 'request', **request}) + '\n')
+            for stage in summary['stages']:
+                f.write(json.dumps({'type': 'stage', **stage}) + '\n')
+            f.write(json.dumps({'type': 'summary', **summary}) + '\n')
+        print(f"Metrics saved to {path}")
+
+# Recorder shared by every worker of the process
+metrics = MetricsRecorder()
+
+
+# Function to get the size of a requests response body as received
+def response_size(response):
+    """Return the number of body bytes received for a requests.Response, None if unknown."""
+    raw = getattr(response, 'raw', None)
+    if raw is not None and hasattr(raw, 'tell'):
+        try:
+            return raw.tell()
+        except (OSError, ValueError):
+            pass
+    content_length = response.headers.get('Content-Length')
+    return int(content_length) if content_length and content_length.isdigit() else None
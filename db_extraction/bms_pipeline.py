@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Pipelined fetch -> parse -> write extraction
+I/O threads only download raw response bodies, a process pool decodes and labels
+them (outside the GIL of the main process), and a writer stage persists the chunk
+files. The stages are connected by bounded queues, so a slow stage holds back the
+ones before it instead of letting memory grow, and every stage is sized on its own
+"""
+
+import concurrent.futures
+import io
+import os
+import queue
+import threading
+import time
+
+import pandas as pd
+from tqdm import tqdm  # For progress bars
+
+from bms_fetching import REQUEST_TIMEOUT, get_thread_session, trend_data_params
+from bms_metrics import metrics
+from bms_processing import decode_trend_data_stream, label_trend_data_compact, write_compact_chunk
+from bms_scheduling import get_with_retries
+
+# Marker put on a queue when the stage feeding it has finished
+_STAGE_DONE = object()
+
+# Source lookup of the current parse worker process (set by _init_parse_worker)
+_worker_source_lookup = None
+
+
+# Function run once in every parse worker process
+def _init_parse_worker(source_lookup):
+    global _worker_source_lookup
+    _worker_source_lookup = source_lookup
+
+# Function decoding and labelling one raw response body in a parse worker process
+# (returns the response row count and the parse and label times, for the metrics of the main process)
+def _parse_in_worker(raw_body):
+    parse_start = time.perf_counter()
+    trend_data_df = decode_trend_data_stream(io.BytesIO(raw_body))
+    label_start = time.perf_counter()
+    if trend_data_df.empty:
+        return pd.DataFrame(), 0, label_start - parse_start, 0.0
+    result_df = label_trend_data_compact(trend_data_df, _worker_source_lookup)
+    return result_df, len(trend_data_df), label_start - parse_start, time.perf_counter() - label_start
+
+# Function to run the pipelined extraction of a list of work items
+def run_extraction_pipeline(work_items, id_shards, source_lookup, auth, trenddata_url, temp_dir,
+                            chunk_names=None, fetch_workers=8, parse_processes=None, queue_size=16,
+                            on_complete=None, failure_report=None):
+    """
+    Run the pipelined fetch -> parse -> write extraction of a list of work items.
+
+    Args:
+        work_items: List of (interval, shard_index) work items (see build_work_items)
+        id_shards: List of externallogid shards (see shard_externallogid)
+        source_lookup: Shared externallogid -> source lookup (see build_source_lookup)
+        auth: (username, password) tuple for the API
+        trenddata_url: URL of the trenddata endpoint
+        temp_dir: Directory to save the chunk files in
+        chunk_names: Optional names used instead of the work item index in the chunk file names
+        fetch_workers: Number of I/O threads downloading response bodies
+        parse_processes: Number of processes decoding and labelling bodies (defaults to the CPU count)
+        queue_size: Capacity of each queue between two stages
+        on_complete: Optional callback (index, chunk_path, row_count, error) called when a work item finishes
+        failure_report: Optional FailureReport collecting the work items that still failed
+
+    Returns:
+        List with one entry per work item: the chunk file path, or None if it had no data or failed
+    """
+    if parse_processes is None:
+        parse_processes = os.cpu_count() or 1
+    results = [None] * len(work_items)
+
+    work_queue = queue.Queue()
+    for idx in range(len(work_items)):
+        work_queue.put(idx)
+    raw_queue = queue.Queue(maxsize=queue_size)
+    parsed_queue = queue.Queue(maxsize=queue_size)
+
+    def finish(idx, chunk_path, row_count, error):
+        results[idx] = chunk_path
+        if error is not None:
+            interval, shard_index = work_items[idx]
+            print(f"Error fetching data for interval {interval[0]} to {interval[1]}: {error}")
+            if failure_report is not None:
+                failure_report.add(interval[0], interval[1], id_shards[shard_index], error)
+        if on_complete is not None:
+            on_complete(idx, chunk_path, row_count, error)
+        progress.update(1)
+
+    # Stage 1: I/O threads download the raw response bodies
+    def fetch_stage():
+        session = get_thread_session(fetch_workers)
+        while True:
+            try:
+                idx = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            interval, shard_index = work_items[idx]
+            request_start = time.perf_counter()
+            try:
+                with metrics.stage('fetch'):
+                    response = get_with_retries(session, trenddata_url,
+                                                params=trend_data_params(interval[0], interval[1],
+                                                                         id_shards[shard_index]),
+                                                auth=auth, timeout=REQUEST_TIMEOUT)
+                    raw_body = response.content
+                request = {'latency': time.perf_counter() - request_start, 'bytes': len(raw_body),
+                           'retries': getattr(response, 'retries', 0), 'queued_at': time.perf_counter()}
+                raw_queue.put((idx, raw_body, None, request))
+            except Exception as e:
+                metrics.record_request(interval[0], interval[1], time.perf_counter() - request_start,
+                                       retries=getattr(e, 'retries', 0), error=e)
+                raw_queue.put((idx, None, e, None))
+
+    # Stage 2: hand the bodies to the process pool, in arrival order
+    def parse_stage(executor):
+        while True:
+            item = raw_queue.get()
+            if item is _STAGE_DONE:
+                parsed_queue.put(_STAGE_DONE)
+                return
+            idx, raw_body, error, request = item
+            if error is not None:
+                parsed_queue.put((idx, None, error, request))
+            else:
+                # The time a body waited for the parse stage is recorded as its queue wait
+                request['queue_wait'] = time.perf_counter() - request['queued_at']
+                # The bounded parsed_queue limits how many bodies are being parsed at once
+                parsed_queue.put((idx, executor.submit(_parse_in_worker, raw_body), None, request))
+
+    with tqdm(total=len(work_items), desc="Pipelined extraction") as progress, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes, initializer=_init_parse_worker,
+                                                   initargs=(source_lookup,)) as executor:
+        fetch_threads = [threading.Thread(target=fetch_stage, daemon=True) for _ in range(fetch_workers)]
+        for thread in fetch_threads:
+            thread.start()
+        parse_thread = threading.Thread(target=parse_stage, args=(executor,), daemon=True)
+        parse_thread.start()
+
+        def close_fetch_stage():
+            for thread in fetch_threads:
+                thread.join()
+            raw_queue.put(_STAGE_DONE)
+        threading.Thread(target=close_fetch_stage, daemon=True).start()
+
+        # Stage 3: the writer (this thread) persists the parsed chunks
+        while True:
+            item = parsed_queue.get()
+            if item is _STAGE_DONE:
+                break
+            idx, future, error, request = item
+            if error is not None:
+                finish(idx, None, 0, error)
+                continue
+            try:
+                result_df, response_rows, parse_seconds, label_seconds = future.result()
+                interval = work_items[idx][0]
+                metrics.add_stage_time('parse', parse_seconds)
+                metrics.add_stage_time('label', label_seconds)
+                metrics.record_request(interval[0], interval[1], request['latency'], request['bytes'],
+                                       response_rows, request['retries'], request['queue_wait'])
+                if result_df.empty:
+                    print(f"No data found for interval {interval[0]} to {interval[1]}")
+                    finish(idx, None, 0, None)
+                    continue
+                name = chunk_names[idx] if chunk_names is not None else idx
+                chunk_path = os.path.join(temp_dir, f"chunk_{name}.parquet")
+                with metrics.stage('write'):
+                    write_compact_chunk(result_df, chunk_path)
+                finish(idx, chunk_path, len(result_df), None)
+            except Exception as e:
+                finish(idx, None, 0, e)
+        parse_thread.join()
+
+    return results
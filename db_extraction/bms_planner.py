@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Dry-run planner and cost estimator for extractions
+A few probe requests spread over the proposed time range measure the data density
+(rows per source per minute), the response size per row and the latency of the
+server. From these the planner estimates the request count, rows, bytes, wall time
+and peak memory of an extraction, and recommends the number of workers and the
+timestep that are fastest within a memory budget (e.g. the SLURM --mem limit)
+"""
+
+import datetime as dt
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from bms_fetching import REQUEST_TIMEOUT, get_thread_session, shard_externallogid, trend_data_params
+from bms_metrics import response_size
+from bms_processing import decode_trend_data_stream
+from bms_scheduling import get_with_retries
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows
+    resource = None
+
+# Number of probe requests and the fractions of the timestep they span (varied to fit the latency per row)
+PROBE_COUNT = 3
+PROBE_SPAN_FRACTIONS = (0.25, 0.5, 1.0)
+# Estimated memory (bytes) of one row of a response while it is decoded and labelled
+PARSE_BYTES_PER_ROW = 120
+# Estimated memory (bytes) of one compact record held in memory, including the concat and pivot copies
+IN_MEMORY_BYTES_PER_ROW = 64
+# Share of the memory budget the plan may use (the rest is headroom for the Python heap and pandas copies)
+MEMORY_HEADROOM = 0.8
+# Candidate settings searched by recommend_settings
+CANDIDATE_WORKERS = (1, 2, 4, 8, 12, 16, 24, 32)
+CANDIDATE_TIMESTEPS = (dt.timedelta(hours=1), dt.timedelta(hours=2), dt.timedelta(hours=4),
+                       dt.timedelta(hours=6), dt.timedelta(hours=10), dt.timedelta(hours=12),
+                       dt.timedelta(days=1), dt.timedelta(days=2), dt.timedelta(days=4),
+                       dt.timedelta(days=7))
+
+
+# Function to read the memory limit of the current SLURM job
+def slurm_memory_budget_mb():
+    """
+    Return the memory limit (MB) of the current SLURM job (--mem or --mem-per-cpu), None outside SLURM.
+    """
+    mem_per_node = os.getenv('SLURM_MEM_PER_NODE')
+    if mem_per_node and mem_per_node.isdigit():
+        return int(mem_per_node)
+    mem_per_cpu = os.getenv('SLURM_MEM_PER_CPU')
+    cpus = os.getenv('SLURM_CPUS_ON_NODE') or os.getenv('SLURM_CPUS_PER_TASK') or '1'
+    if mem_per_cpu and mem_per_cpu.isdigit() and cpus.isdigit():
+        return int(mem_per_cpu) * int(cpus)
+    return None
+
+# Function to get the peak memory of this process so far (an assumed 200 MB where it cannot be measured)
+def _process_peak_rss_mb():
+    if resource is None:
+        return 200.0
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+# Function to send the probe requests of a proposed extraction
+def probe_extraction(starttime, endtime, externallogid, timestep, auth, trenddata_url, id_shard_size=None,
+                     probe_count=PROBE_COUNT, session=None):
+    """
+    Send a few probe requests spread over the time range and measure the server.
+
+    Every probe asks for the first id shard over a fraction of the timestep
+    (PROBE_SPAN_FRACTIONS), so the latency can be split into a fixed part and a
+    part per row.
+
+    Args:
+        starttime: Start time of the proposed extraction
+        endtime: End time of the proposed extraction
+        externallogid: List of external log IDs (or lists of IDs) to fetch
+        timestep: Proposed timestep
+        auth: (username, password) tuple for the API
+        trenddata_url: URL of the trenddata endpoint
+        id_shard_size: Proposed ID_SHARD_SIZE (None sends all ids at once)
+        probe_count: Number of probe requests
+        session: requests.Session to use (defaults to the session of the current thread)
+
+    Returns:
+        Dict with the measured 'rows_per_source_minute', 'bytes_per_row', 'latency_base_s',
+        'latency_per_row_s' and the list of 'probes'
+    """
+    if session is None:
+        session = get_thread_session()
+    shard = shard_externallogid(externallogid, id_shard_size)[0]
+    span_limit = endtime - starttime
+    probes = []
+    for i in range(probe_count):
+        span = min(timestep * PROBE_SPAN_FRACTIONS[i % len(PROBE_SPAN_FRACTIONS)], span_limit)
+        # Spread the probes evenly over the range (data density often changes over the years)
+        probe_start = starttime + (span_limit - span) * ((i + 0.5) / probe_count)
+        probe_start = probe_start.replace(second=0, microsecond=0)
+        probe_end = probe_start + span
+        print(f"Probing {probe_start} to {probe_end}")
+        request_start = time.perf_counter()
+        response = get_with_retries(session, trenddata_url, params=trend_data_params(probe_start, probe_end, shard),
+                                    auth=auth, timeout=REQUEST_TIMEOUT, stream=True)
+        try:
+            response.raw.decode_content = True
+            rows = len(decode_trend_data_stream(response.raw))
+            response_bytes = response_size(response)
+        finally:
+            response.close()
+        probes.append({'starttime': probe_start, 'endtime': probe_end, 'sources': len(shard), 'rows': rows,
+                       'bytes': response_bytes, 'latency_s': time.perf_counter() - request_start})
+
+    source_minutes = sum(p['sources'] * (p['endtime'] - p['starttime']).total_seconds() / 60 for p in probes)
+    rows = sum(p['rows'] for p in probes)
+    sized = [p for p in probes if p['bytes'] is not None]
+    sized_rows = sum(p['rows'] for p in sized)
+    latencies = np.array([p['latency_s'] for p in probes])
+    row_counts = np.array([p['rows'] for p in probes], dtype=float)
+    if len(set(row_counts)) > 1:
+        # Least squares fit latency = base + per_row * rows (a negative slope means noise, not a trend)
+        per_row, base = np.polyfit(row_counts, latencies, 1)
+        per_row = max(per_row, 0.0)
+        base = max(float(np.mean(latencies - per_row * row_counts)), 0.0)
+    else:
+        per_row, base = 0.0, float(np.mean(latencies))
+    return {
+        'rows_per_source_minute': rows / source_minutes if source_minutes else 0.0,
+        'bytes_per_row': sum(p['bytes'] for p in sized) / sized_rows if sized_rows else None,
+        'latency_base_s': float(base),
+        'latency_per_row_s': float(per_row),
+        'probes': probes,
+    }
+
+# Function to estimate the cost of a proposed extraction
+def estimate_extraction(probe, source_count, starttime, endtime, timestep, max_workers, id_shard_size=None,
+                        merge_memory_budget_mb=None, requests_per_second=None, baseline_mb=None):
+    """
+    Estimate the cost of a proposed extraction from the probe measurements.
+
+    Args:
+        probe: Measurements returned by probe_extraction
+        source_count: Number of sources (entries of the externallogid list)
+        starttime: Start time of the extraction
+        endtime: End time of the extraction
+        timestep: Timestep of the requests
+        max_workers: Number of concurrent requests
+        id_shard_size: ID_SHARD_SIZE of the extraction (None sends all ids at once)
+        merge_memory_budget_mb: Memory budget of the out-of-core merge (memory efficient script),
+            None when every row is held in memory until the end (multiprocessing script)
+        requests_per_second: Shared rate limit (None for no limit)
+        baseline_mb: Memory of the process before the extraction (defaults to its peak RSS so far)
+
+    Returns:
+        Dict with the estimated 'requests', 'rows', 'bytes', 'wall_time_s' and 'peak_memory_mb'
+    """
+    if baseline_mb is None:
+        baseline_mb = _process_peak_rss_mb()
+    shard_count = math.ceil(source_count / id_shard_size) if id_shard_size else 1
+    shard_sources = min(source_count, id_shard_size) if id_shard_size else source_count
+    window_count = math.ceil((endtime - starttime) / timestep)
+    request_count = window_count * shard_count
+    rows_per_request = probe['rows_per_source_minute'] * shard_sources * timestep.total_seconds() / 60
+    rows = probe['rows_per_source_minute'] * source_count * (endtime - starttime).total_seconds() / 60
+
+    latency = probe['latency_base_s'] + probe['latency_per_row_s'] * rows_per_request
+    wall_time = math.ceil(request_count / max_workers) * latency
+    if requests_per_second:
+        wall_time = max(wall_time, request_count / requests_per_second)
+
+    # Every worker holds one response while it is decoded and labelled
+    in_flight_mb = max_workers * rows_per_request * PARSE_BYTES_PER_ROW / 1e6
+    if merge_memory_budget_mb is None:
+        results_mb = rows * IN_MEMORY_BYTES_PER_ROW / 1e6
+    else:
+        results_mb = min(merge_memory_budget_mb, rows * IN_MEMORY_BYTES_PER_ROW / 1e6)
+    return {
+        'requests': request_count,
+        'rows': int(rows),
+        'rows_per_request': int(rows_per_request),
+        'bytes': int(rows * probe['bytes_per_row']) if probe['bytes_per_row'] is not None else None,
+        'latency_per_request_s': latency,
+        'wall_time_s': wall_time,
+        'peak_memory_mb': baseline_mb + in_flight_mb + results_mb,
+        'timestep': timestep,
+        'max_workers': max_workers,
+    }
+
+# Function to recommend the fastest settings that fit a memory budget
+def recommend_settings(probe, source_count, starttime, endtime, memory_budget_mb, id_shard_size=None,
+                       merge_memory_budget_mb=None, requests_per_second=None, max_rows_per_request=None,
+                       candidate_workers=CANDIDATE_WORKERS, candidate_timesteps=CANDIDATE_TIMESTEPS):
+    """
+    Recommend the number of workers and the timestep with the smallest estimated wall
+    time whose estimated peak memory fits the budget.
+
+    Between settings that are about as fast (within 5 %), fewer workers and then
+    longer timesteps are preferred, as they put less load on the server.
+
+    Args:
+        probe: Measurements returned by probe_extraction
+        source_count: Number of sources (entries of the externallogid list)
+        starttime: Start time of the extraction
+        endtime: End time of the extraction
+        memory_budget_mb: Memory limit of the job (e.g. slurm_memory_budget_mb()), None for no limit
+        id_shard_size: ID_SHARD_SIZE of the extraction
+        merge_memory_budget_mb: Memory budget of the out-of-core merge (see estimate_extraction)
+        requests_per_second: Shared rate limit (None for no limit)
+        max_rows_per_request: Optional limit of the rows per request (e.g. what the server answers in time)
+        candidate_workers: Worker counts to consider
+        candidate_timesteps: Timesteps to consider
+
+    Returns:
+        Estimate of the recommended settings (see estimate_extraction), None if nothing fits the budget
+    """
+    baseline_mb = _process_peak_rss_mb()
+    usable_mb = memory_budget_mb * MEMORY_HEADROOM if memory_budget_mb else None
+    estimates = []
+    for timestep in candidate_timesteps:
+        if timestep > endtime - starttime and estimates:
+            continue
+        for max_workers in candidate_workers:
+            estimate = estimate_extraction(probe, source_count, starttime, endtime, timestep, max_workers,
+                                           id_shard_size, merge_memory_budget_mb, requests_per_second, baseline_mb)
+            if max_rows_per_request is not None and estimate['rows_per_request'] > max_rows_per_request:
+                continue
+            if usable_mb is not None and estimate['peak_memory_mb'] > usable_mb:
+                continue
+            estimates.append(estimate)
+    if not estimates:
+        return None
+    fastest = min(estimate['wall_time_s'] for estimate in estimates)
+    close = [estimate for estimate in estimates if estimate['wall_time_s'] <= fastest * 1.05]
+    return min(close, key=lambda estimate: (estimate['max_workers'], -estimate['timestep']))
+
+# Function to print an estimate
+def print_estimate(estimate, title="Estimated extraction"):
+    """Print the request count, rows, response size, wall time and peak memory of an estimate."""
+    size = f"{estimate['bytes'] / 1e6:.1f} MB" if estimate['bytes'] is not None else "unknown size"
+    print(f"{title} (MAX_WORKERS={estimate['max_workers']}, timestep={estimate['timestep']}):")
+    print(f"  {estimate['requests']} requests of ~{estimate['rows_per_request']} rows "
+          f"(~{estimate['latency_per_request_s']:.2f} s each)")
+    print(f"  {estimate['rows']} rows, {size}")
+    print(f"  wall time ~{dt.timedelta(seconds=round(estimate['wall_time_s']))}, "
+          f"peak memory ~{estimate['peak_memory_mb']:.0f} MB")
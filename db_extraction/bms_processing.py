@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Shared processing helpers for the BMS data extraction scripts
+"""
+
+import array
+import datetime as dt
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import ijson
+except ImportError:  # without ijson the response body is decoded in one go
+    ijson = None
+
+# Number of timestamps converted to datetime64 at once while stream-decoding a response
+DECODE_BATCH_SIZE = 65536
+# Parquet metadata key holding the time zone of a compact chunk file
+COMPACT_TZ_KEY = b'bms_tz'
+
+
+# Function to pivot long-format trend data into a wide time x source table
+def pivot_long_to_wide(trend_data_df):
+    """
+    Pivot long-format trend data into a wide time x source table.
+
+    Timestamps are floored to the minute and, when a source has several readings
+    within the same minute, the first one is kept. Columns are ordered by the
+    first appearance of each source. No NA values are dropped and the index is
+    not sorted.
+
+    Args:
+        trend_data_df: Long-format DataFrame with 'source', 'timestamp' and 'value' columns
+
+    Returns:
+        Wide DataFrame indexed by 'time' with one column per source
+    """
+    long_df = pd.DataFrame({
+        'source': trend_data_df['source'].to_numpy(),
+        'time': pd.to_datetime(trend_data_df['timestamp']).dt.floor('min').to_numpy(),
+        'value': trend_data_df['value'].to_numpy(),
+    })
+    long_df = long_df.drop_duplicates(subset=['source', 'time'], keep='first')
+
+    wide_df = long_df.pivot(index='time', columns='source', values='value')
+    wide_df = wide_df[pd.unique(long_df['source'])]
+    wide_df.columns.name = None
+    wide_df.index.name = 'time'
+    return wide_df
+
+# Function to convert the long-format trend data into the final DataFrame
+def long_to_wide(trend_data_df, na_drop_setting):
+    """
+    Convert long-format trend data into the final wide DataFrame.
+
+    Args:
+        trend_data_df: Long-format DataFrame with 'source', 'timestamp' and 'value' columns
+        na_drop_setting: Setting for dropping NA values ('all' or 'any')
+
+    Returns:
+        Wide DataFrame indexed by minute, with NA rows dropped and the index sorted
+    """
+    if trend_data_df.empty:
+        return pd.DataFrame()
+
+    final_trend_data_df = pivot_long_to_wide(trend_data_df)
+    final_trend_data_df.dropna(how=na_drop_setting, inplace=True)
+    final_trend_data_df.sort_index(inplace=True)
+    return final_trend_data_df
+
+# Function to build the externallogid -> source lookup for a log map
+def build_source_lookup(source_df, logmap_var_loc, logmap_var_name):
+    """
+    Build the externallogid -> source lookup for a log map.
+
+    The lookup is built once per log map and is only read afterwards, so it can
+    be shared by all fetch workers. Each log map row is labelled with its first
+    externallogid, and the source path is stored as a categorical column.
+
+    Args:
+        source_df: DataFrame containing the log map, with an 'externallogid' column of lists
+        logmap_var_loc: Column name for variable location
+        logmap_var_name: Column name for variable name
+
+    Returns:
+        DataFrame with one row per externallogid and the columns 'externallogid' and 'source'
+    """
+    exploded_ids = source_df['externallogid'].explode()
+    first_ids = exploded_ids[~exploded_ids.index.duplicated(keep='first')]
+
+    source_lookup = pd.DataFrame({
+        'externallogid': first_ids,
+        'source': source_df[logmap_var_loc].astype(str) + '/' + source_df[logmap_var_name].astype(str),
+    })
+    source_lookup = source_lookup.dropna(subset=['externallogid'])
+    source_lookup = source_lookup.drop_duplicates(subset='externallogid', keep='first')
+    source_lookup['externallogid'] = source_lookup['externallogid'].infer_objects()
+    source_lookup['source'] = source_lookup['source'].astype('category')
+    return add_source_ids(source_lookup.reset_index(drop=True))
+
+# Function to number the sources of a lookup for the compact record layout
+def add_source_ids(source_lookup):
+    """
+    Add the int32 'source_id' column used by the compact record layout to a lookup.
+
+    The id of a source is its position in the source dictionary (see source_dictionary).
+
+    Args:
+        source_lookup: Lookup with a categorical 'source' column
+
+    Returns:
+        The lookup with a 'source_id' column
+    """
+    source_lookup['source_id'] = source_lookup['source'].cat.codes.astype(np.int32)
+    return source_lookup
+
+# Function to get the source dictionary of a lookup
+def source_dictionary(source_lookup):
+    """Return the list of source paths of a lookup, indexed by source_id."""
+    return source_lookup['source'].cat.categories.tolist()
+
+# Function to label the rows of a trend data response with their source
+def label_trend_data(trend_data_df, source_lookup):
+    """
+    Label the rows of a trend data response with their source.
+
+    Rows whose externallogid is not in the lookup are dropped. Rows are grouped
+    by externallogid (in ascending order) while keeping their original order
+    within each id.
+
+    Args:
+        trend_data_df: DataFrame as returned by the trenddata endpoint
+        source_lookup: Lookup built by build_source_lookup
+
+    Returns:
+        DataFrame with the columns 'externallogid', 'source', 'timestamp', 'timestamp_tzinfo' and 'value'
+    """
+    trend_data_df.columns = ['externallogid', 'timestamp', 'timestamp_tzinfo', 'value']
+    result_df = trend_data_df.merge(source_lookup, on='externallogid', how='inner', sort=False)
+    result_df = result_df.sort_values('externallogid', kind='stable', ignore_index=True)
+    return result_df[['externallogid', 'source', 'timestamp', 'timestamp_tzinfo', 'value']]
+
+# Function to pick the smallest lossless float type for a value column
+def compact_float_dtype(values):
+    """
+    Return 'float32' if the values survive a round trip through float32, otherwise 'float64'.
+
+    Args:
+        values: Series of values
+
+    Returns:
+        'float32' or 'float64'
+    """
+    values = values.to_numpy(dtype=np.float64)
+    with np.errstate(over='ignore', invalid='ignore'):
+        round_trip = values.astype(np.float32).astype(np.float64)
+    return 'float32' if np.array_equal(round_trip, values, equal_nan=True) else 'float64'
+
+# Function to write a time zone as a string that tz_from_string reads back
+def tz_to_string(tz):
+    """Return the IANA name of a time zone, or its UTC offset as '+HH:MM', None for naive times."""
+    if tz is None:
+        return None
+    name = getattr(tz, 'key', None) or getattr(tz, 'zone', None)
+    if name:
+        return name
+    offset_minutes = int(tz.utcoffset(None).total_seconds() // 60)
+    sign = '-' if offset_minutes < 0 else '+'
+    return f"{sign}{abs(offset_minutes) // 60:02d}:{abs(offset_minutes) % 60:02d}"
+
+# Function to read a time zone written by tz_to_string
+def tz_from_string(tz_string):
+    """Return the time zone for a string written by tz_to_string (None stays None)."""
+    if not tz_string:
+        return None
+    if tz_string[0] in '+-':
+        hours, minutes = tz_string[1:].split(':')
+        offset = dt.timedelta(hours=int(hours), minutes=int(minutes))
+        return dt.timezone(-offset if tz_string[0] == '-' else offset)
+    return tz_string
+
+# Function to label a trend data response in the compact record layout
+def label_trend_data_compact(trend_data_df, source_lookup):
+    """
+    Label the rows of a trend data response in the compact record layout.
+
+    Instead of the source path, the redundant tzinfo column and float64 values, every
+    row holds an int32 source id (see source_dictionary), the int64 minute since the
+    epoch (UTC, floored) and the value as float32 when that is lossless for the
+    response (float64 otherwise). The time zone of the response is kept in
+    DataFrame.attrs['tz']. Rows are filtered and ordered as in label_trend_data.
+
+    Args:
+        trend_data_df: DataFrame as returned by the trenddata endpoint
+        source_lookup: Lookup built by build_source_lookup
+
+    Returns:
+        DataFrame with the columns 'source_id', 'minute' and 'value'
+    """
+    trend_data_df.columns = ['externallogid', 'timestamp', 'timestamp_tzinfo', 'value']
+    timestamps = pd.DatetimeIndex(pd.to_datetime(trend_data_df['timestamp']))
+    tz = timestamps.tz
+    if tz is not None:
+        timestamps = timestamps.tz_convert('UTC').tz_localize(None)
+    compact_df = pd.DataFrame({
+        'externallogid': trend_data_df['externallogid'].to_numpy(),
+        'minute': timestamps.as_unit('ns').asi8 // 60_000_000_000,
+        'value': trend_data_df['value'].to_numpy(dtype=np.float64),
+    })
+    compact_df = compact_df.merge(source_lookup[['externallogid', 'source_id']], on='externallogid',
+                                  how='inner', sort=False)
+    compact_df = compact_df.sort_values('externallogid', kind='stable', ignore_index=True)
+    compact_df = pd.DataFrame({
+        'source_id': compact_df['source_id'].to_numpy(dtype=np.int32),
+        'minute': compact_df['minute'].to_numpy(dtype=np.int64),
+        'value': compact_df['value'].astype(compact_float_dtype(compact_df['value'])).to_numpy(),
+    })
+    compact_df.attrs['tz'] = tz_to_string(tz)
+    return compact_df
+
+# Function to save compact records as a Parquet chunk file
+def write_compact_chunk(compact_df, path):
+    """Save compact records (see label_trend_data_compact) as a Parquet file, keeping their time zone."""
+    table = pa.Table.from_pandas(compact_df, preserve_index=False)
+    tz_string = compact_df.attrs.get('tz')
+    if tz_string:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               COMPACT_TZ_KEY: tz_string.encode('utf-8')})
+    pq.write_table(table, path)
+
+# Function to read the time zone of a compact chunk file
+def read_compact_chunk_tz(path):
+    """Return the time zone string stored with a compact chunk file, None for naive times."""
+    metadata = pq.read_schema(path).metadata or {}
+    tz_string = metadata.get(COMPACT_TZ_KEY)
+    return tz_string.decode('utf-8') if tz_string else None
+
+# Function to turn epoch minutes back into a time index
+def minutes_to_index(minutes, tz_string=None):
+    """
+    Turn epoch minutes (UTC) back into a DatetimeIndex named 'time'.
+
+    Args:
+        minutes: Array of minutes since the epoch
+        tz_string: Time zone of the data (see tz_to_string), None for naive times
+
+    Returns:
+        DatetimeIndex in the time zone of the data
+    """
+    index = pd.DatetimeIndex(np.asarray(minutes, dtype=np.int64) * 60_000_000_000, name='time')
+    tz = tz_from_string(tz_string)
+    if tz is not None:
+        index = index.tz_localize('UTC').tz_convert(tz)
+    return index
+
+# Function to pivot compact records into a wide time x source table
+def pivot_compact_to_wide(compact_df, sources, tz_string=None):
+    """
+    Pivot compact records into a wide time x source table.
+
+    The first reading of a source within a minute is kept and the columns are ordered
+    by the first appearance of each source, as in pivot_long_to_wide. No NA values
+    are dropped and the index is not sorted. Values stored as float32 are widened
+    back to float64, so the table (and a CSV written from it) holds the values as
+    received.
+
+    Args:
+        compact_df: DataFrame with 'source_id', 'minute' and 'value' columns
+        sources: Source dictionary (see source_dictionary)
+        tz_string: Time zone of the data (see tz_to_string)
+
+    Returns:
+        Wide DataFrame indexed by 'time' with one column per source
+    """
+    compact_df = compact_df.drop_duplicates(subset=['source_id', 'minute'], keep='first')
+    compact_df = compact_df.astype({'value': np.float64})
+    wide_df = compact_df.pivot(index='minute', columns='source_id', values='value')
+    wide_df = wide_df[pd.unique(compact_df['source_id'])]
+    wide_df.columns = [sources[source_id] for source_id in wide_df.columns]
+    wide_df.index = minutes_to_index(wide_df.index, tz_string)
+    return wide_df
+
+# Function to convert compact records into the final DataFrame
+def compact_to_wide(compact_df, sources, na_drop_setting, tz_string=None):
+    """
+    Convert compact records into the final wide DataFrame (see long_to_wide).
+
+    Args:
+        compact_df: DataFrame with 'source_id', 'minute' and 'value' columns
+        sources: Source dictionary (see source_dictionary)
+        na_drop_setting: Setting for dropping NA values ('all' or 'any')
+        tz_string: Time zone of the data (see tz_to_string)
+
+    Returns:
+        Wide DataFrame indexed by minute, with NA rows dropped and the index sorted
+    """
+    if compact_df.empty:
+        return pd.DataFrame()
+
+    final_trend_data_df = pivot_compact_to_wide(compact_df, sources, tz_string)
+    final_trend_data_df.dropna(how=na_drop_setting, inplace=True)
+    final_trend_data_df.sort_index(inplace=True)
+    return final_trend_data_df
+
+# Columnar buffers filled while stream-decoding a trend data response
+class TrendDataColumns:
+    """
+    Typed columnar buffers filled while stream-decoding a trend data response.
+
+    Records are appended one at a time: externallogid and value go straight into
+    typed arrays, and timestamps are converted to int64 nanoseconds in batches of
+    DECODE_BATCH_SIZE, so no per-row Python objects are kept.
+    """
+
+    def __init__(self):
+        self.externallogid = array.array('q')
+        self.value = array.array('d')
+        self.timestamp_batches = []
+        self.pending_timestamps = []
+        self.timestamp_tz = None
+        self.tzinfo_categories = {}
+        self.tzinfo_codes = array.array('i')
+
+    def append(self, record):
+        """Append one record of the response (a dict or a list in the response column order)."""
+        if isinstance(record, dict):
+            externallogid, timestamp, tzinfo, value = (record.get('externallogid'), record.get('timestamp'),
+                                                       record.get('timestamp_tzinfo'), record.get('value'))
+        else:
+            externallogid, timestamp, tzinfo, value = record
+        self.externallogid.append(int(externallogid))
+        self.value.append(float('nan') if value is None else float(value))
+        if tzinfo is None:
+            self.tzinfo_codes.append(-1)
+        else:
+            self.tzinfo_codes.append(self.tzinfo_categories.setdefault(str(tzinfo), len(self.tzinfo_categories)))
+        self.pending_timestamps.append(timestamp)
+        if len(self.pending_timestamps) >= DECODE_BATCH_SIZE:
+            self._convert_timestamps()
+
+    def _convert_timestamps(self):
+        if not self.pending_timestamps:
+            return
+        if isinstance(self.pending_timestamps[0], (int, float)):
+            timestamps = pd.to_datetime(self.pending_timestamps, unit='ms')
+        else:
+            timestamps = pd.to_datetime(self.pending_timestamps)
+        if timestamps.tz is not None:
+            self.timestamp_tz = timestamps.tz
+            timestamps = timestamps.tz_convert('UTC').tz_localize(None)
+        # asi8 counts in the unit of the index (pandas may parse to microseconds); the batches hold nanoseconds
+        self.timestamp_batches.append(timestamps.as_unit('ns').asi8)
+        self.pending_timestamps = []
+
+    def __len__(self):
+        return len(self.externallogid)
+
+    def to_frame(self):
+        """Return the decoded rows as a DataFrame in the response column order."""
+        self._convert_timestamps()
+        if not len(self):
+            return pd.DataFrame()
+        timestamps = pd.DatetimeIndex(np.concatenate(self.timestamp_batches).view('datetime64[ns]'))
+        if self.timestamp_tz is not None:
+            timestamps = timestamps.tz_localize('UTC').tz_convert(self.timestamp_tz)
+        return pd.DataFrame({
+            'externallogid': np.frombuffer(self.externallogid, dtype=np.int64),
+            'timestamp': timestamps,
+            'timestamp_tzinfo': pd.Categorical.from_codes(np.frombuffer(self.tzinfo_codes, dtype=np.int32),
+                                                          categories=list(self.tzinfo_categories)),
+            'value': np.frombuffer(self.value, dtype=np.float64),
+        })
+
+# Function to stream-decode a trend data response body into columns
+def decode_trend_data_stream(stream):
+    """
+    Stream-decode a trend data response body into typed columns.
+
+    With ijson installed, the records are decoded straight from the stream, so
+    the body text and a per-row object table are never held in memory at once.
+
+    Args:
+        stream: Binary file-like object with the JSON body (e.g. response.raw)
+
+    Returns:
+        DataFrame with the columns 'externallogid', 'timestamp', 'timestamp_tzinfo' and 'value'
+    """
+    columns = TrendDataColumns()
+    records = ijson.items(stream, 'item', use_float=True) if ijson is not None else json.load(stream)
+    for record in records:
+        columns.append(record)
+    return columns.to_frame()
+
+# Coroutine stream-decoding a trend data response body from an asyncio stream
+async def decode_trend_data_stream_async(reader):
+    """
+    Stream-decode a trend data response body from an asyncio stream (see decode_trend_data_stream).
+
+    Args:
+        reader: Asyncio stream with the JSON body (e.g. aiohttp's response.content)
+
+    Returns:
+        DataFrame with the columns 'externallogid', 'timestamp', 'timestamp_tzinfo' and 'value'
+    """
+    columns = TrendDataColumns()
+    if ijson is not None:
+        async for record in ijson.items_async(reader, 'item', use_float=True):
+            columns.append(record)
+    else:
+        for record in json.loads(await reader.read()):
+            columns.append(record)
+    return columns.to_frame()
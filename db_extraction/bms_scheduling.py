@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Retry, backoff and rate limiting for requests to the BMS API
+A single token bucket is shared by all workers (threads and asyncio tasks), failed
+requests are retried with jittered exponential backoff, 429 / Retry-After answers
+pause every worker, and the intervals that still fail are collected in a report
+"""
+
+import asyncio
+import csv
+import datetime as dt
+import email.utils
+import json
+import random
+import threading
+import time
+
+import requests
+
+# Number of retries after the first attempt of a request
+MAX_RETRIES = 5
+# Base and maximum delay (in seconds) of the exponential backoff between retries
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# HTTP status codes that are worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+# Token bucket limiting the request rate of all workers together
+class TokenBucket:
+    """
+    Token bucket limiting the request rate of all workers together.
+
+    Args:
+        rate: Number of requests per second, None for no limit
+        capacity: Maximum burst of requests (defaults to max(1, rate))
+    """
+
+    def __init__(self, rate=None, capacity=None):
+        self._lock = threading.Lock()
+        self.paused_until = 0.0
+        self.configure(rate, capacity)
+
+    def configure(self, rate=None, capacity=None):
+        """Change the rate (requests per second, None for no limit) and the burst capacity."""
+        with self._lock:
+            self.rate = rate
+            self.capacity = capacity if capacity is not None else max(1.0, rate or 1.0)
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def _reserve(self):
+        """Take a token if possible; return how long to wait (0 if the token was taken)."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.rate is None:
+                return 0.0
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block the calling thread until a request may be sent."""
+        wait = self._reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._reserve()
+
+    async def acquire_async(self):
+        """Wait (without blocking the event loop) until a request may be sent."""
+        wait = self._reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._reserve()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the given number of seconds (e.g. after a 429)."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# Rate limiter shared by every request of the process
+rate_limiter = TokenBucket()
+
+
+# Function to set the request rate shared by all workers
+def configure_rate_limit(requests_per_second=None, burst=None):
+    """
+    Set the request rate shared by all workers.
+
+    Args:
+        requests_per_second: Maximum number of requests per second, None for no limit
+        burst: Maximum burst of requests
+    """
+    rate_limiter.configure(requests_per_second, burst)
+
+# Function to parse the Retry-After header of a response
+def parse_retry_after(value):
+    """
+    Parse the Retry-After header of a response.
+
+    Args:
+        value: Header value, either a number of seconds or an HTTP date
+
+    Returns:
+        Number of seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - dt.datetime.now(retry_at.tzinfo)).total_seconds())
+
+# Function to compute the delay before the next attempt of a request
+def backoff_delay(attempt, retry_after=None):
+    """
+    Compute the delay before the next attempt of a request.
+
+    Args:
+        attempt: Number of the attempt that just failed (0 for the first one)
+        retry_after: Delay asked for by the server, if any
+
+    Returns:
+        Delay in seconds: the server's Retry-After, otherwise a full-jitter exponential backoff
+    """
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+# Function to send a GET request with rate limiting and retries
+def get_with_retries(session, url, max_retries=MAX_RETRIES, **kwargs):
+    """
+    Send a GET request with rate limiting, retries and backoff.
+
+    Timeouts, connection errors and RETRY_STATUS_CODES are retried. A 429 (or any
+    answer with Retry-After) pauses the shared rate limiter, so all workers back off.
+
+    Args:
+        session: requests.Session (or the requests module) used to send the request
+        url: URL to request
+        max_retries: Number of retries after the first attempt
+        **kwargs: Passed on to session.get (params, auth, timeout, ...)
+
+    Returns:
+        The successful requests.Response (its 'retries' attribute holds the number of retries)
+
+    Raises:
+        The last requests exception (HTTPError for error status codes) once the retries are used up
+        (its 'retries' attribute holds the number of retries)
+    """
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        retry_after = None
+        try:
+            response = session.get(url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                response.retries = attempt
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            error = requests.HTTPError(f"{response.status_code} Server Error for url: {response.url}",
+                                       response=response)
+            response.close()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+
+        if attempt == max_retries:
+            error.retries = attempt
+            raise error
+        if retry_after is not None:
+            rate_limiter.pause(retry_after)
+        delay = backoff_delay(attempt, retry_after)
+        print(f"Request failed ({error}), retrying in {delay:.1f} s")
+        time.sleep(delay)
+
+# Report of the intervals that still failed after all retries
+class FailureReport:
+    """Thread-safe collection of the intervals that still failed after all retries."""
+
+    def __init__(self):
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def add(self, starttime, endtime, externallogid, error):
+        """Add a failed (interval, id shard) request to the report (externallogid may be None)."""
+        with self._lock:
+            self.failures.append({
+                'starttime': starttime,
+                'endtime': endtime,
+                'externallogid_count': len(externallogid) if externallogid is not None else '',
+                # the ids of the shard, so the request can be replayed
+                'externallogid': json.dumps(externallogid) if externallogid is not None else '',
+                'error': str(error),
+            })
+
+    def __len__(self):
+        return len(self.failures)
+
+    def print_summary(self):
+        """Print the failed intervals."""
+        if not self.failures:
+            print("All intervals were fetched successfully")
+            return
+        print(f"{len(self.failures)} interval request(s) still failed after {MAX_RETRIES} retries:")
+        for failure in sorted(self.failures, key=lambda f: f['starttime']):
+            print(f"  {failure['starttime']} to {failure['endtime']} "
+                  f"({failure['externallogid_count']} ids): {failure['error']}")
+
+    def save(self, path):
+        """Write the failed intervals to a CSV file."""
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['starttime', 'endtime', 'externallogid_count', 'externallogid',
+                                                   'error'])
+            writer.writeheader()
+            writer.writerows(sorted(self.failures, key=lambda f: f['starttime']))
+        print(f"Failure report saved to {path}")
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Live tail of the BMS API into a Parquet dataset
+Polls /trenddata over one keep-alive connection for the newest minutes of every
+id in a log map and appends them to a typed Parquet dataset (see bms_dataset), so
+a control loop can read the current state of the building with read_dataset
+instead of re-running a batch extraction. After a gap (e.g. the script was
+stopped) it first catches up from the last stored minute in CATCHUP_TIMESTEP steps
+"""
+
+import datetime as dt
+import os
+import time
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from bms_dataset import compact_dataset, dataset_last_timestamp, write_dataset
+from bms_fetching import fetch_trend_data, get_thread_session
+from bms_logmap import load_logmap
+from bms_metadata import load_metadata_index
+from bms_metrics import metrics
+from bms_processing import build_source_lookup, compact_to_wide, source_dictionary
+from bms_scheduling import backoff_delay, configure_rate_limit
+
+load_dotenv()  # take environment variables from .env.
+
+# API endpoints for the DB server (set BMS_API_URL to use another server, e.g. mock_bms_server.py)
+BMS_API_URL = os.getenv('BMS_API_URL', "https://bms-api.build.aau.dk/api/v1").rstrip('/')
+TRENDDATA_NAME = BMS_API_URL + "/trenddata"
+METADATA_NAME = BMS_API_URL + "/metadata"
+
+# Set the username for the DB server (if you do not have one ask Simon)
+username = os.getenv('BD_API_USER')
+# Set the password for the DB server (if you do not have one ask Simon)
+password = os.getenv('BD_API_PASSWORD')
+
+print(f"Username: {username}")
+print(f"Password: {'set' if password else 'not set'}")
+
+# Seconds between two polls of the newest minutes (keep it well below 60 for sub-minute latency)
+POLL_INTERVAL = 10
+# A minute is stored once every source has a value for it, or at the latest this many seconds
+# after it ended (sources that log less often than every minute never complete a row)
+SETTLE_SECONDS = 20
+# Requests covering more than this are split into steps while catching up after a gap
+CATCHUP_TIMESTEP = dt.timedelta(hours=10)
+# Time range fetched when the dataset does not exist yet
+INITIAL_BACKFILL = dt.timedelta(hours=1)
+# Merge the small files written by the polls every COMPACT_EVERY appends
+COMPACT_EVERY = 60
+
+# Maximum request rate (None for no limit); failed requests are retried with backoff
+REQUESTS_PER_SECOND = None
+configure_rate_limit(REQUESTS_PER_SECOND)
+
+# Function to get the current time, floored to the minute, in the time zone of the stored data
+def current_minute(tz=None):
+    """Return the current time floored to the minute, in the time zone tz (None for local wall time)."""
+    return pd.Timestamp.now(tz=tz).floor('min')
+
+# Function to fetch the wide table of all sources between two times
+def fetch_wide(starttime, endtime, externallogid, source_lookup, session, na_drop_setting):
+    """
+    Fetch the trend data between two times as a wide time x source table.
+
+    Args:
+        starttime: Start time (inclusive)
+        endtime: End time (exclusive)
+        externallogid: List of external log IDs to fetch
+        source_lookup: Shared externallogid -> source lookup (see build_source_lookup)
+        session: Keep-alive requests.Session
+        na_drop_setting: Setting for dropping NA values ('all' or 'any')
+
+    Returns:
+        Wide DataFrame indexed by minute (empty if there was no data)
+    """
+    compact_df = fetch_trend_data(starttime.to_pydatetime(), endtime.to_pydatetime(), externallogid,
+                                  source_lookup, (username, password), TRENDDATA_NAME, session=session)
+    if compact_df.empty:
+        return compact_df
+    return compact_to_wide(compact_df, source_dictionary(source_lookup), na_drop_setting,
+                           compact_df.attrs.get('tz'))
+
+# Function to select the minutes of a poll that are ready to be stored
+def settled_rows(trend_data_df, now, source_count):
+    """
+    Select the leading minutes of a poll that are ready to be stored.
+
+    A minute is ready when every source has a value for it or when it ended more
+    than SETTLE_SECONDS ago. Only the minutes before the first one that is not
+    ready are returned, so the dataset never needs rows inserted before its end.
+
+    Args:
+        trend_data_df: Wide DataFrame of the poll, sorted by time
+        now: Current time (in the time zone of the data)
+        source_count: Number of sources of the log map
+
+    Returns:
+        The rows that can be appended
+    """
+    complete = trend_data_df.notna().sum(axis=1).to_numpy() >= source_count
+    settled = trend_data_df.index + pd.Timedelta(minutes=1) + pd.Timedelta(seconds=SETTLE_SECONDS) <= now
+    ready = complete | settled
+    not_ready = (~ready).nonzero()[0]
+    return trend_data_df.iloc[:not_ready[0]] if len(not_ready) else trend_data_df
+
+# Main process
+if __name__ == '__main__':
+    # Log map to follow and the directory of its live dataset
+    source_logmap = "./log_maps/Log_map_TMV23_2025_02_28_MIN.xlsx"
+    save_location = "./SAVED_LOGS"
+    logmap_sheet = 'log_map'
+    logmap_columns = 'A:D'
+    logmap_var_loc = 'Log_variable_location'
+    logmap_var_name = 'Logged_variable_name'
+
+    # Partitioning of the live dataset
+    OUTPUT_PARTITION = 'day'    # either 'day' or 'month'
+
+    # In the final dataframe, when dropping NA values, should the row contain NA for all variables, or just for any variables before dropping the row?
+    na_drop_setting = 'all'     # either 'any' or 'all'
+
+    save_file_name = os.path.basename(source_logmap).split(".")[0].split("Log_map_")[-1]
+    dataset_dir = ''.join([save_location, '/', save_file_name, '_live'])
+
+    metadata_index = load_metadata_index(METADATA_NAME, (username, password))
+    source_df, externallogid = load_logmap(source_logmap, metadata_index, logmap_sheet, logmap_columns,
+                                           logmap_var_loc, logmap_var_name)
+    source_lookup = build_source_lookup(source_df, logmap_var_loc, logmap_var_name)
+    source_count = len(source_dictionary(source_lookup))
+
+    # One keep-alive connection for every poll
+    session = get_thread_session(1)
+
+    # Continue from the last stored minute, or start with a short backfill
+    cursor = dataset_last_timestamp(dataset_dir)
+    if cursor is None:
+        cursor = current_minute() - INITIAL_BACKFILL - pd.Timedelta(minutes=1)
+        print(f"Starting {dataset_dir} from {cursor + pd.Timedelta(minutes=1)}")
+    else:
+        print(f"Continuing {dataset_dir} after {cursor}")
+    dataset_exists = os.path.isdir(dataset_dir)
+    appends = 0
+    failures = 0
+
+    try:
+        while True:
+            poll_start = time.monotonic()
+            try:
+                now = pd.Timestamp.now(tz=cursor.tz)
+                # Catch up in CATCHUP_TIMESTEP steps, then poll up to and including the current minute
+                starttime = cursor + pd.Timedelta(minutes=1)
+                endtime = min(current_minute(cursor.tz) + pd.Timedelta(minutes=1), starttime + CATCHUP_TIMESTEP)
+                catching_up = endtime <= current_minute(cursor.tz)
+                if catching_up:
+                    print(f"Catching up from {starttime} to {endtime}")
+
+                trend_data_df = fetch_wide(starttime, endtime, externallogid, source_lookup, session,
+                                           na_drop_setting)
+                if not trend_data_df.empty:
+                    if cursor.tz is None and trend_data_df.index.tz is not None:
+                        # The first cursor of a new dataset is in local wall time; move it to the data's zone
+                        cursor = cursor.tz_localize(trend_data_df.index.tz)
+                        now = pd.Timestamp.now(tz=cursor.tz)
+                    trend_data_df = trend_data_df[trend_data_df.index > cursor]
+                    trend_data_df = trend_data_df if catching_up else settled_rows(trend_data_df, now, source_count)
+                if len(trend_data_df):
+                    write_dataset(trend_data_df, dataset_dir, partition=OUTPUT_PARTITION,
+                                  mode='append' if dataset_exists else 'overwrite')
+                    dataset_exists = True
+                    cursor = trend_data_df.index[-1]
+                    appends += 1
+                    # A minute is stored as soon as every source reported it, often before the minute ends
+                    lag = (pd.Timestamp.now(tz=cursor.tz) - cursor).total_seconds()
+                    print(f"Stored {len(trend_data_df)} minute(s) up to {cursor} ({lag:.1f} s after the newest sample)")
+                elif catching_up:
+                    # No data in this step of the gap: move on to the next step
+                    cursor = endtime - pd.Timedelta(minutes=1)
+                failures = 0
+
+                if appends and appends % COMPACT_EVERY == 0:
+                    compact_dataset(dataset_dir)
+                    # Keep the memory of the metrics bounded in a long-running tail
+                    metrics.print_summary()
+                    metrics.reset()
+                    appends = 0
+                if catching_up:
+                    continue
+            except Exception as e:
+                delay = backoff_delay(failures)
+                failures += 1
+                print(f"Poll failed ({e!r}), retrying in {delay:.1f} s")
+                time.sleep(delay)
+                continue
+
+            time.sleep(max(0.0, POLL_INTERVAL - (time.monotonic() - poll_start)))
+    except KeyboardInterrupt:
+        print("Stopping the live tail")
+    finally:
+        if dataset_exists:
+            compact_dataset(dataset_dir)
@@ -7,7 +7,6 @@ Modified to use multithreading for faster data extraction
 Memory-efficient version that uses temp files instead of keeping everything in RAM
 """
 
-import requests
 import pandas as pd
 import datetime as dt
 import math
@@ -22,6 +21,21 @@ import concurrent.futures
 from tqdm import tqdm  # For progress bars
 from dotenv import load_dotenv
 
+from bms_dataset import dataset_last_timestamp, write_dataset
+from bms_fetching import (AdaptiveIntervalPlanner, build_work_items, fetch_intervals_adaptive,
+                          fetch_intervals_async, fetch_trend_data, get_thread_session, shard_externallogid)
+from bms_jobs import print_overlap_summary, shared_job_name, union_externallogids, union_source_lookup
+from bms_logmap import load_logmap
+from bms_manifest import ChunkManifest, append_to_csv_dataset, create_work_dir, read_last_timestamp
+from bms_merge import merge_chunk_files
+from bms_metadata import load_metadata_index
+from bms_metrics import metrics
+from bms_pipeline import run_extraction_pipeline
+from bms_planner import (estimate_extraction, print_estimate, probe_extraction, recommend_settings,
+                         slurm_memory_budget_mb)
+from bms_processing import build_source_lookup, source_dictionary, write_compact_chunk
+from bms_scheduling import FailureReport, configure_rate_limit
+
 load_dotenv()  # take environment variables from .env.
 
 # Start timing the script
@@ -29,9 +43,10 @@ script_start_time = time.time()
 
 pd.set_option('display.max_colwidth', None)
 
-# API endpoints for the DB server
-TRENDDATA_NAME = "https://bms-api.build.aau.dk/api/v1/trenddata"
-METADATA_NAME = "https://bms-api.build.aau.dk/api/v1/metadata"
+# API endpoints for the DB server (set BMS_API_URL to use another server, e.g. mock_bms_server.py)
+BMS_API_URL = os.getenv('BMS_API_URL', "https://bms-api.build.aau.dk/api/v1").rstrip('/')
+TRENDDATA_NAME = BMS_API_URL + "/trenddata"
+METADATA_NAME = BMS_API_URL + "/metadata"
 
 # Set the username for the DB server (if you do not have one ask Simon)
 username = os.getenv('BD_API_USER')
@@ -39,12 +54,37 @@ username = os.getenv('BD_API_USER')
 password = os.getenv('BD_API_PASSWORD')
 
 print(f"Username: {username}")
-print(f"Password: {password}")
+print(f"Password: {'set' if password else 'not set'}")
 
 # Set the maximum number of concurrent API requests
 # Adjust this based on API rate limits and your network capacity
 MAX_WORKERS = 8
 
+# Maximum number of externallogid sent in one request; larger log maps are split into shards
+# that are fetched as separate (time window x id shard) requests. None sends all ids at once
+ID_SHARD_SIZE = None
+
+# Extraction mode: 'threads' uses the thread pool above, 'async' runs all interval requests
+# with asyncio over one pooled keep-alive HTTP client (needs aiohttp), 'pipeline' downloads with
+# MAX_WORKERS I/O threads, parses in a process pool and writes the chunks in a separate stage
+EXTRACTION_MODE = 'threads'     # either 'threads', 'async' or 'pipeline'
+# Maximum number of interval requests in flight in the async extraction mode
+MAX_CONCURRENT_REQUESTS = 64
+# Number of parse processes (None for the CPU count) and capacity of the queues between the
+# stages of the pipeline extraction mode
+PIPELINE_PARSE_PROCESSES = None
+PIPELINE_QUEUE_SIZE = 16
+
+# Maximum request rate shared by all workers (None for no limit); failed requests are retried
+# with backoff, and 429 / Retry-After answers from the server pause every worker
+REQUESTS_PER_SECOND = None
+configure_rate_limit(REQUESTS_PER_SECOND)
+
+# Approximate memory budget (in MB) used when merging the chunk files into the final table
+# The chunks are merged out of core in blocks that fit within this budget, whatever the time
+# range; lower it on small SLURM allocations
+MERGE_MEMORY_BUDGET_MB = 512
+
 # Create a temporary directory for chunk storage
 def create_temp_dir():
     """Create a temporary directory for storing data chunks"""
@@ -52,152 +92,73 @@ def create_temp_dir():
     print(f"Created temporary directory: {temp_dir}")
     return temp_dir
 
-# Function to fetch trend data for a specific time interval and save to temp file
-def fetch_trend_data_for_interval(starttime, endtime, externallogid, source_df, 
-                                 logmap_var_loc, logmap_var_name, temp_dir, interval_index):
+# Function to fetch trend data for a specific time interval and save it to a temp file (raising on errors)
+def fetch_and_save_interval(starttime, endtime, externallogid, source_lookup, temp_dir, interval_index,
+                            queued_at=None):
     """
-    Fetch trend data for a specific time interval and save to a temporary file.
+    Fetch trend data for a specific time interval and save it to a temporary file.
+    
+    Errors are raised, so the caller can decide to retry or split the interval.
     
     Args:
         starttime: Start time for data extraction
         endtime: End time for data extraction
         externallogid: List of external log IDs to fetch
-        source_df: DataFrame containing source information
-        logmap_var_loc: Column name for variable location
-        logmap_var_name: Column name for variable name
+        source_lookup: Shared externallogid -> source lookup (see build_source_lookup)
         temp_dir: Directory to save the temporary chunk file
-        interval_index: Index of this interval (for unique filename)
+        interval_index: Index or name of this chunk (for unique filename)
+        queued_at: time.perf_counter() value when the interval was queued (for the metrics)
     
     Returns:
-        Path to the saved temp file, or None if no data was found
+        Tuple (path to the saved temp file or None if no data was found, number of rows)
     """
-    PARAMS = {'starttime': starttime, 'endtime': endtime, 'externallogid': externallogid}
-    try:
-        print(f'Fetching data for interval: {starttime} to {endtime}')
-        trend_data = requests.get(TRENDDATA_NAME, params=PARAMS, auth=(username, password))
-        trend_data_text = trend_data.text
-        trend_data_df = pd.read_json(trend_data_text, orient='records')
-        
-        if trend_data_df.empty:
-            print(f"No data found for interval {starttime} to {endtime}")
-            return None
-        
-        # Process data similar to the original script
-        temp_externallogid_1 = source_df['externallogid'].explode()
-        temp_externallogid_1 = temp_externallogid_1[~temp_externallogid_1.index.duplicated(keep='first')]
-        local_source_df = source_df.copy()
-        local_source_df['externallogid'] = temp_externallogid_1
-        
-        dfs = []
-        for id_, id_df in trend_data_df.groupby('externallogid'):
-            temp_source = (local_source_df[local_source_df['externallogid']==id_][logmap_var_loc]).tolist()
-            temp_name = (local_source_df[local_source_df['externallogid']==id_][logmap_var_name]).tolist()
-            
-            if not temp_source or not temp_name:
-                continue
-                
-            temp_source_name = '/'.join(temp_source + temp_name)
-            
-            temp_s = pd.Series([temp_source_name] * len(id_df))
-            temp_df = pd.concat([id_df.reset_index(drop=True),
-                                temp_s.reset_index(drop=True)],
-                                ignore_index=True, axis=1)
-            
-            dfs.append(temp_df)
-        
-        if not dfs:
-            return None
-            
-        result_df = pd.concat(dfs, axis=0, ignore_index=True)
-        col_names = ['externallogid', 'timestamp', 'timestamp_tzinfo', 'value', 'source']
-        result_df.columns = col_names
-        source_column = result_df.pop('source')
-        result_df.insert(1, 'source', source_column)
-        
-        # Save the result to a temporary file
-        temp_file_path = os.path.join(temp_dir, f"chunk_{interval_index}.parquet")
-        result_df.to_parquet(temp_file_path)
-        
-        # Free up memory
-        del result_df
-        del dfs
-        
-        return temp_file_path
-        
-    except Exception as e:
-        print(f"Error fetching data for interval {starttime} to {endtime}: {e}")
-        return None
+    print(f'Fetching data for interval: {starttime} to {endtime}')
+    result_df = fetch_trend_data(starttime, endtime, externallogid, source_lookup,
+                                 (username, password), TRENDDATA_NAME,
+                                 session=get_thread_session(MAX_WORKERS), queued_at=queued_at)
+    
+    if result_df.empty:
+        print(f"No data found for interval {starttime} to {endtime}")
+        return None, 0
+    
+    # Save the compact records to a temporary file
+    temp_file_path = os.path.join(temp_dir, f"chunk_{interval_index}.parquet")
+    with metrics.stage('write'):
+        write_compact_chunk(result_df, temp_file_path)
+    row_count = len(result_df)
+    
+    # Free up memory
+    del result_df
+    
+    return temp_file_path, row_count
 
-# Function to process chunked data and create the final DataFrame
-def process_chunked_data(temp_files, na_drop_setting):
+# Function to merge the chunked data files into the final table, block by block
+def process_chunked_data(temp_files, na_drop_setting, temp_dir, source_lookup, logmap_lookup=None):
     """
-    Process the chunked data files to create the final DataFrame
+    Merge the chunked data files into the final table, block by block.
+    
+    Each chunk is sorted by time into a run file, and the runs are k-way merged
+    out of core, so the peak memory stays within MERGE_MEMORY_BUDGET_MB however
+    long the extracted time range is.
     
     Args:
         temp_files: List of paths to temporary parquet files
         na_drop_setting: Setting for dropping NA values ('all' or 'any')
+        temp_dir: Directory holding the chunk files (the sorted runs are written below it)
+        source_lookup: Lookup the chunks were labelled with (its source dictionary names the columns)
+        logmap_lookup: Optional log map lookup to project the chunks of a shared job onto
     
     Returns:
-        The final processed DataFrame
+        Generator of wide DataFrames in time order, all with the same columns
     """
     print("Processing chunked data files...")
-    
-    # First, collect all unique sources across all chunks
-    all_sources = set()
-    for file_path in tqdm(temp_files, desc="Scanning for unique sources"):
-        if file_path is None:
-            continue
-        chunk_df = pd.read_parquet(file_path)
-        all_sources.update(chunk_df['source'].unique())
-    
-    print(f"Found {len(all_sources)} unique sources")
-    
-    # Process one source at a time to reduce memory usage
-    final_trend_data_df = pd.DataFrame()
-    
-    for source_id in tqdm(all_sources, desc="Processing sources"):
-        source_data = []
-        
-        # Extract data for this source from each chunk
-        for file_path in temp_files:
-            if file_path is None:
-                continue
-                
-            chunk_df = pd.read_parquet(file_path)
-            source_chunk = chunk_df[chunk_df['source'] == source_id]
-            
-            if not source_chunk.empty:
-                temp_df = pd.DataFrame()
-                temp_df[source_id] = source_chunk['value']
-                temp_df['time'] = source_chunk['timestamp']
-                temp_df['time'] = temp_df['time'].apply(lambda ts: ts.replace(second=0))
-                temp_df.set_index('time', inplace=True)
-                source_data.append(temp_df)
-                
-            # Free memory
-            del chunk_df
-        
-        # Combine chunks for this source
-        if source_data:
-            source_df = pd.concat(source_data, axis=0)
-            source_df = source_df[~source_df.index.duplicated(keep='first')]
-            
-            if len(final_trend_data_df) == 0:
-                final_trend_data_df = source_df
-            else:
-                final_trend_data_df = final_trend_data_df.join(source_df, how='outer')
-            
-            # Free memory
-            del source_df
-            del source_data
-    
-    # Drop NA values and sort the final result
-    if not final_trend_data_df.empty:
-        final_trend_data_df.dropna(how=na_drop_setting, inplace=True)
-        final_trend_data_df = final_trend_data_df[~final_trend_data_df.index.duplicated(keep='first')]
-        final_trend_data_df.sort_index(inplace=True)
-    
-    return final_trend_data_df
+    source_ids = None
+    if logmap_lookup is not None:
+        logmap_rows = source_lookup['externallogid'].isin(logmap_lookup['externallogid'])
+        source_ids = source_lookup.loc[logmap_rows, 'source_id'].unique()
+    return merge_chunk_files(temp_files, na_drop_setting, os.path.join(temp_dir, 'sorted_runs'),
+                             source_dictionary(source_lookup), memory_budget_mb=MERGE_MEMORY_BUDGET_MB,
+                             source_ids=source_ids)
 
 # Main process
 if __name__ == '__main__':
@@ -209,6 +170,42 @@ if __name__ == '__main__':
 
     # Set the timestep size
     timestep = dt.timedelta(hours=10)
+    
+    # Interval sizing: 'fixed' uses timestep for every request, 'adaptive' starts from timestep and
+    # sizes the following intervals toward TARGET_ROWS_PER_REQUEST (uses the thread pool)
+    TIMESTEP_MODE = 'fixed'     # either 'fixed' or 'adaptive'
+    TARGET_ROWS_PER_REQUEST = 50000
+    MIN_TIMESTEP = dt.timedelta(minutes=30)
+    MAX_TIMESTEP = dt.timedelta(days=7)
+
+    # Planning: 'dry_run' sends a few probe requests per job and prints the estimated requests, rows,
+    # size, wall time and peak memory with the settings above and the recommended settings, without
+    # extracting; 'apply' extracts with the recommended MAX_WORKERS and timestep (a run with another
+    # timestep does not reuse the chunks of an earlier run)
+    PLAN_MODE = 'off'       # either 'off', 'dry_run' or 'apply'
+    # Memory limit (in MB) the recommended settings must fit in (defaults to the SLURM --mem of the job)
+    PLAN_MEMORY_BUDGET_MB = slurm_memory_budget_mb()
+
+    # Keep the downloaded chunks in a persistent work directory with a manifest, so an interrupted
+    # run only fetches the missing or failed chunks when it is started again
+    RESUME_RUNS = True
+    work_location = "./.bms_work"
+    
+    # Extraction range: 'range' uses the start and end dates below, 'incremental' extends the
+    # existing <logmap>_memeff_incremental dataset (CSV or Parquet) from its last timestamp up to now
+    SYNC_MODE = 'range'     # either 'range' or 'incremental'
+
+    # Output format: 'csv' writes one CSV file, 'parquet' writes a typed Parquet dataset directory
+    # partitioned by OUTPUT_PARTITION (read it back with bms_dataset.read_dataset)
+    OUTPUT_FORMAT = 'csv'       # either 'csv' or 'parquet'
+    OUTPUT_PARTITION = 'month'  # either 'day' or 'month'
+    # Parquet encoding: 'plain' stores every minute, 'change_points' stores only the minutes where a
+    # source changes (much smaller for counters and near-constant values; read_dataset expands it)
+    OUTPUT_ENCODING = 'plain'   # either 'plain' or 'change_points'
+
+    # Job mode: 'per_logmap' extracts every log map on its own, 'shared' fetches the union of the
+    # externallogids of all log maps once and projects the shared chunks into each log map's output
+    JOB_MODE = 'per_logmap'     # either 'per_logmap' or 'shared'
 
     # In the final dataframe, when dropping NA values, should the row contain NA for all variables, or just for any variables before dropping the row?
     na_drop_setting = 'all'     # either 'any' or 'all'
@@ -219,14 +216,22 @@ if __name__ == '__main__':
 
     print("Files to run: ", files_to_run)
     
-    for j in range(len(files_to_run)):
-        # Create temporary directory for this file processing
-        temp_dir = create_temp_dir()
+    # Load the source -> externallogid index once for all log maps (cached on disk between runs)
+    with metrics.stage('metadata'):
+        metadata_index = load_metadata_index(METADATA_NAME, (username, password))
+    
+    # Group the log maps into jobs: one job per log map, or one shared job over all of them
+    if JOB_MODE == 'shared':
+        jobs = [list(range(len(files_to_run)))]
+    else:
+        jobs = [[j] for j in range(len(files_to_run))]
+    
+    for job in jobs:
+        temp_dir = None
+        job_name = None
+        run_completed = False
         
         try:
-            # Set the name of the data file as a string, e.g. 'test'
-            save_file_name = filenames[j]
-            
             # Start and endtime for the dataextraction 
             start_year = 2024
             start_month = 1
@@ -237,86 +242,236 @@ if __name__ == '__main__':
             end_day = 1
             end_hour = 4
             
-            starttime = dt.datetime(start_year, start_month, start_day, start_hour) 
-            endtime = dt.datetime(end_year, end_month, end_day, end_hour) 
-            
-            # if identifier is 3, the source_df is pulled from the excel sheet logmap (for many inputs)
-            source_logmap = files_to_run[j]
-            logmap_sheet = 'log_map'
-            logmap_columns = 'A:D'
-            logmap_var_loc = 'Log_variable_location'
-            logmap_var_name = 'Logged_variable_name'
+            # Prepare the output, time range, ids and source lookup of every log map in the job
+            logmaps = []
+            for j in job:
+                # Set the name of the data file as a string, e.g. 'test'
+                save_file_name = filenames[j]
+                
+                starttime = dt.datetime(start_year, start_month, start_day, start_hour) 
+                endtime = dt.datetime(end_year, end_month, end_day, end_hour) 
+                last_timestamp = None
+                
+                if SYNC_MODE == 'incremental':
+                    # Extend the existing dataset from its last timestamp up to now
+                    save_file = ''.join([save_location, '/', save_file_name, '_memeff_incremental'])
+                    if OUTPUT_FORMAT == 'parquet':
+                        last_timestamp = dataset_last_timestamp(save_file)
+                    else:
+                        save_file += '.csv'
+                        last_timestamp = read_last_timestamp(save_file)
+                    if last_timestamp is not None:
+                        # The intervals are in wall-clock time, like the configured start and end times
+                        wall_clock = (last_timestamp.tz_localize(None) if last_timestamp.tz is not None
+                                      else last_timestamp)
+                        starttime = wall_clock.to_pydatetime() + dt.timedelta(minutes=1)
+                    endtime = dt.datetime.now().replace(second=0, microsecond=0)
+                    if starttime >= endtime:
+                        print(f"{save_file} is already up to date")
+                        continue
+                    print(f"Incremental sync of {save_file} from {starttime} to {endtime}")
+                else:
+                    save_file = ''.join([save_location, '/', save_file_name, '_memeff_', 
+                                       str(start_year), '_', str(start_month), '__', 
+                                       str(end_year), '_', str(end_month)])
+                    if OUTPUT_FORMAT != 'parquet':
+                        save_file += '.csv'
+                
+                # if identifier is 3, the source_df is pulled from the excel sheet logmap (for many inputs)
+                source_logmap = files_to_run[j]
+                logmap_sheet = 'log_map'
+                logmap_columns = 'A:D'
+                logmap_var_loc = 'Log_variable_location'
+                logmap_var_name = 'Logged_variable_name'
+                
+                # Load the compiled logmap (cached by spreadsheet contents) with the externallogid of every row,
+                # looked up in the cached metadata index
+                print(f"Reading logmap from {source_logmap}")
+                with metrics.stage('metadata'):
+                    source_df, externallogid = load_logmap(source_logmap, metadata_index, logmap_sheet, logmap_columns,
+                                                           logmap_var_loc, logmap_var_name)
+                print("Metadata processing completed")
+                
+                # Build the externallogid -> source lookup once; all fetch workers share it read-only
+                source_lookup = build_source_lookup(source_df, logmap_var_loc, logmap_var_name)
+                
+                logmaps.append({'name': save_file_name, 'save_file': save_file, 'starttime': starttime,
+                                'endtime': endtime, 'last_timestamp': last_timestamp,
+                                'externallogid': externallogid, 'source_lookup': source_lookup})
             
-            print(f"Reading logmap from {source_logmap}")
-            source_df = pd.read_excel(io=source_logmap, sheet_name=logmap_sheet, header=0, usecols=logmap_columns)
+            if not logmaps:
+                continue
             
-            # Create the list of externallogid (same as original script)
-            source = []
-            for i in range(0, len(source_df)):
-                temp = '/'.join([str(source_df[logmap_var_loc][i]), str(source_df[logmap_var_name][i])])
-                source.append(temp)
-                
-            print("Fetching metadata...")
-            trend_meta = requests.get(url=METADATA_NAME, auth=(username, password))
-            trend_meta_text = trend_meta.text
-            print("Metadata status code: ", trend_meta.status_code)
+            # A job over several log maps fetches the union of their ids once, over the union of their ranges
+            if len(logmaps) > 1:
+                job_name = shared_job_name([logmap['name'] for logmap in logmaps])
+                externallogid = union_externallogids([logmap['externallogid'] for logmap in logmaps])
+                source_lookup = union_source_lookup([logmap['source_lookup'] for logmap in logmaps])
+                print(f"Shared job {job_name} over {len(logmaps)} log maps:")
+                print_overlap_summary([logmap['name'] for logmap in logmaps],
+                                      [logmap['externallogid'] for logmap in logmaps], externallogid)
+            else:
+                job_name = logmaps[0]['name']
+                externallogid = logmaps[0]['externallogid']
+                source_lookup = logmaps[0]['source_lookup']
+            starttime = min(logmap['starttime'] for logmap in logmaps)
+            endtime = max(logmap['endtime'] for logmap in logmaps)
             
-            trend_meta_df = pd.read_json(trend_meta_text, orient='records')
-            print("Metadata columns: ", trend_meta_df.columns)
+            # The recommended settings only apply to this job; the next one starts from the settings above
+            job_max_workers = MAX_WORKERS
+            job_timestep = timestep
+            # Estimate the cost of the job from a few probe requests and recommend settings for it
+            if PLAN_MODE != 'off':
+                probe = probe_extraction(starttime, endtime, externallogid, timestep, (username, password),
+                                         TRENDDATA_NAME, ID_SHARD_SIZE, session=get_thread_session(MAX_WORKERS))
+                print_estimate(estimate_extraction(probe, len(externallogid), starttime, endtime, timestep,
+                                                   MAX_WORKERS, ID_SHARD_SIZE, MERGE_MEMORY_BUDGET_MB,
+                                                   REQUESTS_PER_SECOND),
+                               "Estimated extraction with the current settings")
+                recommended = recommend_settings(probe, len(externallogid), starttime, endtime,
+                                                 PLAN_MEMORY_BUDGET_MB, ID_SHARD_SIZE, MERGE_MEMORY_BUDGET_MB,
+                                                 REQUESTS_PER_SECOND)
+                if recommended is None:
+                    print(f"No settings fit the memory budget of {PLAN_MEMORY_BUDGET_MB} MB; "
+                          f"lower MERGE_MEMORY_BUDGET_MB or set ID_SHARD_SIZE")
+                else:
+                    print_estimate(recommended, "Recommended settings")
+                if PLAN_MODE == 'dry_run':
+                    continue
+                if recommended is not None:
+                    job_max_workers = recommended['max_workers']
+                    job_timestep = recommended['timestep']
+                    print(f"Using MAX_WORKERS={job_max_workers} and timestep={job_timestep} for this job")
             
-            externallogid = []
-            temp_externallogid = []
-            for i in range(0, len(source_df)):
-                externallogid.append(trend_meta_df.externallogid[source[i] == trend_meta_df.source].tolist())
-                temp_externallogid.append(trend_meta_df.externallogid[source[i] == trend_meta_df.source].tolist())
-                if externallogid[-1] == []:
-                    print(' '.join(['source_df index', str(source_df.index[i]), 'failed']))
-                    externallogid.pop()
-                    
-            source_df_insert_point = len(source_df.columns)
-            source_df.insert(source_df_insert_point, 'externallogid', temp_externallogid)
-            print("Metadata processing completed")
+            # Create the directory for the chunks of this job: persistent (with a manifest) when
+            # resuming runs, otherwise a temporary one
+            if RESUME_RUNS:
+                temp_dir = create_work_dir(work_location, job_name, starttime)
+                manifest = ChunkManifest(temp_dir)
+            else:
+                temp_dir = create_temp_dir()
+                manifest = None
             
             # Generate time intervals
             time_intervals = []
             current_time = starttime
             while current_time < endtime:
-                time_intervals.append((current_time, current_time + timestep))
-                current_time += timestep
+                time_intervals.append((current_time, min(current_time + job_timestep, endtime)))
+                current_time += job_timestep
                 
-            print(f"Total time intervals to process: {len(time_intervals)}")
+            # Split the externallogid list into shards; every (time window x id shard) pair is one request
+            id_shards = shard_externallogid(externallogid, ID_SHARD_SIZE)
+            work_items = build_work_items(time_intervals, id_shards)
             
-            # Use ThreadPoolExecutor to fetch data for each time interval in parallel
-            # and save each chunk to a temporary file
-            temp_files = [None] * len(time_intervals)
+            print(f"Total time intervals to process: {len(time_intervals)} "
+                  f"({len(work_items)} requests over {len(id_shards)} id shard(s))")
             
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                future_to_index = {}
+            # Chunks already in the manifest are reused, only missing or failed ones are fetched
+            sources = source_dictionary(source_lookup)
+            chunk_keys = [ChunkManifest.chunk_key(job_name, interval, id_shards[shard_index], sources)
+                          for interval, shard_index in work_items]
+            chunk_names = [ChunkManifest.chunk_name(key) if manifest is not None else idx
+                           for idx, key in enumerate(chunk_keys)]
+            temp_files = [None] * len(work_items)
+            pending = []
+            for idx, key in enumerate(chunk_keys):
+                if manifest is not None and manifest.is_done(key):
+                    temp_files[idx] = manifest.chunk_path(key)
+                else:
+                    pending.append(idx)
+            if manifest is not None:
+                print(f"Resuming: {len(work_items) - len(pending)} chunks already downloaded, "
+                      f"{len(pending)} to fetch")
+            
+            # Function to record the outcome of a work item in temp_files and the manifest
+            def record_chunk(idx, temp_file_path, row_count, error):
+                temp_files[idx] = temp_file_path
+                if manifest is not None:
+                    if error is not None:
+                        manifest.record(chunk_keys[idx], 'failed')
+                    elif temp_file_path is None:
+                        manifest.record(chunk_keys[idx], 'empty')
+                    else:
+                        manifest.record(chunk_keys[idx], 'ok', temp_file_path, row_count)
+            
+            # Collects the requests that still fail after all retries
+            failure_report = FailureReport()
+            
+            if TIMESTEP_MODE == 'adaptive':
+                # Size the intervals toward TARGET_ROWS_PER_REQUEST while fetching them with the thread pool
+                # (one planner per id shard). Adaptive intervals are not known in advance, so they are
+                # not resumed from the manifest
+                planners = [AdaptiveIntervalPlanner(starttime, endtime, job_timestep, TARGET_ROWS_PER_REQUEST,
+                                                    MIN_TIMESTEP, MAX_TIMESTEP) for _ in id_shards]
+                interval_results = fetch_intervals_adaptive(
+                    planners,
+                    lambda interval_start, interval_end, shard_index, idx: fetch_and_save_interval(
+                        interval_start, interval_end, id_shards[shard_index], source_lookup, temp_dir, 
+                        f"adaptive_{idx}"),
+                    job_max_workers, failure_report=failure_report, id_shards=id_shards)
+                temp_files = [temp_file_path for _, _, temp_file_path in interval_results]
+            elif EXTRACTION_MODE == 'async':
+                # Run all interval requests with asyncio over one pooled client
+                # and save each chunk to a temporary file
+                fetch_intervals_async(time_intervals, externallogid, source_lookup,
+                                      (username, password), TRENDDATA_NAME,
+                                      MAX_CONCURRENT_REQUESTS, temp_dir=temp_dir,
+                                      id_shard_size=ID_SHARD_SIZE, failure_report=failure_report,
+                                      work_items=[work_items[idx] for idx in pending],
+                                      chunk_names=[chunk_names[idx] for idx in pending],
+                                      on_complete=lambda i, temp_file_path, row_count, error: record_chunk(
+                                          pending[i], temp_file_path, row_count, error))
+            elif EXTRACTION_MODE == 'pipeline':
+                # Fetch raw bodies with I/O threads, parse them in a process pool and write the
+                # chunks in a separate stage, with bounded queues between the stages
+                run_extraction_pipeline([work_items[idx] for idx in pending], id_shards, source_lookup,
+                                        (username, password), TRENDDATA_NAME, temp_dir,
+                                        chunk_names=[chunk_names[idx] for idx in pending],
+                                        fetch_workers=job_max_workers, parse_processes=PIPELINE_PARSE_PROCESSES,
+                                        queue_size=PIPELINE_QUEUE_SIZE, failure_report=failure_report,
+                                        on_complete=lambda i, temp_file_path, row_count, error: record_chunk(
+                                            pending[i], temp_file_path, row_count, error))
+            else:
+                # Use ThreadPoolExecutor to fetch data for each (time window x id shard) in parallel
+                # and save each chunk to a temporary file
+                with concurrent.futures.ThreadPoolExecutor(max_workers=job_max_workers) as executor:
+                    future_to_index = {}
                 
-                for idx, interval in enumerate(time_intervals):
-                    future = executor.submit(
-                        fetch_trend_data_for_interval, 
-                        interval[0],  # starttime 
-                        interval[1],  # endtime
-                        externallogid, 
-                        source_df, 
-                        logmap_var_loc, 
-                        logmap_var_name,
-                        temp_dir,
-                        idx
-                    )
-                    future_to_index[future] = idx
+                    for idx in pending:
+                        interval, shard_index = work_items[idx]
+                        future = executor.submit(
+                            fetch_and_save_interval, 
+                            interval[0],  # starttime 
+                            interval[1],  # endtime
+                            id_shards[shard_index], 
+                            source_lookup,
+                            temp_dir,
+                            chunk_names[idx],
+                            queued_at=time.perf_counter()
+                        )
+                        future_to_index[future] = idx
                 
-                # Process the results as they complete
-                for future in tqdm(concurrent.futures.as_completed(future_to_index), 
-                                  total=len(future_to_index), 
-                                  desc="Downloading data chunks"):
-                    idx = future_to_index[future]
-                    try:
-                        temp_file_path = future.result()
-                        temp_files[idx] = temp_file_path
-                    except Exception as e:
-                        print(f"Error processing interval {time_intervals[idx]}: {e}")
+                    # Process the results as they complete
+                    for future in tqdm(concurrent.futures.as_completed(future_to_index), 
+                                      total=len(future_to_index), 
+                                      desc="Downloading data chunks"):
+                        idx = future_to_index[future]
+                        try:
+                            temp_file_path, row_count = future.result()
+                            record_chunk(idx, temp_file_path, row_count, None)
+                        except Exception as e:
+                            print(f"Error processing interval {work_items[idx][0]}: {e}")
+                            interval, shard_index = work_items[idx]
+                            failure_report.add(interval[0], interval[1], id_shards[shard_index], e)
+                            record_chunk(idx, None, 0, e)
+            
+            # Report the intervals that are missing from the extraction
+            failure_report.print_summary()
+            if len(failure_report):
+                failure_report.save(''.join([save_location, '/', job_name, '_memeff_failed_intervals.csv']))
+            
+            if manifest is not None and manifest.failed_keys():
+                print(f"{len(manifest.failed_keys())} chunks failed; run the script again to fetch only those")
             
             # Check if we have any valid data
             valid_temp_files = [f for f in temp_files if f is not None]
@@ -325,24 +480,65 @@ if __name__ == '__main__':
                 continue
                 
             print(f"Successfully downloaded {len(valid_temp_files)} data chunks")
-                
-            # Process the chunked data
-            final_trend_data_df = process_chunked_data(valid_temp_files, na_drop_setting)
             
-            if final_trend_data_df.empty:
-                print("No data after processing. Exiting.")
-                continue
+            # An incremental sync continues from the last saved row, so it must not save rows past a
+            # failed interval; the next sync then fetches again from the first failed interval
+            sync_cutoff = None
+            if SYNC_MODE == 'incremental' and len(failure_report):
+                sync_cutoff = pd.Timestamp(min(failure['starttime'] for failure in failure_report.failures))
+                print(f"Saving only the rows before the first failed interval ({sync_cutoff})")
                 
-            print(f"Final dataframe shape: {final_trend_data_df.shape}")
-            
-            # Save the file with the desired name, location and filetype
-            save_file = ''.join([save_location, '/', save_file_name, '_memeff_', 
-                               str(start_year), '_', str(start_month), '__', 
-                               str(end_year), '_', str(end_month), '.csv'])
-            
-            print(f"Saving data to {save_file}")
-            final_trend_data_df.to_csv(save_file)
-            print(f"Data saved successfully!")
+            # Merge the chunked data and save the final table of every log map block by block, with
+            # the desired name, location and filetype (shared chunks are projected onto each log map)
+            for logmap in logmaps:
+                save_file = logmap['save_file']
+                last_timestamp = logmap['last_timestamp']
+                print(f"Saving data to {save_file}")
+                append = SYNC_MODE == 'incremental' and (last_timestamp is not None if OUTPUT_FORMAT == 'parquet'
+                                                         else os.path.exists(save_file))
+                final_rows = 0
+                final_columns = 0
+                final_blocks = process_chunked_data(valid_temp_files, na_drop_setting, temp_dir, source_lookup,
+                                                    logmap_lookup=logmap['source_lookup'] if len(logmaps) > 1 else None)
+                while True:
+                    with metrics.stage('merge'):
+                        final_trend_data_df = next(final_blocks, None)
+                    if final_trend_data_df is None:
+                        break
+                    if last_timestamp is not None:
+                        # A shared job may start before this log map's last saved row
+                        final_trend_data_df = final_trend_data_df[final_trend_data_df.index > last_timestamp]
+                    if sync_cutoff is not None:
+                        cutoff = sync_cutoff
+                        if final_trend_data_df.index.tz is not None:
+                            # the intervals are in wall-clock time
+                            cutoff = cutoff.tz_localize(final_trend_data_df.index.tz, ambiguous=True,
+                                                        nonexistent='shift_forward')
+                        final_trend_data_df = final_trend_data_df[final_trend_data_df.index < cutoff]
+                    if final_trend_data_df.empty:
+                        continue
+                    with metrics.stage('write'):
+                        if OUTPUT_FORMAT == 'parquet':
+                            write_dataset(final_trend_data_df, save_file, partition=OUTPUT_PARTITION,
+                                          mode='append' if append or final_rows else 'overwrite',
+                                          encoding=OUTPUT_ENCODING)
+                        elif append:
+                            append_to_csv_dataset(save_file, final_trend_data_df)
+                        else:
+                            final_trend_data_df.to_csv(save_file, mode='a' if final_rows else 'w',
+                                                       header=not final_rows)
+                    final_rows += len(final_trend_data_df)
+                    final_columns = len(final_trend_data_df.columns)
+                    del final_trend_data_df
+                
+                if not final_rows:
+                    print(f"No data after processing for {logmap['name']}.")
+                    continue
+                
+                print(f"Final dataframe shape: ({final_rows}, {final_columns})")
+                print(f"Data saved successfully!")
+            # Adaptive intervals are not in the manifest, so their failures only show in the failure report
+            run_completed = not (manifest is not None and manifest.failed_keys()) and not len(failure_report)
             
             # Calculate and print timing statistics
             script_end_time = time.time()
@@ -351,6 +547,15 @@ if __name__ == '__main__':
             print(f"\nScript execution time: {elapsed_seconds:.2f} seconds ({elapsed_minutes:.2f} minutes)")
         
         finally:
-            # Clean up the temporary directory
-            print(f"Cleaning up temporary files in {temp_dir}")
-            shutil.rmtree(temp_dir, ignore_errors=True)
\ No newline at end of file
+            # Report where the time went and save the per-request metrics of this job
+            if job_name is not None and PLAN_MODE != 'dry_run':
+                metrics.print_summary()
+                metrics.save(''.join([save_location, '/', job_name, '_memeff_metrics.jsonl']))
+                metrics.reset()
+            
+            # Clean up the chunk directory; a persistent work directory is kept until its run completed
+            if temp_dir is not None and (not RESUME_RUNS or run_completed):
+                print(f"Cleaning up temporary files in {temp_dir}")
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            elif temp_dir is not None:
+                print(f"Keeping downloaded chunks in {temp_dir} for the next run")
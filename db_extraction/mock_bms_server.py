@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Oct 18 2026
+
+Local stand-in for the BMS API (bms-api.build.aau.dk)
+Serves /api/v1/metadata and /api/v1/trenddata with synthetic minute-level series,
+with configurable latency, payload size and error rate, so the extraction scripts
+can be run and benchmarked without touching the real server. Point a script at it
+by setting the environment variable BMS_API_URL=http://<host>:<port>/api/v1
+"""
+
+import datetime as dt
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+# Address the server listens on
+MOCK_HOST = '127.0.0.1'
+MOCK_PORT = 8765
+# Sources served: the rows of MOCK_LOGMAP (None for none) plus MOCK_EXTRA_IDS synthetic sources
+MOCK_LOGMAP = "./log_maps/Log_map_TMV23_2025_02_28_MIN.xlsx"
+MOCK_EXTRA_IDS = 0
+# Fixed delay (seconds) of every trenddata answer, plus a delay per row served
+MOCK_LATENCY = 0.05
+MOCK_LATENCY_PER_ROW = 0.0
+# Time between two samples of a series (60 gives minute-level data)
+MOCK_SAMPLE_SECONDS = 60
+# Fraction of trenddata requests answered with a 503 error
+MOCK_ERROR_RATE = 0.0
+# Requests asking for more rows than this are answered with 413 (None for no limit)
+MOCK_MAX_ROWS = None
+# First externallogid handed out
+MOCK_FIRST_ID = 100000
+
+
+# Function to build the list of sources served by the mock server
+def mock_sources(logmap_path=None, extra_ids=0, logmap_sheet='log_map', logmap_columns='A:D',
+                 logmap_var_loc='Log_variable_location', logmap_var_name='Logged_variable_name'):
+    """
+    Build the list of sources served by the mock server.
+
+    Args:
+        logmap_path: Optional log map whose rows are served (so the extraction scripts find them)
+        extra_ids: Number of additional synthetic sources
+        logmap_sheet: Name of the sheet containing the log map
+        logmap_columns: Columns to read from the sheet
+        logmap_var_loc: Column name for variable location
+        logmap_var_name: Column name for variable name
+
+    Returns:
+        List of {'externallogid', 'source'} dicts
+    """
+    source_paths = []
+    if logmap_path is not None:
+        source_df = pd.read_excel(io=logmap_path, sheet_name=logmap_sheet, header=0, usecols=logmap_columns)
+        source_paths = (source_df[logmap_var_loc].astype(str) + '/' + source_df[logmap_var_name].astype(str)).tolist()
+    source_paths += [f"Mock/Building/sensor_{i}" for i in range(extra_ids)]
+    return [{'externallogid': MOCK_FIRST_ID + i, 'source': source} for i, source in enumerate(dict.fromkeys(source_paths))]
+
+# Function to compute the synthetic value of a series at a time
+def mock_value(externallogid, timestamp):
+    """Daily sine wave with a per-series offset and phase (deterministic, so runs are comparable)."""
+    minutes = timestamp.timestamp() / 60
+    return round(20 + (externallogid % 7) + 5 * math.sin(2 * math.pi * minutes / 1440 + externallogid), 2)
+
+# HTTP server holding the mock configuration and the request statistics
+class MockBMSServer(ThreadingHTTPServer):
+    """
+    HTTP server holding the mock configuration and the request statistics.
+
+    Args:
+        address: (host, port) tuple
+        sources: List of sources to serve (see mock_sources)
+        latency: Fixed delay (seconds) of every trenddata answer
+        latency_per_row: Extra delay (seconds) per row served
+        sample_seconds: Time between two samples of a series
+        error_rate: Fraction of trenddata requests answered with a 503 error
+        max_rows: Requests asking for more rows are answered with 413 (None for no limit)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, sources, latency=MOCK_LATENCY, latency_per_row=MOCK_LATENCY_PER_ROW,
+                 sample_seconds=MOCK_SAMPLE_SECONDS, error_rate=MOCK_ERROR_RATE, max_rows=MOCK_MAX_ROWS):
+        super().__init__(address, MockBMSHandler)
+        self.sources = sources
+        self.latency = latency
+        self.latency_per_row = latency_per_row
+        self.sample_seconds = sample_seconds
+        self.error_rate = error_rate
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Set the request statistics back to zero."""
+        with self._lock:
+            self.stats = {'requests': 0, 'trenddata_requests': 0, 'errors': 0, 'rows': 0, 'bytes': 0}
+
+    def count(self, **increments):
+        """Add to the request statistics."""
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def url(self):
+        """Return the API base URL to put in BMS_API_URL."""
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/api/v1"
+
+# Request handler answering the metadata and trenddata endpoints
+class MockBMSHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output readable
+        pass
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(requests=1, bytes=len(body), errors=int(status >= 400))
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.rstrip('/') == '/api/v1/metadata':
+            self._send(200, json.dumps(self.server.sources).encode('utf-8'))
+        elif url.path.rstrip('/') == '/api/v1/trenddata':
+            self._trenddata(urllib.parse.parse_qs(url.query))
+        else:
+            self._send(404, b'{"detail": "Not found"}')
+
+    def _trenddata(self, query):
+        server = self.server
+        server.count(trenddata_requests=1)
+        try:
+            starttime = dt.datetime.fromisoformat(query['starttime'][0])
+            endtime = dt.datetime.fromisoformat(query['endtime'][0])
+            ids = [int(externallogid) for externallogid in query.get('externallogid', [])]
+        except (KeyError, ValueError):
+            self._send(422, b'{"detail": "Invalid starttime, endtime or externallogid"}')
+            return
+
+        known_ids = {source['externallogid'] for source in server.sources}
+        ids = [externallogid for externallogid in dict.fromkeys(ids) if externallogid in known_ids]
+        sample_count = max(0, math.ceil((endtime - starttime).total_seconds() / server.sample_seconds))
+        row_count = sample_count * len(ids)
+
+        time.sleep(server.latency + server.latency_per_row * row_count)
+        if random.random() < server.error_rate:
+            self._send(503, b'{"detail": "Service unavailable (mock)"}')
+            return
+        if server.max_rows is not None and row_count > server.max_rows:
+            self._send(413, b'{"detail": "Too many rows requested (mock)"}')
+            return
+
+        step = dt.timedelta(seconds=server.sample_seconds)
+        timestamps = [starttime + i * step for i in range(sample_count)]
+        records = [
+            {'externallogid': externallogid, 'timestamp': timestamp.isoformat(),
+             'timestamp_tzinfo': None, 'value': mock_value(externallogid, timestamp)}
+            for externallogid in ids for timestamp in timestamps
+        ]
+        server.count(rows=len(records))
+        self._send(200, json.dumps(records).encode('utf-8'))
+
+# Function to start the mock server in a background thread
+def start_mock_server(host=MOCK_HOST, port=MOCK_PORT, logmap_path=MOCK_LOGMAP, extra_ids=MOCK_EXTRA_IDS, **config):
+    """
+    Start the mock server in a background thread.
+
+    Args:
+        host: Address to listen on
+        port: Port to listen on (0 picks a free port)
+        logmap_path: Optional log map whose rows are served
+        extra_ids: Number of additional synthetic sources
+        **config: Passed on to MockBMSServer (latency, sample_seconds, error_rate, ...)
+
+    Returns:
+        The running MockBMSServer (stop it with server.shutdown())
+    """
+    server = MockBMSServer((host, port), mock_sources(logmap_path, extra_ids), **config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Mock BMS API serving {len(server.sources)} sources at {server.url()}")
+    return server
+
+# Main process
+if __name__ == '__main__':
+    server = start_mock_server()
+    print(f"Set BMS_API_URL={server.url()} to use it; press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -6,7 +6,6 @@ Based on original script by GQ05XY (Nov 1 2022)
 Modified to use multithreading for faster data extraction
 """
 
-import requests
 import pandas as pd
 import datetime as dt
 import math
@@ -19,6 +18,17 @@ import concurrent.futures
 from tqdm import tqdm  # For progress bars
 from dotenv import load_dotenv
 
+from bms_dataset import write_dataset
+from bms_fetching import (AdaptiveIntervalPlanner, build_work_items, fetch_intervals_adaptive,
+                          fetch_intervals_async, fetch_trend_data, get_thread_session, shard_externallogid)
+from bms_logmap import load_logmap
+from bms_metadata import load_metadata_index
+from bms_metrics import metrics
+from bms_planner import (estimate_extraction, print_estimate, probe_extraction, recommend_settings,
+                         slurm_memory_budget_mb)
+from bms_scheduling import FailureReport, configure_rate_limit
+from bms_processing import build_source_lookup, compact_to_wide, source_dictionary
+
 load_dotenv()  # take environment variables from .env.
 
 # Start timing the script
@@ -26,9 +36,10 @@ script_start_time = time.time()
 
 pd.set_option('display.max_colwidth', None)
 
-# API endpoints for the DB server
-TRENDDATA_NAME = "https://bms-api.build.aau.dk/api/v1/trenddata"
-METADATA_NAME = "https://bms-api.build.aau.dk/api/v1/metadata"
+# API endpoints for the DB server (set BMS_API_URL to use another server, e.g. mock_bms_server.py)
+BMS_API_URL = os.getenv('BMS_API_URL', "https://bms-api.build.aau.dk/api/v1").rstrip('/')
+TRENDDATA_NAME = BMS_API_URL + "/trenddata"
+METADATA_NAME = BMS_API_URL + "/metadata"
 
 # Set the username for the DB server (if you do not have one ask Simon)
 username = os.getenv('BD_API_USER')
@@ -36,14 +47,30 @@ username = os.getenv('BD_API_USER')
 password = os.getenv('BD_API_PASSWORD')
 
 print(f"Username: {username}")
-print(f"Password: {password}")
+print(f"Password: {'set' if password else 'not set'}")
 
 # Set the maximum number of concurrent API requests
 # Adjust this based on API rate limits and your network capacity
 MAX_WORKERS = 8
 
+# Maximum number of externallogid sent in one request; larger log maps are split into shards
+# that are fetched as separate (time window x id shard) requests. None sends all ids at once
+ID_SHARD_SIZE = None
+
+# Extraction mode: 'threads' uses the thread pool above, 'async' runs all interval requests
+# with asyncio over one pooled keep-alive HTTP client (needs aiohttp)
+EXTRACTION_MODE = 'threads'     # either 'threads' or 'async'
+# Maximum number of interval requests in flight in the async extraction mode
+MAX_CONCURRENT_REQUESTS = 64
+
+# Maximum request rate shared by all workers (None for no limit); failed requests are retried
+# with backoff, and 429 / Retry-After answers from the server pause every worker
+REQUESTS_PER_SECOND = None
+configure_rate_limit(REQUESTS_PER_SECOND)
+
 # Function to fetch trend data for a specific time interval
-def fetch_trend_data_for_interval(starttime, endtime, externallogid, source_df, logmap_var_loc, logmap_var_name):
+def fetch_trend_data_for_interval(starttime, endtime, externallogid, source_lookup, failure_report=None,
+                                  queued_at=None):
     """
     Fetch trend data for a specific time interval.
     
@@ -51,60 +78,30 @@ def fetch_trend_data_for_interval(starttime, endtime, externallogid, source_df,
         starttime: Start time for data extraction
         endtime: End time for data extraction
         externallogid: List of external log IDs to fetch
-        source_df: DataFrame containing source information
-        logmap_var_loc: Column name for variable location
-        logmap_var_name: Column name for variable name
+        source_lookup: Shared externallogid -> source lookup (see build_source_lookup)
+        failure_report: Optional FailureReport collecting the intervals that still failed
+        queued_at: time.perf_counter() value when the interval was queued (for the metrics)
     
     Returns:
-        DataFrame containing the trend data for the interval
+        Compact records of the interval (see label_trend_data_compact)
     """
-    PARAMS = {'starttime': starttime, 'endtime': endtime, 'externallogid': externallogid}
     try:
         print(f'Fetching data for interval: {starttime} to {endtime}')
-        trend_data = requests.get(TRENDDATA_NAME, params=PARAMS, auth=(username, password))
-        trend_data_text = trend_data.text
-        trend_data_df = pd.read_json(trend_data_text, orient='records')
+        # Fetch, parse and label every row with its source in one vectorized merge
+        result_df = fetch_trend_data(starttime, endtime, externallogid, source_lookup,
+                                     (username, password), TRENDDATA_NAME,
+                                     session=get_thread_session(MAX_WORKERS), queued_at=queued_at)
         
-        if trend_data_df.empty:
+        if result_df.empty:
             print(f"No data found for interval {starttime} to {endtime}")
             return pd.DataFrame()
         
-        # Process data similar to the original script
-        temp_externallogid_1 = source_df['externallogid'].explode()
-        temp_externallogid_1 = temp_externallogid_1[~temp_externallogid_1.index.duplicated(keep='first')]
-        local_source_df = source_df.copy()
-        local_source_df['externallogid'] = temp_externallogid_1
-        
-        dfs = []
-        for id_, id_df in trend_data_df.groupby('externallogid'):
-            temp_source = (local_source_df[local_source_df['externallogid']==id_][logmap_var_loc]).tolist()
-            temp_name = (local_source_df[local_source_df['externallogid']==id_][logmap_var_name]).tolist()
-            
-            if not temp_source or not temp_name:
-                continue
-                
-            temp_source_name = '/'.join(temp_source + temp_name)
-            
-            temp_s = pd.Series([temp_source_name] * len(id_df))
-            temp_df = pd.concat([id_df.reset_index(drop=True),
-                                temp_s.reset_index(drop=True)],
-                                ignore_index=True, axis=1)
-            
-            dfs.append(temp_df)
-        
-        if not dfs:
-            return pd.DataFrame()
-            
-        result_df = pd.concat(dfs, axis=0, ignore_index=True)
-        col_names = ['externallogid', 'timestamp', 'timestamp_tzinfo', 'value', 'source']
-        result_df.columns = col_names
-        source_column = result_df.pop('source')
-        result_df.insert(1, 'source', source_column)
-        
         return result_df
         
     except Exception as e:
         print(f"Error fetching data for interval {starttime} to {endtime}: {e}")
+        if failure_report is not None:
+            failure_report.add(starttime, endtime, externallogid, e)
         return pd.DataFrame()
 
 # Main process
@@ -116,6 +113,28 @@ if __name__ == '__main__':
 
     # Set the timestep size
     timestep = dt.timedelta(hours=10)
+    
+    # Interval sizing: 'fixed' uses timestep for every request, 'adaptive' starts from timestep and
+    # sizes the following intervals toward TARGET_ROWS_PER_REQUEST (uses the thread pool)
+    TIMESTEP_MODE = 'fixed'     # either 'fixed' or 'adaptive'
+    TARGET_ROWS_PER_REQUEST = 50000
+    MIN_TIMESTEP = dt.timedelta(minutes=30)
+    MAX_TIMESTEP = dt.timedelta(days=7)
+
+    # Planning: 'dry_run' sends a few probe requests per log map and prints the estimated requests, rows,
+    # size, wall time and peak memory with the settings above and the recommended settings, without
+    # extracting; 'apply' extracts with the recommended MAX_WORKERS and timestep
+    PLAN_MODE = 'off'       # either 'off', 'dry_run' or 'apply'
+    # Memory limit (in MB) the recommended settings must fit in (defaults to the SLURM --mem of the job)
+    PLAN_MEMORY_BUDGET_MB = slurm_memory_budget_mb()
+
+    # Output format: 'csv' writes one CSV file, 'parquet' writes a typed Parquet dataset directory
+    # partitioned by OUTPUT_PARTITION (read it back with bms_dataset.read_dataset)
+    OUTPUT_FORMAT = 'csv'       # either 'csv' or 'parquet'
+    OUTPUT_PARTITION = 'month'  # either 'day' or 'month'
+    # Parquet encoding: 'plain' stores every minute, 'change_points' stores only the minutes where a
+    # source changes (much smaller for counters and near-constant values; read_dataset expands it)
+    OUTPUT_ENCODING = 'plain'   # either 'plain' or 'change_points'
 
     # In the final dataframe, when dropping NA values, should the row contain NA for all variables, or just for any variables before dropping the row?
     na_drop_setting = 'all'     # either 'any' or 'all'
@@ -126,6 +145,10 @@ if __name__ == '__main__':
 
     print("Files to run: ", files_to_run)
     
+    # Load the source -> externallogid index once for all log maps (cached on disk between runs)
+    with metrics.stage('metadata'):
+        metadata_index = load_metadata_index(METADATA_NAME, (username, password))
+    
     for j in range(len(files_to_run)):
         # Set the name of the data file as a string, e.g. 'test'
         save_file_name = filenames[j]
@@ -150,75 +173,117 @@ if __name__ == '__main__':
         logmap_var_loc = 'Log_variable_location'
         logmap_var_name = 'Logged_variable_name'
         
+        # Load the compiled logmap (cached by spreadsheet contents) with the externallogid of every row,
+        # looked up in the cached metadata index
         print(f"Reading logmap from {source_logmap}")
-        source_df = pd.read_excel(io=source_logmap, sheet_name=logmap_sheet, header=0, usecols=logmap_columns)
-        
-        # Create the list of externallogid (same as original script)
-        source = []
-        for i in range(0, len(source_df)):
-            temp = '/'.join([str(source_df[logmap_var_loc][i]), str(source_df[logmap_var_name][i])])
-            source.append(temp)
-            
-        print("Fetching metadata...")
-        trend_meta = requests.get(url=METADATA_NAME, auth=(username, password))
-        trend_meta_text = trend_meta.text
-        print("Metadata status code: ", trend_meta.status_code)
+        with metrics.stage('metadata'):
+            source_df, externallogid = load_logmap(source_logmap, metadata_index, logmap_sheet, logmap_columns,
+                                                   logmap_var_loc, logmap_var_name)
+        print("Metadata processing completed")
         
-        trend_meta_df = pd.read_json(trend_meta_text, orient='records')
-        print("Metadata columns: ", trend_meta_df.columns)
+        # Build the externallogid -> source lookup once; all fetch workers share it read-only
+        source_lookup = build_source_lookup(source_df, logmap_var_loc, logmap_var_name)
         
-        externallogid = []
-        temp_externallogid = []
-        for i in range(0, len(source_df)):
-            externallogid.append(trend_meta_df.externallogid[source[i] == trend_meta_df.source].tolist())
-            temp_externallogid.append(trend_meta_df.externallogid[source[i] == trend_meta_df.source].tolist())
-            if externallogid[-1] == []:
-                print(' '.join(['source_df index', str(source_df.index[i]), 'failed']))
-                externallogid.pop()
-                
-        source_df_insert_point = len(source_df.columns)
-        source_df.insert(source_df_insert_point, 'externallogid', temp_externallogid)
-        print("Metadata processing completed")
+        # The recommended settings only apply to this job; the next one starts from the settings above
+        job_max_workers = MAX_WORKERS
+        job_timestep = timestep
+        # Estimate the cost of the extraction from a few probe requests and recommend settings for it
+        # (this script holds every row in memory until the end)
+        if PLAN_MODE != 'off':
+            probe = probe_extraction(starttime, endtime, externallogid, timestep, (username, password),
+                                     TRENDDATA_NAME, ID_SHARD_SIZE, session=get_thread_session(MAX_WORKERS))
+            print_estimate(estimate_extraction(probe, len(externallogid), starttime, endtime, timestep,
+                                               MAX_WORKERS, ID_SHARD_SIZE, requests_per_second=REQUESTS_PER_SECOND),
+                           "Estimated extraction with the current settings")
+            recommended = recommend_settings(probe, len(externallogid), starttime, endtime, PLAN_MEMORY_BUDGET_MB,
+                                             ID_SHARD_SIZE, requests_per_second=REQUESTS_PER_SECOND)
+            if recommended is None:
+                print(f"No settings fit the memory budget of {PLAN_MEMORY_BUDGET_MB} MB; "
+                      f"use memory_efficient_bms_extraction.py for this range")
+            else:
+                print_estimate(recommended, "Recommended settings")
+            if PLAN_MODE == 'dry_run':
+                continue
+            if recommended is not None:
+                job_max_workers = recommended['max_workers']
+                job_timestep = recommended['timestep']
+                print(f"Using MAX_WORKERS={job_max_workers} and timestep={job_timestep} for this job")
         
         # Generate time intervals
         time_intervals = []
         current_time = starttime
         while current_time < endtime:
-            time_intervals.append((current_time, current_time + timestep))
-            current_time += timestep
+            time_intervals.append((current_time, min(current_time + job_timestep, endtime)))
+            current_time += job_timestep
             
-        print(f"Total time intervals to process: {len(time_intervals)}")
+        # Split the externallogid list into shards; every (time window x id shard) pair is one request
+        id_shards = shard_externallogid(externallogid, ID_SHARD_SIZE)
+        work_items = build_work_items(time_intervals, id_shards)
+        
+        print(f"Total time intervals to process: {len(time_intervals)} "
+              f"({len(work_items)} requests over {len(id_shards)} id shard(s))")
         
-        # Use ThreadPoolExecutor to fetch data for each time interval in parallel
-        all_trend_data_dfs = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Create a dictionary mapping futures to time intervals for better tracking
-            future_to_interval = {
-                executor.submit(
-                    fetch_trend_data_for_interval, 
-                    interval[0],  # starttime 
-                    interval[1],  # endtime
-                    externallogid, 
-                    source_df, 
-                    logmap_var_loc, 
-                    logmap_var_name
-                ): interval for interval in time_intervals
-            }
+        # Collects the requests that still fail after all retries
+        failure_report = FailureReport()
+        
+        if TIMESTEP_MODE == 'adaptive':
+            # Size the intervals toward TARGET_ROWS_PER_REQUEST while fetching them with the thread pool
+            def fetch_interval_rows(interval_start, interval_end, shard_index, idx):
+                result_df = fetch_trend_data(interval_start, interval_end, id_shards[shard_index], source_lookup,
+                                             (username, password), TRENDDATA_NAME,
+                                             session=get_thread_session(job_max_workers))
+                return result_df, len(result_df)
             
-            # Process the results as they complete
-            for future in tqdm(concurrent.futures.as_completed(future_to_interval), 
-                              total=len(future_to_interval), 
-                              desc="Processing time intervals"):
-                interval = future_to_interval[future]
-                try:
-                    trend_data_df = future.result()
-                    if not trend_data_df.empty:
-                        all_trend_data_dfs.append(trend_data_df)
-                except Exception as e:
-                    print(f"Error processing interval {interval}: {e}")
+            # (one planner per id shard)
+            planners = [AdaptiveIntervalPlanner(starttime, endtime, job_timestep, TARGET_ROWS_PER_REQUEST,
+                                                MIN_TIMESTEP, MAX_TIMESTEP) for _ in id_shards]
+            interval_results = fetch_intervals_adaptive(planners, fetch_interval_rows, job_max_workers,
+                                                        failure_report=failure_report, id_shards=id_shards)
+            all_trend_data_dfs = [df for _, _, df in interval_results if not df.empty]
+        elif EXTRACTION_MODE == 'async':
+            # Run all interval requests with asyncio over one pooled client
+            all_trend_data_dfs = fetch_intervals_async(time_intervals, externallogid, source_lookup,
+                                                       (username, password), TRENDDATA_NAME,
+                                                       MAX_CONCURRENT_REQUESTS, id_shard_size=ID_SHARD_SIZE,
+                                                       failure_report=failure_report)
+            all_trend_data_dfs = [df for df in all_trend_data_dfs if not df.empty]
+        else:
+            # Use ThreadPoolExecutor to fetch data for each (time window x id shard) in parallel
+            all_trend_data_dfs = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=job_max_workers) as executor:
+                # Create a dictionary mapping futures to time intervals for better tracking
+                future_to_interval = {
+                    executor.submit(
+                        fetch_trend_data_for_interval, 
+                        interval[0],  # starttime 
+                        interval[1],  # endtime
+                        id_shards[shard_index], 
+                        source_lookup,
+                        failure_report,
+                        queued_at=time.perf_counter()
+                    ): interval for interval, shard_index in work_items
+                }
+            
+                # Process the results as they complete
+                for future in tqdm(concurrent.futures.as_completed(future_to_interval), 
+                                  total=len(future_to_interval), 
+                                  desc="Processing time intervals"):
+                    interval = future_to_interval[future]
+                    try:
+                        trend_data_df = future.result()
+                        if not trend_data_df.empty:
+                            all_trend_data_dfs.append(trend_data_df)
+                    except Exception as e:
+                        print(f"Error processing interval {interval}: {e}")
+        
+        # Report the intervals that are missing from the extraction
+        failure_report.print_summary()
+        if len(failure_report):
+            failure_report.save(''.join([save_location, '/', save_file_name, '_mp_failed_intervals.csv']))
         
-        # Combine all dataframes
+        # Combine all dataframes (compact records, the time zone is the same for every interval)
         if all_trend_data_dfs:
+            tz_string = all_trend_data_dfs[0].attrs.get('tz')
             temp_trend_data_df = pd.concat(all_trend_data_dfs, ignore_index=True)
             print(f"Combined data shape: {temp_trend_data_df.shape}")
         else:
@@ -227,38 +292,36 @@ if __name__ == '__main__':
             
         print("All data extracted")
         # Convert the temp_trend_data_df file into a useful df
-        unique_source = temp_trend_data_df['source'].unique()
+        unique_source = temp_trend_data_df['source_id'].unique()
         print(f"Found {len(unique_source)} unique sources")
         
-        final_trend_data_df = pd.DataFrame()
-        for source_id in tqdm(unique_source, desc="Processing sources"):
-            temp_final_trend_data_df = pd.DataFrame()
-            temp_final_trend_data_df[source_id] = temp_trend_data_df['value'][temp_trend_data_df['source']==source_id]
-            temp_final_trend_data_df['time'] = temp_trend_data_df['timestamp'][temp_trend_data_df['source']==source_id]
-            temp_final_trend_data_df['time'] = temp_final_trend_data_df['time'].apply(lambda ts: ts.replace(second=0))
-            temp_final_trend_data_df.set_index('time',inplace=True)
-            
-            if len(final_trend_data_df) == 0:
-                final_trend_data_df = temp_final_trend_data_df
-            else:
-                final_trend_data_df = final_trend_data_df.join(temp_final_trend_data_df, how='outer')
-            
-            final_trend_data_df.dropna(how=na_drop_setting, inplace=True)
-            final_trend_data_df = final_trend_data_df[~final_trend_data_df.index.duplicated(keep='first')]
-            
-        final_trend_data_df.sort_index(inplace=True)
+        with metrics.stage('merge'):
+            final_trend_data_df = compact_to_wide(temp_trend_data_df, source_dictionary(source_lookup),
+                                                  na_drop_setting, tz_string)
         
         # Save the file with the desired name, location and filetype
         save_file = ''.join([save_location, '/', save_file_name, '_mp_', 
                            str(start_year), '_', str(start_month), '__', 
-                           str(end_year), '_', str(end_month), '.csv'])
+                           str(end_year), '_', str(end_month)])
         
-        print(f"Saving data to {save_file}")
-        final_trend_data_df.to_csv(save_file)
+        with metrics.stage('write'):
+            if OUTPUT_FORMAT == 'parquet':
+                print(f"Saving data to {save_file}")
+                write_dataset(final_trend_data_df, save_file, partition=OUTPUT_PARTITION,
+                              encoding=OUTPUT_ENCODING)
+            else:
+                save_file += '.csv'
+                print(f"Saving data to {save_file}")
+                final_trend_data_df.to_csv(save_file)
         print(f"Data saved successfully! Final dataframe shape: {final_trend_data_df.shape}")
         
         # Calculate and print timing statistics
         script_end_time = time.time()
         elapsed_seconds = script_end_time - script_start_time
         elapsed_minutes = elapsed_seconds / 60
-        print(f"\nScript execution time: {elapsed_seconds:.2f} seconds ({elapsed_minutes:.2f} minutes)")
\ No newline at end of file
+        print(f"\nScript execution time: {elapsed_seconds:.2f} seconds ({elapsed_minutes:.2f} minutes)")
+        
+        # Report where the time went and save the per-request metrics of this log map
+        metrics.print_summary()
+        metrics.save(''.join([save_location, '/', save_file_name, '_mp_metrics.jsonl']))
+        metrics.reset()
\ No newline at end of file
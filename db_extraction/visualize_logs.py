@@ -1,19 +1,102 @@
+import os
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
+import matplotlib.dates as mdates
+
+from bms_lod import cached_pyramid, lttb_downsample, minmax_downsample, pyramid_range
+from bms_processing import tz_from_string
 
 matplotlib.use("qtagg")
 
-# Replace with your actual CSV filename
+# Replace with your actual CSV filename (or the directory of a Parquet dataset written by bms_dataset)
 csv_file = "./SAVED_LOGS/TMV23_2025_02_28_MIN_mp_2024_1__2024_1.csv"
 
-# Read the CSV file
-df = pd.read_csv(csv_file, parse_dates=['time'])
+# 'raw' plots every sample of every column (slow for long extractions); 'lod' plots at most one point per
+# pixel from a cached min/max/mean pyramid (see bms_lod) and reads finer levels when zooming in
+PLOT_MODE = 'lod'        # either 'raw' or 'lod'
+# 'minmax' draws the min and max of every pixel (keeps every peak), 'lttb' a line through the bucket means
+DOWNSAMPLE = 'minmax'    # either 'minmax' or 'lttb'
+# A CSV file only holds the UTC offsets of its times; they are shown in this time zone
+CSV_TZ = 'Europe/Copenhagen'
+
+
+# Function to read the logs into a wide DataFrame indexed by time
+def read_logs(path):
+    if os.path.isdir(path):
+        from bms_dataset import read_dataset  # needs pyarrow, only for datasets
+        return read_dataset(path)
+    # Read the CSV file
+    df = pd.read_csv(path)
+    if len(df) and pd.Timestamp(df['time'].iloc[0]).tz is not None:
+        # A file spanning a DST change holds two UTC offsets, which only parse through UTC
+        df['time'] = pd.to_datetime(df['time'], utc=True).dt.tz_convert(CSV_TZ)
+    else:
+        df['time'] = pd.to_datetime(df['time'])
+    # Set 'time' as the DataFrame index for easier plotting
+    df.set_index('time', inplace=True)
+    return df
+
+# Function to convert matplotlib dates to int64 UTC nanoseconds and back
+def num_to_ns(value):
+    return pd.Timestamp(mdates.num2date(value)).value
+
+def ns_to_num(values):
+    return mdates.date2num(np.asarray(values).astype('datetime64[ns]'))
+
+
+if PLOT_MODE == 'raw':
+    df = read_logs(csv_file)
+    # Plot all columns except 'time'
+    df.plot(subplots=True, figsize=(12, 10), title="Sensor Data Over Time")
+    plt.tight_layout()
+    plt.show()
+else:
+    pyramid = cached_pyramid(csv_file, read_logs)
+    time_range = pyramid_range(pyramid)
+    if time_range is None:
+        raise SystemExit(f"No data in {csv_file}")
+
+    fig, axes = plt.subplots(len(pyramid['columns']), 1, sharex=True, figsize=(12, 10), squeeze=False)
+    axes = list(axes[:, 0])
+    lines = []
+    for ax, column in zip(axes, pyramid['columns']):
+        lines.append(ax.plot([], [], linewidth=0.8, label=column)[0])
+        ax.legend(loc='upper right')
+        # the pyramid is in UTC; only the axis labels are in the time zone of the data
+        ax.xaxis_date(tz_from_string(pyramid['tz']))
+    fig.suptitle("Sensor Data Over Time")
+    shown = {}
 
-# Set 'time' as the DataFrame index for easier plotting
-df.set_index('time', inplace=True)
+    # Function to redraw the visible time range from the finest level that fits the width of the axes
+    def refresh(*_):
+        start, end = axes[0].get_xlim()
+        pixels = max(int(axes[0].bbox.width), 100)
+        key = (start, end, pixels)
+        if shown.get('key') == key:
+            # every shared axis reports the same change
+            return
+        shown['key'] = key
+        start, end = num_to_ns(start), num_to_ns(end)
+        if DOWNSAMPLE == 'lttb':
+            _, times, values = lttb_downsample(pyramid, start, end, pixels)
+            for i, line in enumerate(lines):
+                line.set_data(ns_to_num(times[:, i]), values[:, i])
+        else:
+            _, times, mins, maxs, _ = minmax_downsample(pyramid, start, end, pixels)
+            x = np.repeat(ns_to_num(times), 2)
+            # a vertical stroke from the min to the max of every pixel
+            for i, line in enumerate(lines):
+                line.set_data(x, np.column_stack((mins[:, i], maxs[:, i])).ravel())
+        fig.canvas.draw_idle()
 
-# Plot all columns except 'time'
-df.plot(subplots=True, figsize=(12, 10), title="Sensor Data Over Time")
-plt.tight_layout()
-plt.show()
\ No newline at end of file
+    axes[0].set_xlim(ns_to_num(time_range[0]), ns_to_num(time_range[1]))
+    refresh()
+    for ax in axes:
+        ax.relim()
+        ax.autoscale_view(scalex=False)
+        ax.callbacks.connect('xlim_changed', refresh)
+    fig.canvas.mpl_connect('resize_event', refresh)
+    plt.tight_layout()
+    plt.show()
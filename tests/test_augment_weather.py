@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+import augment_weather
+from exogenous_alignment import ExogenousSeries
+
+
+def test_streaming_a_csv_across_a_dst_change_keeps_its_local_times(tmp_path, monkeypatch):
+    monkeypatch.setattr(augment_weather, 'CHUNK_ROWS', 3)
+    times = pd.date_range('2024-10-27 00:00', '2024-10-27 04:00', freq='30min', tz='Europe/Copenhagen', name='time')
+    sensor_path = str(tmp_path / 'sensors.csv')
+    pd.DataFrame({'value': np.arange(len(times), dtype=float)}, index=times).to_csv(sensor_path)
+    weather = pd.DataFrame({'time': pd.date_range('2024-10-26 20:00', periods=8, freq='h'),
+                            'temp': np.arange(8, dtype=float)})
+    series = [ExogenousSeries(weather, 'linear')]
+
+    output_path = str(tmp_path / 'augmented.csv')
+    assert augment_weather.augment_streaming(sensor_path, series, output_path) == len(times)
+    augmented = pd.read_csv(output_path)
+    assert list(augmented['time']) == list(pd.read_csv(sensor_path)['time'])
+    np.testing.assert_array_equal(augmented['temp'].to_numpy(), series[0].align(times)[:, 0])
+    assert augment_weather.sensor_time_range(sensor_path) == (times[0], times[-1])
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from bms_dataset import compact_dataset, read_dataset, read_source_dictionary, write_dataset
+
+
+def minutes(start, periods):
+    return pd.date_range(start, periods=periods, freq='min', name='time')
+
+
+def test_read_dataset_returns_sources_added_by_an_append(tmp_path):
+    dataset_dir = str(tmp_path / 'dataset')
+    first = pd.DataFrame({'x': np.arange(60.0), 'y': np.arange(60.0)}, index=minutes('2024-01-01 00:00', 60))
+    second = pd.DataFrame({'x': np.arange(60.0), 'y': np.arange(60.0), 'z': np.arange(60.0)},
+                          index=minutes('2024-01-01 01:00', 60))
+    write_dataset(first, dataset_dir, partition='day')
+    write_dataset(second, dataset_dir, partition='day', mode='append')
+
+    read_df = read_dataset(dataset_dir)
+    assert list(read_df.columns) == ['x', 'y', 'z']
+    assert len(read_df) == 120
+    assert read_df['z'].notna().sum() == 60
+    assert read_df['z'].iloc[:60].isna().all()
+    np.testing.assert_array_equal(read_df['z'].iloc[60:].to_numpy(), np.arange(60.0))
+
+    later = read_dataset(dataset_dir, sources=['z'], start='2024-01-01 01:00')
+    assert later['z'].notna().sum() == 60
+
+
+def test_append_widens_a_float32_source_that_needs_float64(tmp_path):
+    dataset_dir = str(tmp_path / 'dataset')
+    write_dataset(pd.DataFrame({'x': [1.0, 2.0]}, index=minutes('2024-01-01 00:00', 2)), dataset_dir, partition='day')
+    assert read_source_dictionary(dataset_dir)['columns'][0]['dtype'] == 'float32'
+    precise = [0.1, 21.123456789]
+    write_dataset(pd.DataFrame({'x': precise}, index=minutes('2024-01-01 00:02', 2)), dataset_dir,
+                  partition='day', mode='append')
+    assert read_source_dictionary(dataset_dir)['columns'][0]['dtype'] == 'float64'
+
+    read_df = read_dataset(dataset_dir)
+    np.testing.assert_array_equal(read_df['x'].to_numpy(), [1.0, 2.0] + precise)
+    compact_dataset(dataset_dir)
+    np.testing.assert_array_equal(read_dataset(dataset_dir)['x'].to_numpy(), [1.0, 2.0] + precise)
+
+
+def test_tailed_polls_with_different_sources_read_back(tmp_path):
+    # The live tail appends every poll with only the sources that had readings in it
+    dataset_dir = str(tmp_path / 'live')
+    write_dataset(pd.DataFrame({'a': [20.5, 20.5]}, index=minutes('2024-01-01 00:00', 2)), dataset_dir,
+                  partition='day')
+    write_dataset(pd.DataFrame({'b': [0.25, 0.5], 'a': [20.75, np.nan]}, index=minutes('2024-01-01 00:02', 2)),
+                  dataset_dir, partition='day', mode='append')
+
+    for _ in range(2):
+        read_df = read_dataset(dataset_dir)
+        assert list(read_df.columns) == ['a', 'b']
+        np.testing.assert_array_equal(read_df['a'].to_numpy(), [20.5, 20.5, 20.75, np.nan])
+        np.testing.assert_array_equal(read_df['b'].to_numpy(), [np.nan, np.nan, 0.25, 0.5])
+        # the same after the tail compacts the partition
+        compact_dataset(dataset_dir)
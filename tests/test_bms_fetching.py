@@ -0,0 +1,29 @@
+import csv
+import datetime as dt
+import json
+
+from bms_fetching import AdaptiveIntervalPlanner, fetch_intervals_adaptive
+from bms_scheduling import FailureReport
+
+
+def test_adaptive_failures_record_the_ids_of_their_shard(tmp_path):
+    id_shards = [[[100000], [100001]], [[100002]]]
+    start = dt.datetime(2024, 1, 1)
+    planners = [AdaptiveIntervalPlanner(start, start + dt.timedelta(hours=2), dt.timedelta(hours=1), 1000,
+                                        dt.timedelta(minutes=10), dt.timedelta(hours=1)) for _ in id_shards]
+
+    def fetch(interval_start, interval_end, shard_index, idx):
+        if shard_index == 1:
+            raise ValueError("shard down")
+        return None, 60
+
+    failure_report = FailureReport()
+    results = fetch_intervals_adaptive(planners, fetch, 2, failure_report=failure_report, id_shards=id_shards)
+    assert len(results) == 2
+    assert len(failure_report) == 2
+
+    report_file = tmp_path / 'failed.csv'
+    failure_report.save(str(report_file))
+    with open(report_file, newline='', encoding='utf-8') as f:
+        rows = list(csv.DictReader(f))
+    assert [json.loads(row['externallogid']) for row in rows] == [[[100002]], [[100002]]]
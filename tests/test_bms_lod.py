@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+
+from bms_lod import build_pyramid, cached_pyramid, lttb_downsample, minmax_downsample, pyramid_range
+
+
+def minute_data_with_gap():
+    # two days of minute data with the readings of the 6 hours in between missing
+    times = pd.date_range('2024-01-01', periods=1440, freq='min').append(
+        pd.date_range('2024-01-02 06:00', periods=1440, freq='min'))
+    return pd.DataFrame({'a': np.sin(np.arange(2880) / 50.0), 'b': np.arange(2880.0)},
+                        index=pd.DatetimeIndex(times, name='time'))
+
+
+def test_buckets_end_at_gaps():
+    trend_data_df = minute_data_with_gap()
+    gap_start = trend_data_df.index[1440].as_unit('ns').value
+    pyramid = build_pyramid(trend_data_df, min_buckets=16)
+    assert len(pyramid['levels']) > 2
+    for level in pyramid['levels'][1:]:
+        # the bucket holding the last row before the gap ends there
+        assert gap_start in level['time']
+        assert level['gap'].sum() == 1
+        assert level['count'][:, 1].sum() == 2880
+
+
+def test_downsampled_lines_break_at_gaps():
+    trend_data_df = minute_data_with_gap()
+    pyramid = build_pyramid(trend_data_df, min_buckets=16)
+    start, end = pyramid_range(pyramid)
+    number, times, mins, maxs, means = minmax_downsample(pyramid, start, end, 200)
+    assert number > 0 and len(times) <= 202
+    assert np.isnan(maxs[:, 1]).sum() == 1
+    assert np.nanmax(maxs[:, 1]) == 2879 and np.nanmin(mins[:, 1]) == 0
+    number, times, values = lttb_downsample(pyramid, start, end, 200)
+    assert times.shape == values.shape
+    assert (np.isnan(values).sum(axis=0) == 1).all()
+
+
+def test_minmax_of_a_short_range_returns_the_samples(tmp_path):
+    trend_data_df = minute_data_with_gap()
+    data_file = tmp_path / 'data.csv'
+    data_file.write_text('')
+    pyramid = cached_pyramid(str(data_file), lambda path: trend_data_df, cache_dir=str(tmp_path / 'cache'))
+    # the second call reads the memory-mapped pyramid from the cache
+    pyramid = cached_pyramid(str(data_file), None, cache_dir=str(tmp_path / 'cache'))
+    start = trend_data_df.index[100].as_unit('ns').value
+    end = trend_data_df.index[150].as_unit('ns').value
+    number, times, mins, maxs, _ = minmax_downsample(pyramid, start, end, 500)
+    # the range runs on by one sample past its end, up to the edge of the plot
+    assert number == 0
+    np.testing.assert_array_equal(mins[:, 1], np.arange(100.0, 152.0))
+    np.testing.assert_array_equal(mins, maxs)
+
+
+def test_a_pyramid_across_a_dst_change_is_in_utc(tmp_path):
+    # the clocks go back from 03:00 to 02:00, so the wall-clock times repeat an hour
+    times = pd.date_range('2024-10-26 22:00', '2024-10-27 06:00', freq='min', tz='Europe/Copenhagen', name='time')
+    trend_data_df = pd.DataFrame({'a': np.arange(len(times), dtype=float)}, index=times)
+    data_file = tmp_path / 'data.csv'
+    data_file.write_text('')
+    cached_pyramid(str(data_file), lambda path: trend_data_df, cache_dir=str(tmp_path / 'cache'))
+    pyramid = cached_pyramid(str(data_file), None, cache_dir=str(tmp_path / 'cache'))
+    assert pyramid['tz'] == 'Europe/Copenhagen'
+    assert pyramid_range(pyramid) == (times[0].value, times[-1].value)
+    assert not pyramid['levels'][0]['gap'].any()
+    start = pd.Timestamp('2024-10-27 02:30+02:00').value
+    end = pd.Timestamp('2024-10-27 02:30+01:00').value
+    number, _, mins, maxs, _ = minmax_downsample(pyramid, start, end, 500)
+    # the range runs on by one sample past its end, over the hour the wall clock repeats
+    assert number == 0
+    first, last = np.searchsorted(times.as_unit('ns').asi8, [start, end])
+    np.testing.assert_array_equal(mins[:, 0], np.arange(first, last + 2, dtype=float))
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from bms_manifest import ChunkManifest, append_to_csv_dataset
+from bms_processing import build_source_lookup, source_dictionary
+
+
+def test_append_with_new_columns_rewrites_a_csv_spanning_a_dst_change(tmp_path):
+    csv_path = str(tmp_path / 'dataset.csv')
+    times = pd.date_range('2024-10-27 00:00', '2024-10-27 04:00', freq='30min', tz='Europe/Copenhagen',
+                          name='time')
+    pd.DataFrame({'a': np.arange(len(times), dtype=float)}, index=times).to_csv(csv_path)
+
+    new_times = pd.date_range(times[-1] + pd.Timedelta(minutes=30), periods=2, freq='30min', name='time')
+    append_to_csv_dataset(csv_path, pd.DataFrame({'a': [20.0, 21.0], 'b': [1.0, 2.0]}, index=new_times))
+
+    saved_df = pd.read_csv(csv_path, index_col=0)
+    saved_index = pd.to_datetime(saved_df.index, utc=True)
+    assert saved_index.is_monotonic_increasing and len(saved_index) == len(times) + 2
+    assert list(saved_df.columns) == ['a', 'b']
+    assert saved_df['b'].notna().sum() == 2
+
+
+def test_resume_fetches_again_after_a_source_is_inserted(tmp_path):
+    source_df = pd.DataFrame({'loc': ['room', 'room'], 'name': ['temp', 'co2'], 'externallogid': [[1], [2]]})
+    interval = (pd.Timestamp('2026-10-18 00:00'), pd.Timestamp('2026-10-18 01:00'))
+    lookup = build_source_lookup(source_df, 'loc', 'name')
+    manifest = ChunkManifest(str(tmp_path))
+    key = ChunkManifest.chunk_key('logmap', interval, [1, 2], source_dictionary(lookup))
+    manifest.record(key, 'empty')
+
+    # 'room/alarm' sorts before both sources, so their source ids change
+    inserted_df = pd.concat([source_df, pd.DataFrame({'loc': ['room'], 'name': ['alarm'], 'externallogid': [[3]]})],
+                            ignore_index=True)
+    inserted_lookup = build_source_lookup(inserted_df, 'loc', 'name')
+    resumed = ChunkManifest(str(tmp_path))
+    assert resumed.is_done(ChunkManifest.chunk_key('logmap', interval, [1, 2], source_dictionary(lookup)))
+    assert not resumed.is_done(ChunkManifest.chunk_key('logmap', interval, [1, 2],
+                                                       source_dictionary(inserted_lookup)))
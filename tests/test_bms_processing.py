@@ -0,0 +1,46 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+
+from bms_processing import (build_source_lookup, compact_to_wide, decode_trend_data_stream,
+                            label_trend_data_compact, source_dictionary)
+
+
+def trend_data_body(timestamps):
+    return json.dumps([{'externallogid': 100000, 'timestamp': timestamp, 'timestamp_tzinfo': 'Europe/Copenhagen',
+                        'value': 20.5 + i} for i, timestamp in enumerate(timestamps)]).encode('utf-8')
+
+
+def test_decode_trend_data_stream_keeps_the_timestamps():
+    timestamps = ['2026-10-18T19:16:00+02:00', '2026-10-18T19:17:00+02:00']
+    decoded = decode_trend_data_stream(io.BytesIO(trend_data_body(timestamps)))
+    assert list(decoded['timestamp']) == [pd.Timestamp(timestamp) for timestamp in timestamps]
+    assert list(decoded['value']) == [20.5, 21.5]
+
+
+def test_compact_records_pivot_back_to_the_minute_grid():
+    source_lookup = build_source_lookup(pd.DataFrame({'loc': ['room'], 'name': ['temp'], 'externallogid': [[100000]]}),
+                                        'loc', 'name')
+    trend_data_df = pd.DataFrame({'externallogid': [100000, 100000],
+                                  'timestamp': ['2026-10-18T19:16:00+02:00', '2026-10-18T19:17:00+02:00'],
+                                  'timestamp_tzinfo': ['Europe/Copenhagen'] * 2, 'value': [20.5, 21.5]})
+    compact_df = label_trend_data_compact(trend_data_df, source_lookup)
+    wide_df = compact_to_wide(compact_df, source_dictionary(source_lookup), 'all', compact_df.attrs['tz'])
+    assert list(wide_df.index) == [pd.Timestamp('2026-10-18T19:16:00+02:00'),
+                                   pd.Timestamp('2026-10-18T19:17:00+02:00')]
+    assert list(wide_df.iloc[:, 0]) == [20.5, 21.5]
+
+
+def test_float32_values_are_written_as_received():
+    source_lookup = build_source_lookup(pd.DataFrame({'loc': ['room'], 'name': ['temp'], 'externallogid': [[100000]]}),
+                                        'loc', 'name')
+    value = float(np.float32(72.89))
+    trend_data_df = pd.DataFrame({'externallogid': [100000], 'timestamp': ['2026-10-18T19:16:00+02:00'],
+                                  'timestamp_tzinfo': ['Europe/Copenhagen'], 'value': [value]})
+    compact_df = label_trend_data_compact(trend_data_df, source_lookup)
+    assert compact_df['value'].dtype == np.float32
+    wide_df = compact_to_wide(compact_df, source_dictionary(source_lookup), 'all', compact_df.attrs['tz'])
+    assert wide_df.iloc[0, 0] == value
+    assert repr(value) in wide_df.to_csv()
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from exogenous_alignment import ExogenousSeries, align_exogenous
+
+
+def hourly_weather(unit='ns'):
+    times = pd.date_range('2024-01-01 00:00', periods=4, freq='h').as_unit(unit)
+    return pd.DataFrame({'time': times, 'temp': [0.0, 6.0, 12.0, 18.0]})
+
+
+def sensor_times(unit='ns'):
+    return pd.Series(pd.date_range('2024-01-01 00:30', periods=5, freq='30min').as_unit(unit), name='time')
+
+
+def test_alignment_is_independent_of_the_datetime_unit():
+    expected = {'last': [0.0, 6.0, 6.0, 12.0, 12.0], 'linear': [3.0, 6.0, 9.0, 12.0, 15.0]}
+    for method, values in expected.items():
+        for sensor_unit, series_unit in (('us', 'ns'), ('ns', 's'), ('us', 'us')):
+            aligned = ExogenousSeries(hourly_weather(series_unit), method).align(sensor_times(sensor_unit))
+            np.testing.assert_array_equal(aligned[:, 0], values)
+
+
+def test_chunks_aligned_from_the_cursor_match_the_whole_alignment():
+    times = sensor_times()
+    for method, window in (('last', None), ('linear', None), ('mean', '90min')):
+        exogenous = ExogenousSeries(hourly_weather(), method, window)
+        whole = exogenous.align(times)
+        start = 0
+        for chunk in (times.iloc[:2], times.iloc[2:3], times.iloc[3:]):
+            np.testing.assert_array_equal(exogenous.align(chunk, start), whole[chunk.index])
+            start = exogenous.cursor(chunk.iloc[-1])
+        sensor_df = pd.DataFrame({'time': times.iloc[3:], 'value': 1.0})
+        merged = align_exogenous(sensor_df, [exogenous], starts=[exogenous.cursor(times.iloc[2])])
+        np.testing.assert_array_equal(merged['temp'].to_numpy(), whole[3:, 0])
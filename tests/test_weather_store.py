@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import weather_store
+from weather_store import WeatherStore
+
+
+class EmptyHourly:
+    # meteostat answer for a location without data
+    fetches = 0
+
+    def __init__(self, point, start, end):
+        EmptyHourly.fetches += 1
+
+    def fetch(self):
+        return pd.DataFrame()
+
+
+def test_a_span_without_data_is_fetched_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(weather_store, 'Hourly', EmptyHourly)
+    monkeypatch.setattr(weather_store, 'Point', lambda latitude, longitude: (latitude, longitude))
+    store = WeatherStore(str(tmp_path))
+    for _ in range(2):
+        data = store.hourly((57.0, 9.9), '2024-01-01', '2024-01-02', ['temp'])
+        assert data.empty
+    assert EmptyHourly.fetches == 1
+    assert store.coverage((57.0, 9.9))['temp'] == [(pd.Timestamp('2024-01-01'), pd.Timestamp('2024-01-02'))]